@@ -1,20 +1,38 @@
 import os
-import inspect
-import numpy as np
 import time
-import pickle
 import json
-import itertools
-from datetime import datetime
-from tqdm import tqdm
-
-from utils import safe_print
-from classes import Track, SubscribedPlaylist, SubscriptionFeed
-
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING
+
+from utils import safe_print, json_size, to_timestamp
+from classes import (
+    Track,
+    PlaylistRecord,
+    SeenTrackIndex,
+    SubscribedPlaylist,
+    SubscriptionFeed,
+)
+from storage import PickleStorage, get_storage
+from storage_lock import StorageLock
+from feed_journal import FeedJournal
+from feed_router import FeedPlaylist, FeedRouter
+from update_checkpoint import UpdateCheckpoint
+from poll_scheduler import PollScheduler
+from name_index import PlaylistNameIndex
+from rate_limit import RateLimiter
+from metrics import Metrics
+
+# Spotipy and numpy take long to import, so they are only imported when they are needed. This keeps runs in which
+# nothing changed fast, and lets the subscriber run against a fake API without importing spotipy at all.
 # Note: have built spotipy from source, because the pip version is outdated.
 # To install: `pip install git+https://github.com/plamere/spotipy.git --upgrade`
-from spotipy import Spotify
-import spotipy.util as sp_util
+if TYPE_CHECKING:
+    import numpy as np
+    from feed_retention import RetentionPolicy
+    from spotipy import Spotify
+    from spotipy.oauth2 import SpotifyOAuth
 
 
 class SpotifySubscriber:
@@ -24,55 +42,154 @@ class SpotifySubscriber:
     Default storage dir: ../storage
     """
 
+    # Attributes that only apply to the current run, which are not stored and not overwritten when loading
+    _run_attributes = (
+        "sp",
+        "token",
+        "_oauth",
+        "rate_limiter",
+        "metrics",
+        "_first_page_bytes",
+        "_storage",
+        "_feed_log",
+        "_library_index",
+        "_name_index",
+        "_journal",
+        "_lock",
+        "_lock_timeout",
+        "_stored_version",
+        "storage_dir",
+        "_cache_path",
+    )
+
     def __init__(
         self,
         user_id: str = None,
         storage_dir: str = os.path.join(
             os.path.dirname(os.path.abspath(__file__)), "storage"
         ),
+        spotify: "Spotify" = None,
+        storage_backend: str = "sqlite",
+        pool_size: int = 8,
+        http_cache_size: int = 64 * 2 ** 20,
+        rate_limiter: RateLimiter = None,
+        metrics: Metrics = None,
+        load_playlists: bool = True,
+        lock_timeout: float = None,
     ):
+        """
+        If spotify is provided, it is used as the API client instead of requesting a token.
+        This allows running against a local stand-in for the Spotify API.
+        Storage_backend is either 'sqlite' or 'pickle'. A pickled storage.p from an older version is
+        migrated to the sqlite backend when it is first loaded.
+        Pool_size is the number of connections to the API that are kept alive, which should be at least the
+        number of workers used in update_feed. Playlist and track responses are cached in the storage dir
+        and revalidated using their ETag, up to http_cache_size bytes. Set it to 0 to disable the cache.
+        All requests wait for the rate_limiter, which can be shared to limit the requests of several users.
+        If it is not provided, a RateLimiter with the default rate is created.
+        Metrics record where the time of a run goes, and are emitted at the end of update_feed. They are disabled
+        if not provided.
+        If load_playlists is False, the playlists the user owns and follows are not loaded from the sqlite storage,
+        which only updating the feed does not need. They stay stored, unless refresh_user_playlists replaces them.
+        Only one process at a time can load, update or save the state in a storage dir. If another one is doing so,
+        we wait until it is done, or raise an exception after lock_timeout seconds.
+        """
         self.user_id: str = user_id
+        self.metrics = metrics if metrics is not None else Metrics()
 
         # Playlists are stored by ID in dictionaries for quick lookup
         self.user_playlists: dict = {}
         self.followed_playlists: dict = {}
+        self.playlists_refreshed_at: datetime = None
         self.subscribed_playlists: dict = {}
 
+        # All tracks seen in the subscribed playlists, shared by the subscriptions
+        self.seen_tracks: SeenTrackIndex = SeenTrackIndex()
+
         # This is the playlist in which all new songs will be pushed
         self.subscription_feed: SubscriptionFeed = None
+        # Decides to which playlists of which feed new songs are pushed, see FeedRouter
+        self.feed_router: FeedRouter = None
+
+        # If there is no save file, there may not be a storage directory either.
+        os.makedirs(storage_dir, exist_ok=True)
+        self._lock = StorageLock(storage_dir)
+        self._lock_timeout = lock_timeout
 
         loaded = False
-        save_path = os.path.join(storage_dir, "storage.p")
-        # If a save file exists, load it.
-        if os.path.isfile(save_path):
-            self._load(save_path)
-            loaded = True
-
-        # Since we need the user_id, we cannot continue if it was not specified and we did not obtain it from a save file.
-        elif user_id is None:
-            raise Exception(
-                "No save file found and no user_id specified! Please specify user_id."
-            )
+        storage = get_storage(storage_backend, storage_dir)
+        legacy_storage = PickleStorage(storage_dir)
+        # Lock the storage dir while reading, so we never load state that another run is still changing.
+        with self._locked():
+            # If a save file exists, load it.
+            if storage.exists():
+                with self.metrics.phase("load"):
+                    storage.load(self, include_playlists=load_playlists)
+                self._upgrade_playlists()
+                self._upgrade_subscriptions()
+                self._upgrade_feed_router()
+                loaded = True
+
+            # Migrate the save file of older versions, which pickled the entire object.
+            elif legacy_storage.exists():
+                with self.metrics.phase("load"):
+                    legacy_storage.load(self)
+                self._upgrade_playlists()
+                self._upgrade_subscriptions()
+                self._upgrade_feed_router()
+                storage.save(self)
+                os.replace(legacy_storage.path, legacy_storage.path + ".bak")
+                safe_print(
+                    "Migrated {} to {}.".format(legacy_storage.path, storage.path)
+                )
+                loaded = True
 
-        # If there is no save file, there may not be a storage directory either
-        elif not os.path.isdir(storage_dir):
-            os.mkdir(storage_dir)
+            # Since we need the user_id, we cannot continue if it was not specified and we did not obtain it from a save file.
+            elif user_id is None:
+                raise Exception(
+                    "No save file found and no user_id specified! Please specify user_id."
+                )
+            self._stored_version = storage.version()
 
         # We deliberately set these after loading, so they may be updated if we move the save file to a different location.
         self.storage_dir = storage_dir
-        self._save_path = save_path
+        self._storage = storage
         self._cache_path = os.path.join(
             self.storage_dir, ".cache-{}".format(self.user_id)
         )
-        self._feed_log_path = os.path.join(self.storage_dir, "feed_log.npy")
-
-        # If no save file exists, load the client secret and ID from file so that we can request a token.
-        if not loaded:
-            self._load_client_secrets()
-
-        # Refresh token and create spotify object
-        self.token = self._get_token(self.user_id)
-        self.sp = Spotify(auth=self.token)
+        self._feed_log = None
+        self._library_index = None
+        self._journal = FeedJournal(self.storage_dir)
+
+        # Size in bytes of the first page of tracks of each playlist we fetched during this run
+        self._first_page_bytes = {}
+        self._name_index = None
+
+        if spotify is not None:
+            self.sp = spotify
+            self._oauth = None
+            self.rate_limiter = rate_limiter
+        else:
+            # If no save file exists, load the client secret and ID from file so that we can request a token.
+            if not loaded:
+                self._load_client_secrets()
+
+            # Refresh token and create spotify object
+            with self.metrics.phase("token"):
+                self.token = self._get_token(self.user_id)
+            self._oauth = self._create_oauth()
+            self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+            from spotipy import Spotify
+            from session import create_session
+
+            session = create_session(
+                pool_size=pool_size,
+                cache_dir=os.path.join(self.storage_dir, "http_cache"),
+                cache_size=http_cache_size,
+                rate_limiter=self.rate_limiter,
+                metrics=self.metrics,
+            )
+            self.sp = Spotify(auth=self.token, requests_session=session)
 
         # If not loaded from save file, perform initial setup
         if not loaded:
@@ -80,9 +197,26 @@ class SpotifySubscriber:
                 self._follow_user("jneeven")
 
             self.subscription_feed = SubscriptionFeed(self.sp, self.user_id)
+            self._upgrade_feed_router()
             self.refresh_user_playlists()
             self._save()
 
+    # Permissions we request from the user
+    scopes = [
+        "user-read-recently-played",
+        "user-library-modify",
+        "playlist-read-private",
+        "playlist-modify-public",
+        "playlist-modify-private",
+        "user-library-read",
+        "playlist-read-collaborative",
+        "user-read-playback-state",
+        "user-follow-read",
+        "user-top-read",
+        "user-read-currently-playing",
+        "user-follow-modify",
+    ]
+
     # Load a token from the cache or request one from the spotify API. Will open the browser to ask for permission if necessary.
     def _get_token(self, username: str):
         """
@@ -91,26 +225,11 @@ class SpotifySubscriber:
         export SPOTIPY_CLIENT_SECRET='your-spotify-client-secret'
         export SPOTIPY_REDIRECT_URI='your-app-redirect-url'
         """
-        scopes = " ".join(
-            [
-                "user-read-recently-played",
-                "user-library-modify",
-                "playlist-read-private",
-                "playlist-modify-public",
-                "playlist-modify-private",
-                "user-library-read",
-                "playlist-read-collaborative",
-                "user-read-playback-state",
-                "user-follow-read",
-                "user-top-read",
-                "user-read-currently-playing",
-                "user-follow-modify",
-            ]
-        )
+        import spotipy.util as sp_util
 
         token = sp_util.prompt_for_user_token(
             username,
-            scopes,
+            " ".join(self.scopes),
             client_id=self._client_id,
             client_secret=self._client_secret,
             redirect_uri="http://localhost",
@@ -118,6 +237,41 @@ class SpotifySubscriber:
         )
         return token
 
+    # OAuth helper that reads the cached token of the user and refreshes it, without prompting for permission.
+    def _create_oauth(self) -> "SpotifyOAuth":
+        from spotipy.oauth2 import SpotifyOAuth
+
+        return SpotifyOAuth(
+            self._client_id,
+            self._client_secret,
+            "http://localhost",
+            scope=" ".join(self.scopes),
+            cache_path=self._cache_path,
+        )
+
+    # Refresh the access token if it expires within margin seconds. Returns the unix time at which the token expires,
+    # or None if the API client was provided by the caller.
+    def refresh_token(self, margin: float = 300):
+        if self._oauth is None:
+            return None
+
+        with self.metrics.phase("token"):
+            token_info = self._oauth.get_cached_token()
+        if token_info is None:
+            raise Exception(
+                "No cached token found for user {}, please run update.py once to log in.".format(
+                    self.user_id
+                )
+            )
+        if token_info["expires_at"] - time.time() <= margin:
+            with self.metrics.phase("token"):
+                token_info = self._oauth.refresh_access_token(token_info["refresh_token"])
+
+        # The client sends this token with every request
+        self.token = token_info["access_token"]
+        self.sp._auth = self.token
+        return token_info["expires_at"]
+
     # Load the client secret and ID from client_data.json
     def _load_client_secrets(self):
         data_path = os.path.join(
@@ -132,33 +286,102 @@ class SpotifySubscriber:
         self._client_id = info["client_id"]
         self._client_secret = info["client_secret"]
 
-    # Save the entire object to a storage file
+    # The API client and token are recreated on every run, so there is no need to store them.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for attr in self._run_attributes:
+            state.pop(attr, None)
+        return state
+
+    # Hold the lock on the storage dir in the with block, see StorageLock
+    @contextmanager
+    def _locked(self):
+        self._lock.acquire(self._lock_timeout)
+        try:
+            yield
+        finally:
+            self._lock.release()
+
+    # If another run saved the state since we loaded or saved it, load it again, so we do not overwrite its changes
+    # with our outdated state. Must be called while holding the lock.
+    def _reload_if_changed(self):
+        if self._storage.version() == self._stored_version:
+            return
+        safe_print("The state was changed by another run, loading it again.")
+        with self.metrics.phase("load"):
+            self._storage.load(self, include_playlists=self._storage.includes_playlists)
+        self._upgrade_playlists()
+        self._upgrade_subscriptions()
+        self._upgrade_feed_router()
+        self._name_index = None
+        self._stored_version = self._storage.version()
+
+    # Subscriptions from older save files store their own dict of track IDs, move them into the shared index.
+    def _upgrade_subscriptions(self):
+        if "seen_tracks" not in self.__dict__:
+            self.seen_tracks = SeenTrackIndex()
+
+        for playlist in self.subscribed_playlists.values():
+            if not playlist.attached:
+                playlist.attach_index(self.seen_tracks)
+
+    # Older save files only have the subscription feed, which becomes the first playlist of the default feed.
+    def _upgrade_feed_router(self):
+        if self.__dict__.get("feed_router") is None:
+            self.feed_router = FeedRouter(self.subscription_feed.id, self.subscription_feed.name)
+
+    # The log of tracks added to the feed. It needs numpy, so it is only loaded when it is used.
+    @property
+    def feed_log(self):
+        if self._feed_log is None:
+            from feed_log import FeedLog
+
+            self._feed_log = FeedLog(self.storage_dir)
+        return self._feed_log
+
+    # Older save files store the raw playlist dicts of the API, convert them into compact records.
+    def _upgrade_playlists(self):
+        for playlists in [self.user_playlists, self.followed_playlists]:
+            for playlist_id, playlist in playlists.items():
+                if isinstance(playlist, dict):
+                    playlists[playlist_id] = PlaylistRecord.from_api(playlist)
+
+    # Write the current state to the storage backend
     def _save(self):
-        pickle.dump(self, open(self._save_path, "wb"))
-
-    # Load the storage file and overwrite the current object attributes
-    def _load(self, save_path: str):
-        load_obj = pickle.load(open(save_path, "rb"))
-
-        # Overwrite own attributes with the ones we just loaded
-        for attr, val in load_obj.__dict__.items():
-            self.__dict__[attr] = val
+        with self._locked(), self.metrics.phase("save"):
+            self._storage.save(self)
+            self._stored_version = self._storage.version()
 
     # Obtain the playlists the user owns or follows (both private and public)
-    def refresh_user_playlists(self):
-        self.user_playlists = {}
-        self.followed_playlists = {}
+    def refresh_user_playlists(self, max_age: float = None):
+        """
+        Only compact PlaylistRecords are kept. The new listing is compared with the previous one, and the returned dict
+        contains the records of the playlists that were added, removed or changed (based on their snapshot ID).
+        If max_age (in seconds) is given and the previous listing is more recent than that, nothing is requested
+        and None is returned.
+        """
+        if (
+            max_age is not None
+            and self.playlists_refreshed_at is not None
+            and (datetime.utcnow() - self.playlists_refreshed_at).total_seconds() < max_age
+        ):
+            return None
+
+        previous_playlists = {**self.user_playlists, **self.followed_playlists}
+        user_playlists = {}
+        followed_playlists = {}
 
         # Only obtains 50 playlists at a time, is API limit
         playlists_data = self.sp.user_playlists(self.user_id)
 
         while playlists_data:
             for playlist in playlists_data["items"]:
+                record = PlaylistRecord.from_api(playlist)
                 # If we own a playlist but it's collaborative, we treat it as a followed one since we might be interested in updates.
-                if playlist["owner"]["id"] != self.user_id or playlist["collaborative"]:
-                    self.followed_playlists[playlist["id"]] = playlist
+                if record.owner_id != self.user_id or record.collaborative:
+                    followed_playlists[record.id] = record
                 else:
-                    self.user_playlists[playlist["id"]] = playlist
+                    user_playlists[record.id] = record
 
             # If there were more playlists than we just received, query the next batch
             if playlists_data["next"]:
@@ -166,10 +389,57 @@ class SpotifySubscriber:
             else:
                 break
 
-    # Subscribe to multiple playlists based on their ID or patterns in their names.
-    def subscribe_to_playlists(self, playlist_ids: list = [], contains: list = []):
-        new_subscriptions = False
+        self.user_playlists = user_playlists
+        self.followed_playlists = followed_playlists
+        self.playlists_refreshed_at = datetime.utcnow()
+        self._save()
 
+        playlists = {**user_playlists, **followed_playlists}
+        return {
+            "added": [playlists[key] for key in playlists.keys() - previous_playlists.keys()],
+            "removed": [
+                previous_playlists[key] for key in previous_playlists.keys() - playlists.keys()
+            ],
+            "changed": [
+                playlist
+                for key, playlist in playlists.items()
+                if key in previous_playlists
+                and playlist.snapshot_id != previous_playlists[key].snapshot_id
+            ],
+        }
+
+    # Print the changes returned by refresh_user_playlists
+    def print_playlist_changes(self, changes: dict):
+        if changes is None:
+            safe_print(
+                "Playlists were last refreshed at {} (UTC), not refreshing them again.".format(
+                    self.playlists_refreshed_at.strftime("%Y-%m-%d %H:%M:%S")
+                )
+            )
+            return
+
+        for change in ["added", "removed", "changed"]:
+            for playlist in changes[change]:
+                safe_print("Playlist {} {}".format(change, playlist))
+
+    # Index of the names of the followed playlists, which is rebuilt after they are refreshed.
+    def _followed_name_index(self) -> PlaylistNameIndex:
+        index = self._name_index
+        if index is None or index.playlists is not self.followed_playlists:
+            index = PlaylistNameIndex(self.followed_playlists)
+            self._name_index = index
+        return index
+
+    # Subscribe to multiple playlists based on their ID or patterns in their names.
+    def subscribe_to_playlists(
+        self, playlist_ids: list = [], contains: list = [], max_workers: int = 8
+    ):
+        """
+        Contains is a list of name patterns, see PlaylistNameIndex for the supported forms.
+        The tracks of all new subscriptions are fetched concurrently, using up to max_workers threads,
+        and the result is saved once.
+        """
+        matched_ids = []
         for playlist_id in playlist_ids:
             if playlist_id not in self.followed_playlists.keys():
                 raise Exception(
@@ -177,49 +447,41 @@ class SpotifySubscriber:
                         playlist_id
                     )
                 )
+            matched_ids.append(playlist_id)
 
-            if playlist_id not in self.subscribed_playlists.keys():
-                playlist = self.followed_playlists[playlist_id]
-                tracks = self._get_playlist_tracks(playlist["owner"]["id"], playlist_id)
-                self.subscribed_playlists[playlist_id] = SubscribedPlaylist(
-                    playlist, tracks
-                )
-                new_subscriptions = True
+        if contains:
+            matched_ids += self._followed_name_index().match(contains)
+
+        new_playlists = [
+            self.followed_playlists[playlist_id]
+            for playlist_id in dict.fromkeys(matched_ids)
+            if playlist_id not in self.subscribed_playlists.keys()
+        ]
+        if not new_playlists:
+            return
+
+        def fetch_tracks(playlist: PlaylistRecord) -> list:
+            return list(self._iter_playlist_tracks(playlist.owner_id, playlist.id))
+
+        # The seen track index is not thread-safe, so subscriptions are created here, in order.
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            for playlist, tracks in zip(
+                new_playlists, executor.map(fetch_tracks, new_playlists)
+            ):
+                subscription = SubscribedPlaylist(playlist, tracks, self.seen_tracks)
+                subscription.first_page_bytes = self._first_page_bytes.pop(playlist.id, 0)
+                self.subscribed_playlists[playlist.id] = subscription
                 safe_print(
-                    "Subscribed to playlist {} by {}".format(
-                        playlist["name"], playlist["owner"]["id"]
-                    )
+                    "Subscribed to playlist {} by {}".format(playlist.name, playlist.owner_id)
                 )
 
-        # Lowercase pattern matching with the playlist name
-        for pattern in contains:
-            pattern = pattern.lower()
-            for playlist in self.followed_playlists.values():
-                if (
-                    pattern in playlist["name"].lower()
-                    and playlist["id"] not in self.subscribed_playlists.keys()
-                ):
-                    tracks = self._get_playlist_tracks(
-                        playlist["owner"]["id"], playlist["id"]
-                    )
-                    self.subscribed_playlists[playlist["id"]] = SubscribedPlaylist(
-                        playlist, tracks
-                    )
-                    new_subscriptions = True
-                    safe_print(
-                        "Subscribed to playlist {} by {}".format(
-                            playlist["name"], playlist["owner"]["id"]
-                        )
-                    )
-
-        # Only save if we actually changed something. TODO: Save these in a separate file.
-        if new_subscriptions:
-            self._save()
+        self._save()
 
     # Unsubscribe from multiple playlists based on their ID or patterns in their names.
     def unsubscribe_from_playlists(self, playlist_ids: list = [], contains: list = []):
-        removed_subscriptions = False
-
+        """
+        Contains is a list of name patterns, see PlaylistNameIndex for the supported forms.
+        """
         for playlist_id in playlist_ids:
             if playlist_id not in self.subscribed_playlists.keys():
                 raise Exception(
@@ -228,44 +490,104 @@ class SpotifySubscriber:
                     )
                 )
 
-            playlist = self.subscribed_playlists[playlist_id]
-            removed_subscriptions = True
+        removed_ids = list(playlist_ids)
+        if contains:
+            removed_ids += PlaylistNameIndex(self.subscribed_playlists).match(contains)
+
+        for playlist_id in dict.fromkeys(removed_ids):
+            playlist = self.subscribed_playlists.pop(playlist_id)
             safe_print(
                 "Unsubscribed from playlist {} by {}".format(
                     playlist.name, playlist.owner_id
                 )
             )
-            del self.subscribed_playlists[playlist_id]
-
-        # Lowercase pattern matching with the playlist name
-        subscribed_playlists = list(self.subscribed_playlists.values())
-        for pattern in contains:
-            pattern = pattern.lower()
-            for playlist in subscribed_playlists:
-                if pattern in playlist.name.lower():
-                    removed_subscriptions = True
-                    safe_print(
-                        "Unsubscribed from playlist {} by {}".format(
-                            playlist.name, playlist.owner_id
-                        )
-                    )
-                    del self.subscribed_playlists[playlist.id]
 
-        # Only save if we actually changed something. TODO: Save these in a separate file.
-        if removed_subscriptions:
+        # Only save if we actually changed something.
+        if removed_ids:
+            self._save()
+
+    # Choose how new songs are spread over feeds, see FeedRouter for the modes.
+    def set_feed_mode(self, mode: str, max_tracks: int = FeedRouter.default_max_tracks):
+        """
+        Feeds roll over into a new playlist once they hold max_tracks tracks. If it is None, they never roll over.
+        """
+        self.feed_router.set_mode(mode, max_tracks)
+        self._save()
+
+    # Add the new songs of subscribed playlists to the feed with the given name, if the feed mode is "source".
+    def route_playlists(self, feed_name: str, playlist_ids: list = [], contains: list = []):
+        """
+        Contains is a list of name patterns, see PlaylistNameIndex for the supported forms.
+        The playlists of the feed are created when the first songs are added to it.
+        """
+        routed_ids = self._match_subscriptions(playlist_ids, contains)
+        self.feed_router.route(routed_ids, feed_name)
+        for playlist_id in routed_ids:
+            safe_print(
+                "Routed playlist {} to feed {}".format(self.subscribed_playlists[playlist_id].name, feed_name)
+            )
+
+        if routed_ids:
             self._save()
 
+    # Add the new songs of subscribed playlists to the default feed again.
+    def unroute_playlists(self, playlist_ids: list = [], contains: list = []):
+        """
+        Contains is a list of name patterns, see PlaylistNameIndex for the supported forms.
+        """
+        routed_ids = self._match_subscriptions(playlist_ids, contains)
+        self.feed_router.unroute(routed_ids)
+        if routed_ids:
+            self._save()
+
+    # IDs of the subscribed playlists with the given IDs or names that match the patterns
+    def _match_subscriptions(self, playlist_ids: list, contains: list) -> list:
+        for playlist_id in playlist_ids:
+            if playlist_id not in self.subscribed_playlists.keys():
+                raise Exception(
+                    "Cannot route playlist with id {}, because the user is not subscribed to it.".format(
+                        playlist_id
+                    )
+                )
+
+        matched_ids = list(playlist_ids)
+        if contains:
+            matched_ids += PlaylistNameIndex(self.subscribed_playlists).match(contains)
+        return list(dict.fromkeys(matched_ids))
+
+    # Print the feeds, their playlists and which subscribed playlists are routed to them.
+    def print_feeds(self):
+        router = self.feed_router
+        if router.max_tracks is not None:
+            safe_print("Feed mode: {}, rolling over after {} tracks.".format(router.mode, router.max_tracks))
+        else:
+            safe_print("Feed mode: {}, never rolling over.".format(router.mode))
+        # Feeds that playlists are routed to are only created when the first songs are added to them
+        for feed_name in dict.fromkeys(list(router.feeds) + list(router.routes.values())):
+            safe_print("\nFeed {}:".format(feed_name))
+            for playlist in router.feeds.get(feed_name, []):
+                safe_print(
+                    "\t{} ({} tracks)".format(
+                        playlist.name, playlist.num_tracks if playlist.num_tracks is not None else "?"
+                    )
+                )
+            for playlist_id, routed_name in router.routes.items():
+                if routed_name == feed_name and playlist_id in self.subscribed_playlists:
+                    safe_print("\tfrom {}".format(self.subscribed_playlists[playlist_id].name))
+
+        safe_print()
+
     # Print an overview of the playlist the user owns, follows and is subscribed to.
     def print_playlists(self, own=False, follow=False, subscribed=True):
         if own:
             safe_print("Own playlists:")
             for playlist in self.user_playlists.values():
-                safe_print(playlist["name"])
+                safe_print(playlist.name)
 
         if follow:
             safe_print("\nFollowed playlists:")
             for playlist in self.followed_playlists.values():
-                safe_print(playlist["name"], playlist["owner"]["id"])
+                safe_print(playlist.name, playlist.owner_id)
 
         if subscribed:
             safe_print("\nCurrently subscribed to the following playlists:")
@@ -275,82 +597,302 @@ class SpotifySubscriber:
         safe_print()
 
     # Check the subscribed playlists for new songs and add them to the feed list.
-    def update_feed(self, add_own=False):
+    def update_feed(
+        self,
+        add_own=False,
+        max_workers: int = 1,
+        incremental=True,
+        executor: ThreadPoolExecutor = None,
+        skip_library: bool = True,
+        scheduler: PollScheduler = None,
+    ):
         """
         Add_own denotes whether to add songs that the user added to a playlist themselves.
         This may happen for example in collaborative playlists.
+        Max_workers denotes how many playlists are fetched from the API concurrently.
+        The results are merged in subscription order, so the outcome is the same as fetching them one by one.
+        If an executor is provided, playlists are fetched in it instead of in a new pool of max_workers threads.
+        This allows sharing one pool between several users.
+
+        The update happens in two passes: first we only request the snapshot ID of every subscribed playlist,
+        then we page through the tracks of the playlists of which the snapshot changed.
+        If incremental is True, changed playlists are read from the end until we reach tracks that are older than
+        the last update, rather than paging through the entire playlist.
+        If skip_library is True, new tracks that the user saved in their library or has in one of their own playlists
+        are not added, see LibraryIndex. The index is only brought up to date if there are new tracks.
+        The storage dir is locked during the update, and if another run changed the state since it was loaded,
+        it is loaded again first.
+        Only the subscriptions that the scheduler considers due are checked, see PollScheduler. If it is not provided,
+        a PollScheduler with the default intervals and no request budget is used.
         """
+        if scheduler is None:
+            scheduler = PollScheduler()
+        with self._locked():
+            self._reload_if_changed()
+            return self._update_feed(add_own, max_workers, incremental, executor, skip_library, scheduler)
+
+    # Update the feed while holding the lock, see update_feed
+    def _update_feed(
+        self,
+        add_own: bool,
+        max_workers: int,
+        incremental: bool,
+        executor: ThreadPoolExecutor,
+        skip_library: bool,
+        scheduler: PollScheduler,
+    ):
+        self._recover_feed_journal()
 
         last_update = self.subscription_feed.last_update
+        # Anything added while this update is running will be picked up next time
+        update_stamp = datetime.utcnow()
 
         track_ids = []
+        # Tracks are only marked as seen once they have been added to the feed, so failed writes are retried next time.
+        pending_tracks = []
+        checked_playlists = []
+        # (playlist, whether its snapshot changed, number of new tracks) of every playlist we probed
+        probed_playlists = []
         num_added_tracks = 0
 
-        for playlist_id, playlist in self.subscribed_playlists.items():
-            # safe_print("Checking playlist {}".format(playlist.name))
-            new_tracks, snapshot = self._get_playlist_tracks(
-                playlist.owner_id,
-                playlist_id,
-                min_timestamp=last_update,
-                compare_snapshot=playlist.snapshot_id,
-                return_snapshot=True,
+        checkpoint = UpdateCheckpoint(self.storage_dir, last_update, add_own, incremental)
+        if len(checkpoint) > 0:
+            safe_print(
+                "Resuming the interrupted update, which fetched {} playlists.".format(len(checkpoint))
             )
-            # Update the playlist snapshot so that we quickly know if it has changed next time
-            playlist.snapshot_id = snapshot
-
-            added = 0
-            for track in new_tracks:
-                if track.id == None:
-                    print(f"Track with id None: {track}")
-                if add_own or track.added_by != self.user_id:
-                    try:
-                        # Only add the track if it wasn't already in the list when we subbed
-                        if track.id not in playlist.track_ids.keys():
-                            track_ids.append(track.id)
-                            # Add the ID to the track ID list so we know not to add it in the future
-                            playlist.track_ids[track.id] = datetime.utcnow()
-                            added += 1
-                    # TODO: correctly upgrade objects if storage consists of SubscribedPlaylists without ID list.
-                    except AttributeError:
-                        track_ids.append(track.id)
-                        added += 1
-
-            if added > 0:
-                safe_print(
-                    "Obtained {} new tracks from playlist {}!".format(
-                        added, playlist.name
-                    )
+
+        # Return the IDs of the tracks that are new for the playlist. Progress is recorded in the checkpoint.
+        def fetch(item):
+            playlist_id, playlist, snapshot, num_tracks = item
+            progress = checkpoint.progress(playlist_id, snapshot)
+            if progress is not None and progress["done"]:
+                return progress["track_ids"], snapshot
+
+            # Playlists are not checked on every update, so look for tracks added since this one was last checked
+            since = playlist.last_checked if playlist.last_checked is not None else last_update
+            new_ids = []
+            tracks = None
+            if progress is None and incremental and playlist.num_tracks is not None:
+                tracks = self._get_new_playlist_tracks(
+                    playlist.owner_id,
+                    playlist_id,
+                    since,
+                    num_tracks,
+                    playlist.num_tracks,
+                )
+            if tracks is None:
+                # Continue an interrupted scan of the playlist
+                start_offset = 0
+                if progress is not None:
+                    start_offset = progress["offset"]
+                    new_ids += progress["track_ids"]
+                tracks = self._iter_playlist_tracks(
+                    playlist.owner_id,
+                    playlist_id,
+                    min_timestamp=since,
+                    start_offset=start_offset,
+                    on_page=lambda offset: checkpoint.update(playlist_id, snapshot, offset, new_ids),
                 )
 
+            # Filter the tracks as the pages come in, so we only hold on to the ones that are new for this playlist.
+            for track in tracks:
+                if (add_own or track.added_by != self.user_id) and not playlist.has_track(track.id):
+                    new_ids.append(track.id)
+            checkpoint.update(playlist_id, snapshot, num_tracks, new_ids, done=True)
+            return new_ids, snapshot
+
+        def probe(item):
+            playlist_id, playlist = item
+            return self._get_playlist_snapshot(playlist.owner_id, playlist_id)
+
+        due, num_postponed = scheduler.due(list(self.subscribed_playlists.values()), update_stamp)
+        subscriptions = [(playlist.id, playlist) for playlist in due]
+        num_not_due = len(self.subscribed_playlists) - len(due) - num_postponed
+        if num_not_due > 0:
+            safe_print("Skipped {} playlists that rarely get new tracks and are not due yet.".format(num_not_due))
+        if num_postponed > 0:
+            safe_print("Postponed {} due playlists to stay within the request budget.".format(num_postponed))
+        # Our own pool is shut down after fetching, so later phases use the given executor or create their own
+        shared_executor = executor
+        if executor is None:
+            pool = ThreadPoolExecutor(max_workers=max(1, max_workers))
+        else:
+            pool = nullcontext(executor)
+        try:
+            with pool as executor:
+                # If the snapshot is still the same, there is nothing interesting for us to see.
+                # NOTE: certain playlists like 'Brain Food' seem to have a different snapshot every time.
+                changed = []
+                bytes_avoided = 0
+                with self.metrics.phase("snapshots"):
+                    for (playlist_id, playlist), (snapshot, num_tracks) in zip(
+                        subscriptions, executor.map(probe, subscriptions)
+                    ):
+                        if snapshot == playlist.snapshot_id:
+                            bytes_avoided += playlist.first_page_bytes
+                            probed_playlists.append((playlist, False, 0))
+                        else:
+                            changed.append((playlist_id, playlist, snapshot, num_tracks))
+
+                num_skipped = len(subscriptions) - len(changed)
+                if num_skipped > 0:
+                    safe_print(
+                        "Skipped {} of {} playlists because they did not change (avoided downloading ~{:.1f} kB).".format(
+                            num_skipped, len(subscriptions), bytes_avoided / 1024
+                        )
+                    )
+
+                with self.metrics.phase("fetch"):
+                    # Executor.map yields the results in order, so we can merge them while later playlists are still being fetched.
+                    for (playlist_id, playlist, _, num_tracks), (playlist_track_ids, snapshot) in zip(
+                        changed, executor.map(fetch, changed)
+                    ):
+                        checked_playlists.append((playlist, snapshot, num_tracks))
+                        playlist.first_page_bytes = self._first_page_bytes.pop(
+                            playlist_id, playlist.first_page_bytes
+                        )
+
+                        added = 0
+                        new_ids = set()
+                        for track_id in playlist_track_ids:
+                            # The same track may appear in a playlist more than once
+                            if track_id not in new_ids:
+                                new_ids.add(track_id)
+                                track_ids.append(track_id)
+                                pending_tracks.append((playlist, track_id))
+                                added += 1
+
+                        probed_playlists.append((playlist, True, added))
+                        if added > 0:
+                            safe_print(
+                                "Obtained {} new tracks from playlist {}!".format(
+                                    added, playlist.name
+                                )
+                            )
+        except BaseException:
+            # Keep the progress of the playlists that were fetched, so the next update can resume from there
+            checkpoint.save()
+            raise
+
+        failed_ids = set()
+        unique_ids = []
         if len(track_ids) > 0:
-            unique_ids = np.unique(track_ids)
-
-            # If a feed log exists, filter all track IDs that have already been added to the feed before.
-            if os.path.exists(self._feed_log_path):
-                feed_log = pickle.load(open(self._feed_log_path, "rb"))
-                filtered_indices = np.where(~np.isin(unique_ids, feed_log["track_ids"]))
-                unique_ids = unique_ids[filtered_indices]
-
-            # We can add at most 100 tracks to a playlist in a single request.
-            if unique_ids.size <= 100:
-                self.sp.user_playlist_add_tracks(
-                    self.user_id, self.subscription_feed.id, unique_ids
+            import numpy as np
+
+            # Filter all track IDs that have already been added to the feed before.
+            with self.metrics.phase("feed_log"):
+                unique_ids = self.feed_log.filter_new(np.unique(track_ids))
+
+            # Tracks the user already has are marked as seen without adding them
+            if skip_library and len(unique_ids) > 0:
+                self.refresh_library_index(max_workers, shared_executor)
+                in_library = self.library_index.contains(unique_ids)
+                if in_library.any():
+                    safe_print(
+                        "Skipped {} new tracks that are already in your library or own playlists.".format(
+                            int(in_library.sum())
+                        )
+                    )
+                unique_ids = unique_ids[~in_library]
+
+        # If all new tracks were added to the feed before, there is nothing to write
+        if len(unique_ids) > 0:
+            # Every batch is logged as soon as it was added, so a failure halfway does not lose the earlier batches.
+            # The journal tells the next run which tracks may have been added if this one is interrupted.
+            from feed_writer import FeedWriter
+
+            # Tracks are routed by the first subscribed playlist they were found in
+            sources = {}
+            for playlist, track_id in pending_tracks:
+                sources.setdefault(track_id, playlist.id)
+            feed_ids = self.feed_router.playlist_ids()
+            assignments = self.feed_router.assign(
+                unique_ids.tolist(),
+                sources,
+                update_stamp,
+                create_playlist=self._create_feed_playlist,
+                count_tracks=lambda playlist_id: self._get_playlist_snapshot(self.user_id, playlist_id)[1],
+            )
+            # Save the playlists that were created right away, so they are used again if the update is interrupted
+            if self.feed_router.playlist_ids() != feed_ids:
+                self._save()
+
+            written_ids = []
+            for feed, feed_track_ids in assignments:
+                self._journal.begin(feed.id, feed_track_ids)
+
+                writer = FeedWriter(
+                    self.sp,
+                    self.user_id,
+                    feed.id,
+                    max_in_flight=max_workers,
                 )
-            else:
-                # Split array into near-equal sections that are smaller than 100 tracks
-                for id_array in np.array_split(
-                    unique_ids, np.ceil(unique_ids.size / 100).astype(int)
-                ):
-                    self.sp.user_playlist_add_tracks(
-                        self.user_id, self.subscription_feed.id, id_array
+                with self.metrics.phase("feed_write"):
+                    feed_written_ids = writer.write(
+                        feed_track_ids,
+                        on_written=lambda batch: self._log_feed_updates(batch, feed.id),
                     )
+                feed.num_tracks += len(feed_written_ids)
+                written_ids += feed_written_ids
 
-            num_added_tracks = unique_ids.size
-            self._log_feed_updates(unique_ids)
+                if writer.batch_stats:
+                    summary = writer.summary()
+                    safe_print(
+                        "Added {} tracks to {} in {} batches ({} retries, {:.0f} ms mean latency per batch).".format(
+                            summary["tracks"],
+                            feed.name,
+                            summary["batches"],
+                            summary["retries"],
+                            summary["mean_latency"] * 1000,
+                        )
+                    )
+            failed_ids = set(unique_ids.tolist()) - set(written_ids)
+            num_added_tracks = len(written_ids)
 
-        # Update the timestamp and save to file
-        self.subscription_feed.last_update = datetime.utcnow()
+        failed_playlists = set()
+        for playlist, track_id in pending_tracks:
+            if track_id in failed_ids:
+                failed_playlists.add(playlist.id)
+            else:
+                # Add the ID to the seen tracks so we know not to add it in the future
+                playlist.add_track(track_id)
+
+        # Update the playlist snapshots so that we quickly know if they have changed next time.
+        # Playlists of which some tracks could not be added keep their old snapshot, so they are checked again.
+        for playlist, snapshot, num_tracks in checked_playlists:
+            if playlist.id not in failed_playlists:
+                playlist.snapshot_id = snapshot
+                playlist.num_tracks = num_tracks
+
+        # Playlists of which some tracks could not be added stay due, since they were not checked completely
+        for playlist, changed, num_new_tracks in probed_playlists:
+            if playlist.id not in failed_playlists:
+                scheduler.record(playlist, changed, num_new_tracks, update_stamp)
+
+        # Update the timestamp and save to file. If some tracks could not be added, we keep the old timestamp
+        # so that they are found again next time.
+        if failed_ids:
+            safe_print(
+                "Could not add {} tracks to the feed, they will be retried on the next update.".format(
+                    len(failed_ids)
+                )
+            )
+        else:
+            self.subscription_feed.last_update = update_stamp
         self._save()
+        self._journal.clear()
+        checkpoint.clear()
+
+        if self.metrics.enabled:
+            summary = self.metrics.summary()
+            summary["added_tracks"] = num_added_tracks
+            summary["checked_playlists"] = len(checked_playlists)
+            summary["due_playlists"] = len(subscriptions)
+            summary["postponed_playlists"] = num_postponed
+            if self.rate_limiter is not None:
+                summary["rate_limiter"] = self.rate_limiter.stats()
+            safe_print(json.dumps(summary))
+            self.metrics.emit(summary)
 
         return num_added_tracks
 
@@ -368,124 +910,436 @@ class SpotifySubscriber:
             playlist_owner_id, playlist_id, fields="tracks, snapshot_id"
         )
 
-        return_tracks = []
-        if not min_timestamp:
-            min_timestamp = datetime.fromtimestamp(0)
-
         # If the snapshot is still the same, there is nothing interesting for us to see.
         # NOTE: certain playlists like 'Brain Food' seem to have a different snapshot every time.
         if compare_snapshot and data["snapshot_id"] == compare_snapshot:
             # safe_print("Snapshot still the same, ignoring list contents.")
             return [], data["snapshot_id"]
 
-        tracks = data["tracks"]
-        while tracks:
-            for track in tracks["items"]:
-                added_at = track["added_at"]
+        return_tracks = list(
+            self._iter_playlist_tracks(
+                playlist_owner_id,
+                playlist_id,
+                min_timestamp=min_timestamp,
+                first_page=data["tracks"],
+            )
+        )
 
-                # Somehow, it's possible that we receive an empty track. IDK if this is a spotipy bug or what
-                if track["track"] is None or track["track"]["id"] is None:
-                    print("WARNING: encountered None track! Ignoring.")
-                    continue
+        if return_snapshot:
+            return return_tracks, data["snapshot_id"]
 
-                timestamp = datetime.strptime(added_at, "%Y-%m-%dT%H:%M:%SZ")
-                if timestamp > min_timestamp:
-                    return_tracks.append(Track(track, playlist_id))
-                    # safe_print("Found track with name {} and timestamp {} ( > {})".format(track_name, timestamp, min_timestamp))
+        return return_tracks
 
-            if tracks["next"]:
-                tracks = self.sp.next(tracks)
-            else:
+    # Yield the tracks in the specified playlist added after min_timestamp, one page at a time as they are received.
+    # While the tracks of a page are being processed, the next page is already requested.
+    def _iter_playlist_tracks(
+        self,
+        playlist_owner_id: str,
+        playlist_id: str,
+        min_timestamp: datetime = None,
+        first_page: dict = None,
+        start_offset: int = 0,
+        on_page=None,
+    ):
+        """
+        Reading starts at start_offset. If on_page is given, it is called with the offset of the next page once
+        all tracks of a page have been consumed.
+        """
+        from page_parser import parse_new_tracks
+
+        if not min_timestamp:
+            min_timestamp = datetime.fromtimestamp(0)
+
+        tracks = first_page
+        if tracks is None:
+            tracks = self.sp.user_playlist_tracks(playlist_owner_id, playlist_id, offset=start_offset)
+
+        # Remember how much data the first page costs, so we know how much we save by skipping it next time.
+        if start_offset == 0:
+            self._first_page_bytes[playlist_id] = json_size(tracks)
+
+        with ThreadPoolExecutor(max_workers=1) as prefetcher:
+            while tracks:
+                self.metrics.count_page(playlist_id)
+                next_tracks = None
+                if tracks["next"]:
+                    next_tracks = prefetcher.submit(self.sp.next, tracks)
+
+                # The times of the whole page are compared at once, and only new tracks are converted
+                yield from parse_new_tracks(tracks["items"], playlist_id, min_timestamp)
+
+                if on_page is not None:
+                    on_page(tracks["offset"] + len(tracks["items"]))
+                tracks = next_tracks.result() if next_tracks else None
+
+    # Get the tracks added to the specified playlist after min_timestamp by reading it from the end.
+    # Returns None if the playlist is not ordered by date added, in which case it has to be scanned entirely.
+    def _get_new_playlist_tracks(
+        self,
+        playlist_owner_id: str,
+        playlist_id: str,
+        min_timestamp: datetime,
+        num_tracks: int,
+        previous_num_tracks: int,
+        page_size: int = 100,
+    ):
+        import numpy as np
+        from page_parser import added_at_array, new_item_mask
+
+        # Pages from the last one backwards
+        new_pages = []
+        num_new_items = 0
+        later_timestamp = None
+        min_time = np.datetime64(min_timestamp, "s")
+
+        offset = num_tracks
+        while offset > 0:
+            offset = max(0, offset - page_size)
+            tracks = self.sp.user_playlist_tracks(
+                playlist_owner_id, playlist_id, limit=page_size, offset=offset
+            )
+            self.metrics.count_page(playlist_id)
+            items = tracks["items"]
+            if not items:
+                continue
+
+            added_at = added_at_array(items)
+            # Some very old playlists do not have a date for their tracks, so we can't rely on the order.
+            if np.isnat(added_at).any():
+                return None
+            # If a track was added later than the one after it, the playlist has been reordered.
+            if np.any(added_at[1:] < added_at[:-1]) or (
+                later_timestamp is not None and added_at[-1] > later_timestamp
+            ):
+                return None
+            later_timestamp = added_at[0]
+
+            is_new = added_at > min_time
+            num_new_items += int(np.count_nonzero(is_new))
+            mask = new_item_mask(items, added_at, min_timestamp)
+            new_pages.append(
+                [Track(items[position], playlist_id) for position in np.flatnonzero(mask)]
+            )
+
+            if not is_new.all():
                 break
 
-        if return_snapshot:
-            return return_tracks, data["snapshot_id"]
+        # If the playlist grew by more tracks than we found at the end, some must have been inserted elsewhere.
+        if num_tracks - previous_num_tracks > num_new_items:
+            return None
 
-        return return_tracks
+        return [track for page in reversed(new_pages) for track in page]
+
+    # Obtain only the snapshot ID and number of tracks of a playlist.
+    # This tells us whether it has changed without downloading any tracks.
+    def _get_playlist_snapshot(self, playlist_owner_id: str, playlist_id: str):
+        data = self.sp.user_playlist(
+            playlist_owner_id, playlist_id, fields="snapshot_id,tracks.total"
+        )
+        return data["snapshot_id"], data["tracks"]["total"]
 
-    # Get all tracks from the users library and own playlists (including sub feed).
-    def _get_all_user_tracks(self):
-        tracks = {}
+    # The index of the tracks the user saved or has in their own playlists. It needs numpy, so it is only
+    # loaded when it is used.
+    @property
+    def library_index(self):
+        if self._library_index is None:
+            from library_index import LibraryIndex
 
-        self._get_user_library_tracks()
+            self._library_index = LibraryIndex(self.storage_dir)
+        return self._library_index
 
-        for playlist_id, playlist in self.user_playlists.items():
-            tracks = self._get_playlist_tracks(playlist["owner"]["id"], playlist_id)
-            for track in tracks:
-                tracks[track.id] = track
-
-    def _get_user_library_tracks(self):
-        tracks = {}
-
-        data = self.sp.current_user_saved_tracks()
-
-        while data:
-            for track in data["items"]:
-                print(track["track"].keys())
-            exit(0)
-            exit(0)
-            # for playlist in playlists_data['items']:
-            #     # If we own a playlist but it's collaborative, we treat it as a followed one since we might be interested in updates.
-            #     if playlist['owner']['id'] != self.user_id or playlist['collaborative']:
-            #         self.followed_playlists[playlist['id']] = playlist
-            #     else:
-            #         self.user_playlists[playlist['id']] = playlist
-
-            # # If there were more playlists than we just received, query the next batch
-            # if playlists_data['next']:
-            #     playlists_data = self.sp.next(playlists_data)
-            # else:
-            #     break
-
-    # Store the track ids we just added to the feed in the log file.
-    def _log_feed_updates(self, track_ids: np.ndarray):
+    # Bring the index of the tracks in the library and own playlists up to date, see LibraryIndex.
+    def refresh_library_index(self, max_workers: int = 8, executor: ThreadPoolExecutor = None):
         """
-        Log is dict with the following info:
-            track_ids: numpy array of track ids that were added to the feed
-            timestamps: timestamp at which each of the tracks was added to the feed
+        Pages are requested concurrently, using up to max_workers threads or the given executor.
         """
-        if os.path.exists(self._feed_log_path):
-            feed_log = pickle.load(open(self._feed_log_path, "rb"))
+        if executor is None:
+            pool = ThreadPoolExecutor(max_workers=max(1, max_workers))
         else:
-            feed_log = {"track_ids": [], "timestamps": []}
+            pool = nullcontext(executor)
+        with pool as executor, self.metrics.phase("library"):
+            self._refresh_saved_tracks(executor)
+            self._refresh_own_playlists(executor)
+        self.library_index.save()
+
+    # Add the tracks saved since the watermark of the index. If the number of saved tracks shows that some
+    # were removed, or the index is empty, all pages of the library are requested instead.
+    def _refresh_saved_tracks(self, executor: ThreadPoolExecutor, page_size: int = 50):
+        from spotipy.client import SpotifyException
+
+        index = self.library_index
+
+        def parse(page):
+            track_ids = []
+            newest = 0
+            for item in page["items"]:
+                if item["track"] is None or item["track"]["id"] is None:
+                    continue
+                track_ids.append(item["track"]["id"])
+                newest = max(newest, to_timestamp(datetime.strptime(item["added_at"], "%Y-%m-%dT%H:%M:%SZ")))
+            return track_ids, newest
+
+        try:
+            first_page = self.sp.current_user_saved_tracks(limit=page_size)
+        except SpotifyException as error:
+            # Tokens that were requested before the library was used may not have permission to read it
+            if error.http_status not in (401, 403):
+                raise
+            safe_print("WARNING: no permission to read the saved tracks, they are not skipped.")
+            return
 
-        # Create, append and overwrite timestamps
-        new_timestamps = np.repeat(datetime.utcnow(), track_ids.size)
-        timestamp_array = np.append(feed_log["timestamps"], new_timestamps)
-        feed_log["timestamps"] = timestamp_array
+        if index.saved_watermark > 0:
+            new_ids = []
+            newest = index.saved_watermark
+            page = first_page
+            reached_known = False
+            while page and not reached_known:
+                for item in page["items"]:
+                    added_at = to_timestamp(datetime.strptime(item["added_at"], "%Y-%m-%dT%H:%M:%SZ"))
+                    if added_at <= index.saved_watermark:
+                        reached_known = True
+                        break
+                    newest = max(newest, added_at)
+                    if item["track"] is not None and item["track"]["id"] is not None:
+                        new_ids.append(item["track"]["id"])
+                page = self.sp.next(page) if not reached_known and page["next"] else None
+
+            if index.num_saved_with(new_ids) == first_page["total"]:
+                index.add_saved(new_ids, newest)
+                return
+
+        offsets = range(page_size, first_page["total"], page_size)
+        pages = [first_page] + list(
+            executor.map(
+                lambda offset: self.sp.current_user_saved_tracks(limit=page_size, offset=offset), offsets
+            )
+        )
+        parsed = [parse(page) for page in pages]
+        index.replace_saved(
+            [track_id for track_ids, _ in parsed for track_id in track_ids],
+            max([newest for _, newest in parsed], default=0),
+        )
 
-        # Append and overwrite track_ids
-        track_id_array = np.append(feed_log["track_ids"], track_ids)
-        feed_log["track_ids"] = track_id_array
+    # Read the own playlists of which the snapshot changed since they were indexed. If the playlists of the user
+    # were not loaded, the own playlists that are already in the index are checked.
+    def _refresh_own_playlists(self, executor: ThreadPoolExecutor):
+        from spotipy.client import SpotifyException
+
+        index = self.library_index
+        # The feeds only hold tracks we added, which should not be skipped
+        feed_ids = self.feed_router.playlist_ids()
+        playlist_ids = [
+            playlist_id
+            for playlist_id in self._storage.own_playlist_ids(self)
+            if playlist_id not in feed_ids
+        ]
+        for playlist_id in set(index.playlist_ids) - set(playlist_ids):
+            index.remove_playlist(playlist_id)
+
+        def probe(playlist_id):
+            try:
+                return self._get_playlist_snapshot(self.user_id, playlist_id)
+            except SpotifyException as error:
+                # The playlist was deleted
+                if error.http_status != 404:
+                    raise
+                return None, None
+
+        changed = []
+        for playlist_id, (snapshot, _) in zip(playlist_ids, executor.map(probe, playlist_ids)):
+            if snapshot is None:
+                index.remove_playlist(playlist_id)
+            elif snapshot != index.snapshot(playlist_id):
+                changed.append((playlist_id, snapshot))
+
+        def fetch(item):
+            playlist_id, _ = item
+            return [track.id for track in self._iter_playlist_tracks(self.user_id, playlist_id)]
+
+        for (playlist_id, snapshot), track_ids in zip(changed, executor.map(fetch, changed)):
+            index.set_playlist(playlist_id, snapshot, track_ids)
+
+    # Store the track ids we just added to the feed playlist with the given ID in the log file.
+    def _log_feed_updates(self, track_ids: "np.ndarray", feed_id: str = None):
+        """
+        See FeedLog for the format of the log. Only the new entries are appended to the log files.
+        """
+        self.feed_log.append(track_ids, datetime.utcnow(), feed_id)
+        self._journal.commit(track_ids)
 
-        pickle.dump(feed_log, open(self._feed_log_path, "wb"))
+    # If the previous update was interrupted while adding tracks to the feed, log the ones that reached the feed,
+    # so they are not added again. The others are found again, since the state of that update was not saved.
+    def _recover_feed_journal(self):
+        if not self._journal.exists():
+            return
+        unfinished, done = self._journal.read()
+
+        # Tracks that are done were logged, unless the run was interrupted while logging them
+        recovered = self.feed_log.filter_new(sorted(done)).tolist() if done else []
+        num_recovered = len(recovered)
+        if recovered:
+            self.feed_log.append(recovered)
+        for feed_id, began_at, track_ids in unfinished:
+            # We do not know how many of the tracks were added
+            self.feed_router.invalidate(feed_id)
+            # Allow for a difference between our clock and the one of the API
+            feed_ids = {
+                track.id for track in self._get_feed_tracks(feed_id, began_at - timedelta(minutes=5))
+            }
+            recovered = [track_id for track_id in track_ids if track_id in feed_ids]
+            if recovered:
+                self.feed_log.append(recovered, feed_id=feed_id)
+            num_recovered += len(recovered)
+
+        safe_print(
+            "The previous update was interrupted, found {} of its tracks in the feed.".format(num_recovered)
+        )
+        self._journal.clear()
+
+    # Create a new, empty playlist for a feed
+    def _create_feed_playlist(self, name: str) -> FeedPlaylist:
+        feed = SubscriptionFeed(self.sp, self.user_id, name=name)
+        return FeedPlaylist(feed.id, feed.name, 0)
+
+    # Get the tracks added to the feed playlist after min_timestamp
+    def _get_feed_tracks(self, feed_id: str, min_timestamp: datetime) -> list:
+        _, num_tracks = self._get_playlist_snapshot(self.user_id, feed_id)
+        tracks = self._get_new_playlist_tracks(
+            self.user_id, feed_id, min_timestamp, num_tracks, num_tracks
+        )
+        if tracks is None:
+            tracks = list(self._iter_playlist_tracks(self.user_id, feed_id, min_timestamp=min_timestamp))
+        return tracks
+
+    # Remove tracks from the feeds according to the retention policy, and drop them from the feed log.
+    def prune_feed(self, policy: "RetentionPolicy", dry_run: bool = False, max_workers: int = 4) -> int:
+        """
+        See RetentionPolicy for the rules. Removals are sent in batches of 100 tracks per feed playlist, up to
+        max_workers batches at a time. Removed tracks stay in the index of the feed log, so they are never added again.
+        If dry_run is True, only the tracks that would be removed are reported. Returns the number of tracks that
+        were (or would be) removed.
+        """
+        with self._locked():
+            self._reload_if_changed()
+            return self._prune_feed(policy, dry_run, max_workers)
+
+    # Prune the feed while holding the lock, see prune_feed
+    def _prune_feed(self, policy: "RetentionPolicy", dry_run: bool, max_workers: int) -> int:
+        import numpy as np
+        from feed_writer import FeedWriter
+
+        track_ids, timestamps = self.feed_log.read()
+        # Entries of older versions were all added to the subscription feed
+        feed_ids = self.feed_log.read_feeds()
+        feed_ids[feed_ids == ""] = self.subscription_feed.id
+
+        # Playlists that are no longer part of a feed count as a feed of their own
+        names_by_id = {
+            playlist.id: (feed_name, playlist.name)
+            for feed_name, chain in self.feed_router.feeds.items()
+            for playlist in chain
+        }
+        unique_feed_ids, feed_positions = np.unique(feed_ids, return_inverse=True)
+        feed_names = np.array(
+            [names_by_id.get(feed_id, (feed_id, feed_id))[0] for feed_id in unique_feed_ids.tolist()], dtype=str
+        )[feed_positions.reshape(-1)]
+
+        saved = None
+        if policy.remove_saved:
+            self.refresh_library_index(max_workers)
+            saved = self.library_index.contains_saved(track_ids)
+        remove = policy.select(timestamps, feed_names, saved)
+
+        removed = np.zeros(len(track_ids), dtype=bool)
+        for feed_id in np.unique(feed_ids[remove]).tolist():
+            in_feed = remove & (feed_ids == feed_id)
+            playlist_name = names_by_id.get(feed_id, (feed_id, feed_id))[1]
+            if dry_run:
+                safe_print(
+                    "Would remove {} tracks from {}, added between {} and {}.".format(
+                        int(in_feed.sum()), playlist_name, timestamps[in_feed].min(), timestamps[in_feed].max()
+                    )
+                )
+                continue
+
+            writer = FeedWriter(self.sp, self.user_id, feed_id, max_in_flight=max_workers)
+            with self.metrics.phase("feed_prune"):
+                removed_ids = writer.remove(np.unique(track_ids[in_feed]))
+            removed |= in_feed & np.isin(track_ids, removed_ids)
+            # Our count of the tracks in the playlist is requested again before adding to it
+            self.feed_router.invalidate(feed_id)
+            safe_print("Removed {} tracks from {}.".format(len(removed_ids), playlist_name))
+
+        if dry_run:
+            return int(remove.sum())
+        # If we are interrupted before compacting, the tracks are removed again next time, which changes nothing
+        if removed.any():
+            self.feed_log.compact(~removed)
+            self._save()
+        return int(removed.sum())
 
     # Print the tracks and timestamps saved in the feed log.
-    def print_feed_log(self):
-        if not os.path.exists(self._feed_log_path):
+    def print_feed_log(self, max_workers: int = 4):
+        """
+        Track names are read from the track cache in the storage dir, and only tracks that are not in it are requested.
+        Those are requested concurrently in batches of 50, and every entry is printed as soon as its track is known.
+        """
+        import numpy as np
+        from track_cache import TrackCache
+
+        num_tracks = len(self.feed_log)
+        if num_tracks == 0:
             print("No feed log exists yet!")
             return
 
-        feed_log = pickle.load(open(self._feed_log_path, "rb"))
-        num_tracks = len(feed_log["track_ids"])
+        log_track_ids, log_timestamps = self.feed_log.read()
         print("Found {} tracks in log.".format(num_tracks))
 
+        track_cache = TrackCache(self.storage_dir)
+        known_tracks = track_cache.get_many(log_track_ids.tolist())
+
+        # Uncached IDs in order of their first appearance, so batches arrive in the order they are printed
+        unique_ids, first_index = np.unique(log_track_ids, return_index=True)
+        missing_ids = [
+            track_id
+            for track_id in unique_ids[np.argsort(first_index)].tolist()
+            if track_id not in known_tracks
+        ]
         batch_size = 50
-        tracks = []
-        start_idx = 0
-        print("Requesting track info...")
-        for start_idx in tqdm(range(0, num_tracks, batch_size)):
-            end_idx = start_idx + batch_size
-            track_ids = feed_log["track_ids"][start_idx:end_idx]
-            tracks += self.sp.tracks(track_ids)["tracks"]
-            start_idx = end_idx
-
-        for track, timestamp in zip(tracks, feed_log["timestamps"]):
-            safe_print(
-                "{} - {} - {} - {}".format(
-                    track["artists"][0]["name"], track["name"], timestamp, track["id"]
-                )
+        batches = [
+            missing_ids[start : start + batch_size]
+            for start in range(0, len(missing_ids), batch_size)
+        ]
+        print(
+            "{} tracks cached, requesting info for {} tracks...".format(
+                len(unique_ids) - len(missing_ids), len(missing_ids)
+            )
+        )
+
+        requested = set()
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            results = zip(
+                batches,
+                executor.map(lambda batch: self.sp.tracks(batch)["tracks"], batches),
             )
+            for track_id, timestamp in zip(log_track_ids.tolist(), log_timestamps):
+                # Wait for the batch containing this track to arrive
+                while track_id not in known_tracks and track_id not in requested:
+                    batch, tracks = next(results)
+                    requested.update(batch)
+                    track_cache.put_many(tracks)
+                    for track in tracks:
+                        if track is not None:
+                            known_tracks[track["id"]] = (
+                                track["name"],
+                                track["artists"][0]["name"] if track["artists"] else "",
+                            )
+
+                # Tracks that no longer exist are not returned by the API
+                name, artist_name = known_tracks.get(track_id, ("Unknown track", "Unknown artist"))
+                safe_print("{} - {} - {} - {}".format(artist_name, name, timestamp, track_id))
+
+        track_cache.close()
 
     # Follow a user
     def _follow_user(self, username: str):
@@ -0,0 +1,597 @@
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import platform
+import random
+import string
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from classes import PlaylistRecord, SeenTrackIndex, SubscribedPlaylist, Track
+from fake_spotify import FakeSpotify, synthetic_id
+from feed_log import FeedLog
+from page_parser import parse_new_tracks
+from poll_scheduler import PollScheduler
+from SpotifySubscriber import SpotifySubscriber
+from storage import get_storage
+
+
+# Generate a random 22 character base62 ID, like the ones Spotify uses
+def random_id(rng: random.Random) -> str:
+    return "".join(rng.choices(string.ascii_letters + string.digits, k=22))
+
+
+# Generate a playlist track item with roughly the same structure and size as the ones returned by the API
+def synthetic_playlist_item(
+    rng: random.Random, added_at: datetime, added_by: str = "owner"
+) -> dict:
+    track_id = random_id(rng)
+    artists = [
+        {
+            "external_urls": {"spotify": "https://open.spotify.com/artist/" + artist_id},
+            "href": "https://api.spotify.com/v1/artists/" + artist_id,
+            "id": artist_id,
+            "name": "Artist " + artist_id[:6],
+            "type": "artist",
+            "uri": "spotify:artist:" + artist_id,
+        }
+        for artist_id in [random_id(rng) for _ in range(rng.randint(1, 3))]
+    ]
+    album_id = random_id(rng)
+    album = {
+        "album_type": "album",
+        "artists": artists[:1],
+        "available_markets": ["AD", "AE", "AR", "AT", "AU", "BE", "BG", "BO", "BR", "CA"]
+        * 8,
+        "external_urls": {"spotify": "https://open.spotify.com/album/" + album_id},
+        "href": "https://api.spotify.com/v1/albums/" + album_id,
+        "id": album_id,
+        "images": [
+            {"height": size, "url": "https://i.scdn.co/image/" + random_id(rng), "width": size}
+            for size in (640, 300, 64)
+        ],
+        "name": "Album " + album_id[:6],
+        "release_date": "2019-01-01",
+        "type": "album",
+        "uri": "spotify:album:" + album_id,
+    }
+    return {
+        "added_at": added_at.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "added_by": {"id": added_by, "type": "user", "uri": "spotify:user:" + added_by},
+        "is_local": False,
+        "track": {
+            "album": album,
+            "artists": artists,
+            "duration_ms": rng.randint(120000, 400000),
+            "explicit": False,
+            "external_ids": {"isrc": "USRC1" + track_id[:7].upper()},
+            "href": "https://api.spotify.com/v1/tracks/" + track_id,
+            "id": track_id,
+            "name": "Track " + track_id[:6],
+            "popularity": rng.randint(0, 100),
+            "track_number": rng.randint(1, 15),
+            "type": "track",
+            "uri": "spotify:track:" + track_id,
+        },
+    }
+
+
+# Generate the items of a playlist one page at a time, like the API returns them
+def synthetic_playlist_pages(num_tracks: int, page_size: int = 100, seed: int = 0):
+    rng = random.Random(seed)
+    start = datetime(2019, 1, 1)
+    for offset in range(0, num_tracks, page_size):
+        yield [
+            synthetic_playlist_item(rng, start + timedelta(minutes=index))
+            for index in range(offset, min(offset + page_size, num_tracks))
+        ]
+
+
+class LegacyTrack:
+    """
+    The Track representation of older versions, which kept the album and artist dicts of every track.
+    Only used as a reference in the memory benchmark.
+    """
+
+    def __init__(self, track: dict, playlist_id="-1"):
+        self.name = track["track"]["name"]
+        self.id = track["track"]["id"]
+        self.album = track["track"]["album"]
+        self.artist_dicts = track["track"]["artists"]
+        self.main_artist_name = self.artist_dicts[0]["name"]
+        self.playlist_id = playlist_id
+        self.added_by = track["added_by"]["id"]
+
+
+# Return the memory (in bytes) that is still allocated after calling function, and the peak memory during the call.
+def measure_memory(function):
+    gc.collect()
+    tracemalloc.start()
+    result = function()
+    gc.collect()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return retained, peak
+
+
+# Compare the memory used by the tracks and subscription of a playlist with the current and legacy representations.
+def benchmark_track_memory(num_tracks: int = 50000):
+    def legacy_tracks():
+        return [
+            LegacyTrack(item, "playlist")
+            for page in synthetic_playlist_pages(num_tracks)
+            for item in page
+        ]
+
+    def slim_tracks():
+        return [
+            Track(item, "playlist")
+            for page in synthetic_playlist_pages(num_tracks)
+            for item in page
+        ]
+
+    track_ids = [
+        item["track"]["id"] for page in synthetic_playlist_pages(num_tracks) for item in page
+    ]
+    playlist = PlaylistRecord("playlist", "Benchmark", "owner", "snapshot", num_tracks=num_tracks)
+
+    # Copy the IDs, so that their strings are counted like they would be after loading them from storage
+    def legacy_subscription():
+        # Older versions stored a dict of track ID to subscribe time in every subscription
+        stamp = datetime.utcnow()
+        return {track_id[:11] + track_id[11:]: stamp for track_id in track_ids}
+
+    def slim_subscription():
+        index = SeenTrackIndex()
+        subscription = SubscribedPlaylist(playlist, [], index)
+        for track_id in track_ids:
+            subscription.add_track(track_id[:11] + track_id[11:])
+        index.mark_saved()
+        return index, subscription
+
+    results = {}
+    for name, function in [
+        ("legacy_tracks", legacy_tracks),
+        ("slim_tracks", slim_tracks),
+        ("legacy_subscription", legacy_subscription),
+        ("slim_subscription", slim_subscription),
+    ]:
+        retained, peak = measure_memory(function)
+        results[name] = {"retained_bytes": retained, "peak_bytes": peak}
+
+    return results
+
+
+# Parse pages like older versions did: every item is parsed with strptime and converted into a Track.
+def legacy_parse_new_tracks(items: list, playlist_id: str, min_timestamp: datetime) -> list:
+    tracks = []
+    for item in items:
+        if item["track"] is None or item["track"]["id"] is None:
+            continue
+        track = Track(item, playlist_id)
+        if datetime.strptime(item["added_at"], "%Y-%m-%dT%H:%M:%SZ") > min_timestamp:
+            tracks.append(track)
+    return tracks
+
+
+# Compare the time per track of parsing the pages of a playlist item by item and in batches, when a fraction
+# new_fraction of the tracks was added after the last update.
+def benchmark_page_parsing(num_tracks: int = 100000, new_fraction: float = 0.01, repeat: int = 3) -> dict:
+    pages = list(synthetic_playlist_pages(num_tracks))
+    # The synthetic tracks were added one minute apart
+    min_timestamp = datetime(2019, 1, 1) + timedelta(minutes=int(num_tracks * (1 - new_fraction)))
+
+    results = {}
+    for name, parse in [("per_item", legacy_parse_new_tracks), ("batched", parse_new_tracks)]:
+        seconds = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            found = [track for page in pages for track in parse(page, "playlist", min_timestamp)]
+            seconds.append(time.perf_counter() - start)
+        results[name] = {
+            "seconds": min(seconds),
+            "us_per_track": min(seconds) / num_tracks * 1e6,
+            "new_tracks": len(found),
+        }
+    results["speedup"] = results["per_item"]["seconds"] / results["batched"]["seconds"]
+    return results
+
+
+# Scenarios of the benchmark suite. Before the update, a churn fraction of the subscribed playlists gets
+# new_tracks new tracks. Scenarios can override the latency and rate limit of the fake API.
+scenarios = {
+    "small": {"subscriptions": 10, "tracks": 100, "churn": 0.2, "new_tracks": 5},
+    "many_subscriptions": {"subscriptions": 1000, "tracks": 100, "churn": 0.05, "new_tracks": 5},
+    "medium_playlists": {"subscriptions": 100, "tracks": 1000, "churn": 0.5, "new_tracks": 20},
+    "large_playlists": {"subscriptions": 10, "tracks": 100000, "churn": 0.5, "new_tracks": 20},
+    "high_churn": {"subscriptions": 100, "tracks": 1000, "churn": 1.0, "new_tracks": 150},
+    "rate_limited": {
+        "subscriptions": 100,
+        "tracks": 100,
+        "churn": 0.5,
+        "new_tracks": 50,
+        "latency": 0.002,
+        "rate_limit": 100,
+        "retry_after": 0.05,
+    },
+}
+
+feed_log_sizes = [10000, 100000, 1000000]
+
+# Run by benchmark_startup in a fresh interpreter, so the imports are measured as well. The fake API is created
+# first, since a real client does not need to build its playlists.
+_startup_script = """
+import json, sys, time
+from datetime import timedelta
+from fake_spotify import FakeSpotify
+
+params = json.loads(sys.argv[1])
+spotify = FakeSpotify(num_playlists=params["playlists"], tracks_per_playlist=params["tracks"])
+start = time.perf_counter()
+from SpotifySubscriber import SpotifySubscriber
+from poll_scheduler import PollScheduler
+imported = time.perf_counter()
+subscriber = SpotifySubscriber(
+    storage_dir=params["storage_dir"], spotify=spotify, load_playlists=params["load_playlists"]
+)
+loaded = time.perf_counter()
+heavy_modules = [name for name in ["numpy", "spotipy", "requests"] if name in sys.modules]
+# The previous run checked every subscription just now, so check them regardless of the schedule
+subscriber.update_feed(max_workers=params["workers"], scheduler=PollScheduler(max_interval=timedelta(0)))
+updated = time.perf_counter()
+print(json.dumps({
+    "import_seconds": imported - start,
+    "load_seconds": loaded - imported,
+    "first_request_seconds": spotify.first_request_time - start,
+    "update_seconds": updated - loaded,
+    "modules_before_update": heavy_modules,
+}))
+"""
+
+
+class PhaseTimer:
+    """
+    Measures the runtime, number of requests to the fake API and peak memory of the phases of a benchmark.
+    Output of the measured functions is suppressed.
+
+    Attributes:
+    results (dict): measurements by phase name
+    """
+
+    def __init__(self, spotify: FakeSpotify = None, trace_memory: bool = True):
+        self.spotify = spotify
+        self.trace_memory = trace_memory
+        self.results = {}
+
+    def measure(self, name: str, function):
+        if self.spotify is not None:
+            self.spotify.reset_counters()
+        gc.collect()
+        if self.trace_memory:
+            tracemalloc.start()
+
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = function()
+        seconds = time.perf_counter() - start
+
+        measurement = {"seconds": seconds}
+        if self.trace_memory:
+            measurement["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        if self.spotify is not None:
+            measurement["requests"] = self.spotify.num_requests
+            measurement["requests_by_method"] = dict(self.spotify.calls)
+            measurement["rate_limited"] = self.spotify.rate_limited
+
+        self.results[name] = measurement
+        return result
+
+
+# Subscribe to the playlists of a fake API, update the feed after some churn, and save and load the state.
+def benchmark_scenario(
+    subscriptions: int,
+    tracks: int,
+    churn: float,
+    new_tracks: int,
+    latency: float = 0.0,
+    rate_limit: float = None,
+    retry_after: float = 1.0,
+    workers: int = 8,
+    trace_memory: bool = True,
+) -> dict:
+    spotify = FakeSpotify(
+        num_playlists=subscriptions,
+        tracks_per_playlist=tracks,
+        latency=latency,
+        rate_limit=rate_limit,
+        retry_after=retry_after,
+    )
+    timer = PhaseTimer(spotify, trace_memory)
+
+    with tempfile.TemporaryDirectory() as storage_dir:
+        subscriber = timer.measure(
+            "setup",
+            lambda: SpotifySubscriber(spotify.user_id, storage_dir=storage_dir, spotify=spotify),
+        )
+        timer.measure(
+            "subscribe",
+            lambda: subscriber.subscribe_to_playlists(contains=["benchmark"], max_workers=workers),
+        )
+
+        playlist = next(iter(subscriber.subscribed_playlists.values()))
+        timer.measure(
+            "get_playlist_tracks",
+            lambda: subscriber._get_playlist_tracks(playlist.owner_id, playlist.id),
+        )
+
+        spotify.churn(churn, new_tracks)
+        num_added = timer.measure("update_feed", lambda: subscriber.update_feed(max_workers=workers))
+        # Nothing changed since the last update, so this should only check the snapshots of the due playlists
+        timer.measure("update_feed_unchanged", lambda: subscriber.update_feed(max_workers=workers))
+
+        with tempfile.TemporaryDirectory() as save_dir:
+            timer.measure("save", lambda: get_storage("sqlite", save_dir).save(subscriber))
+        timer.measure("load", lambda: SpotifySubscriber(storage_dir=storage_dir, spotify=spotify))
+
+    results = timer.results
+    results["update_feed"]["added_tracks"] = num_added
+    return results
+
+
+# Measure the latency from starting to import SpotifySubscriber to the first request of an update, in a new process,
+# for a user who follows many playlists but is only subscribed to some of them. The update finds no changes.
+def benchmark_startup(
+    playlists: int = 5000, subscriptions: int = 50, tracks: int = 100, workers: int = 8
+) -> dict:
+    spotify = FakeSpotify(num_playlists=playlists, tracks_per_playlist=tracks)
+    results = {}
+    with tempfile.TemporaryDirectory() as storage_dir:
+        with contextlib.redirect_stdout(io.StringIO()):
+            subscriber = SpotifySubscriber(spotify.user_id, storage_dir=storage_dir, spotify=spotify)
+            subscriber.subscribe_to_playlists(
+                playlist_ids=list(subscriber.followed_playlists)[:subscriptions], max_workers=workers
+            )
+
+        for name, load_playlists in [("full_load", True), ("slim_load", False)]:
+            params = {
+                "playlists": playlists,
+                "tracks": tracks,
+                "storage_dir": storage_dir,
+                "load_playlists": load_playlists,
+                "workers": workers,
+            }
+            start = time.perf_counter()
+            output = subprocess.run(
+                [sys.executable, "-c", _startup_script, json.dumps(params)],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout
+            results[name] = json.loads(output.strip().splitlines()[-1])
+            results[name]["process_seconds"] = time.perf_counter() - start
+
+    return results
+
+
+# Generate random 22 character base62 IDs as fixed-width byte strings
+def random_ids(rng: np.random.Generator, num_ids: int) -> np.ndarray:
+    alphabet = np.frombuffer((string.ascii_letters + string.digits).encode("ascii"), dtype="S1")
+    characters = alphabet[rng.integers(0, len(alphabet), size=(num_ids, 22))]
+    return characters.view("S22").ravel()
+
+
+# Measure the feed log operations of an update on a log that already holds num_entries entries.
+def benchmark_feed_log(num_entries: int, trace_memory: bool = True) -> dict:
+    rng = np.random.default_rng(0)
+    timer = PhaseTimer(trace_memory=trace_memory)
+
+    with tempfile.TemporaryDirectory() as storage_dir:
+        feed_log = FeedLog(storage_dir)
+        logged_ids = random_ids(rng, num_entries)
+        for start in range(0, num_entries, 100000):
+            feed_log.append(logged_ids[start : start + 100000])
+
+        # Half of the candidates are in the log already
+        candidates = np.concatenate([logged_ids[:5000], random_ids(rng, 5000)]).astype(str)
+        timer.measure("filter_new", lambda: feed_log.filter_new(candidates))
+        timer.measure("append", lambda: feed_log.append(random_ids(rng, 100)))
+        timer.measure("read", lambda: feed_log.read())
+
+    return timer.results
+
+
+# Simulate daily updates of the feed, and count the requests of checking every subscription on every update and of
+# only checking the due ones. Every day, a fraction of the playlists gets new tracks, another fraction only changes
+# its snapshot (like 'Brain Food') and a third gets new tracks once a week. The others never change.
+def benchmark_polling(
+    subscriptions: int = 500,
+    days: int = 28,
+    active: float = 0.05,
+    reordered: float = 0.02,
+    weekly: float = 0.05,
+    workers: int = 8,
+) -> dict:
+    results = {}
+    for name, scheduler in [
+        ("check_all", PollScheduler(max_interval=timedelta(0))),
+        ("adaptive", PollScheduler()),
+    ]:
+        spotify = FakeSpotify(num_playlists=subscriptions, tracks_per_playlist=50)
+        playlists = list(spotify.playlists.values())
+        num_active = int(active * subscriptions)
+        num_reordered = int(reordered * subscriptions)
+        num_weekly = int(weekly * subscriptions)
+        next_track = 1 << 40
+
+        with tempfile.TemporaryDirectory() as storage_dir:
+            with contextlib.redirect_stdout(io.StringIO()):
+                subscriber = SpotifySubscriber(spotify.user_id, storage_dir=storage_dir, spotify=spotify)
+                subscriber.subscribe_to_playlists(contains=["benchmark"], max_workers=workers)
+
+                spotify.reset_counters()
+                added = 0
+                start = time.perf_counter()
+                for day in range(days):
+                    # Let a day pass
+                    for subscription in subscriber.subscribed_playlists.values():
+                        if subscription.last_checked is not None:
+                            subscription.last_checked -= timedelta(days=1)
+
+                    changed = playlists[:num_active]
+                    if day % 7 == 6:
+                        changed += playlists[num_active + num_reordered : num_active + num_reordered + num_weekly]
+                    for playlist in changed:
+                        playlist.add([synthetic_id(next_track + number) for number in range(3)], playlist.owner_id)
+                        next_track += 3
+                    for playlist in playlists[num_active : num_active + num_reordered]:
+                        playlist.snapshot += 1
+
+                    added += subscriber.update_feed(max_workers=workers, scheduler=scheduler)
+                seconds = time.perf_counter() - start
+
+        results[name] = {
+            "requests": spotify.num_requests,
+            "requests_per_update": spotify.num_requests / days,
+            "added_tracks": added,
+            "seconds": seconds,
+        }
+    return results
+
+
+# Current commit of the repository, if it can be determined
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(
+    scenario_names: list,
+    log_sizes: list,
+    workers: int = 8,
+    trace_memory: bool = True,
+    startup: bool = True,
+) -> dict:
+    results = {
+        "timestamp": datetime.utcnow().isoformat(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "trace_memory": trace_memory,
+        "scenarios": {},
+        "feed_log": {},
+        "startup": {},
+        "page_parsing": {},
+        "polling": {},
+    }
+
+    for name in scenario_names:
+        print("Running scenario {}...".format(name))
+        params = scenarios[name]
+        results["scenarios"][name] = {
+            "params": params,
+            "phases": benchmark_scenario(**params, workers=workers, trace_memory=trace_memory),
+        }
+
+    for num_entries in log_sizes:
+        print("Running feed log with {} entries...".format(num_entries))
+        results["feed_log"][str(num_entries)] = benchmark_feed_log(num_entries, trace_memory)
+
+    print("Running page parsing...")
+    results["page_parsing"] = benchmark_page_parsing()
+
+    print("Running polling...")
+    results["polling"] = benchmark_polling(workers=workers)
+
+    if startup:
+        print("Running startup...")
+        results["startup"] = benchmark_startup(workers=workers)
+
+    return results
+
+
+def main(args):
+    if args.command == "suite":
+        results = run_suite(
+            args.scenarios,
+            args.log_sizes,
+            workers=args.workers,
+            trace_memory=not args.no_memory,
+            startup=not args.no_startup,
+        )
+        if args.output:
+            # Every run is appended as one line, so results can be compared over time.
+            with open(args.output, "a") as output_file:
+                output_file.write(json.dumps(results) + "\n")
+            print("Appended results to {}.".format(args.output))
+        else:
+            print(json.dumps(results, indent=2))
+        return
+
+    if args.command == "parsing":
+        print("Parsing a playlist of {} tracks, of which 1% are new:".format(args.num_tracks))
+        results = benchmark_page_parsing(args.num_tracks)
+        for name in ["per_item", "batched"]:
+            print("{:>10}: {:6.2f} us per track".format(name, results[name]["us_per_track"]))
+        print("{:>10}: {:6.1f}x".format("speedup", results["speedup"]))
+        return
+
+    if args.command == "polling":
+        print("Requests of 28 daily updates of 500 subscriptions, of which 5% change every day:")
+        for name, result in benchmark_polling(workers=args.workers).items():
+            print(
+                "{:>10}: {:6d} requests ({:6.1f} per update), {} tracks added".format(
+                    name, result["requests"], result["requests_per_update"], result["added_tracks"]
+                )
+            )
+        return
+
+    print("Memory for a playlist of {} tracks:".format(args.num_tracks))
+    for name, result in benchmark_track_memory(args.num_tracks).items():
+        print(
+            "{:>20}: {:8.1f} MB retained, {:8.1f} MB peak".format(
+                name, result["retained_bytes"] / 2 ** 20, result["peak_bytes"] / 2 ** 20
+            )
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark SpotifySubscriber on synthetic data.")
+    parser.add_argument("command", nargs="?", default="memory", choices=["memory", "suite", "parsing", "polling"],
+                        help="'memory' compares the memory of track representations, 'suite' runs the scenarios against a fake API, "
+                        "'parsing' compares parsing pages of tracks item by item and in batches, "
+                        "'polling' compares checking every subscription on every update with checking only the due ones.")
+    parser.add_argument("--num_tracks", type=int, default=50000, help="Number of tracks in the synthetic playlist.")
+    parser.add_argument("--scenarios", nargs="*", default=list(scenarios), choices=list(scenarios),
+                        help="Scenarios of the suite to run, all by default.")
+    parser.add_argument("--log_sizes", nargs="*", type=int, default=feed_log_sizes,
+                        help="Sizes of the feed logs to benchmark in the suite.")
+    parser.add_argument("--workers", type=int, default=8, help="Number of playlists to fetch concurrently.")
+    parser.add_argument("--no_memory", action="store_true",
+                        help="Do not trace memory, which makes the runtimes more accurate.")
+    parser.add_argument("--no_startup", action="store_true",
+                        help="Do not measure the startup latency of an update in a new process.")
+    parser.add_argument("--output", type=str, default=None,
+                        help="Append the results of the suite as a JSON line to this file, instead of printing them.")
+    args = parser.parse_args()
+
+    main(args)
@@ -1,27 +1,323 @@
-from datetime import datetime
+from array import array
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING
 
-from spotipy import Spotify
+# Spotipy takes long to import, and is only needed for annotations here
+if TYPE_CHECKING:
+    from spotipy import Spotify
 
-from utils import safe_print
+from utils import safe_print, to_timestamp, from_timestamp
+
+
+class SeenTrackIndex:
+    """
+    Index of all tracks seen in any of the subscribed playlists, shared by all subscriptions.
+
+    Every track ID is interned once and gets an integer reference. Subscribed playlists only store a sorted array
+    of the references of their tracks, so a track that appears in many playlists is not stored many times, and
+    checking whether a playlist contained a track is a binary search.
+    """
+
+    def __init__(self):
+        self._refs = {}
+        self._track_ids = []
+        # UTC timestamp (in seconds) at which each track was first seen
+        self._first_seen = array("q")
+        # (playlist ID, reference) pairs that were added since the storage was last written
+        self._unsaved = []
+
+    def __len__(self):
+        return len(self._track_ids)
+
+    # Return the reference of the track ID, or None if it was never seen
+    def get_ref(self, track_id: str):
+        return self._refs.get(track_id)
+
+    def track_id(self, ref: int) -> str:
+        return self._track_ids[ref]
+
+    def first_seen(self, ref: int) -> datetime:
+        return from_timestamp(self._first_seen[ref])
+
+    # Intern the track ID and record that it was seen in the given playlist. Returns the reference of the track.
+    def add(self, playlist_id: str, track_id: str, seen_at: datetime = None) -> int:
+        ref = self._refs.get(track_id)
+        if ref is None:
+            ref = len(self._track_ids)
+            self._refs[track_id] = ref
+            self._track_ids.append(track_id)
+            self._first_seen.append(to_timestamp(seen_at or datetime.utcnow()))
+
+        self._unsaved.append((playlist_id, ref))
+        return ref
+
+    # The (playlist ID, reference) pairs that have not been written to storage yet
+    def unsaved(self) -> list:
+        return list(self._unsaved)
+
+    # Forget the first num_saved unsaved pairs (or all of them), after they have been written to storage.
+    def mark_saved(self, num_saved: int = None):
+        if num_saved is None:
+            num_saved = len(self._unsaved)
+        del self._unsaved[:num_saved]
+
+
+class PlaylistRecord:
+    """
+    Compact record of a playlist the user owns or follows, holding only the fields we use from the API listing.
+
+    Attributes:
+    collaborative (bool): whether other users can add tracks to the playlist
+    num_tracks (int): number of tracks in the playlist when it was listed
+    """
+
+    __slots__ = ("id", "name", "owner_id", "snapshot_id", "collaborative", "num_tracks")
+
+    def __init__(
+        self,
+        playlist_id: str,
+        name: str,
+        owner_id: str,
+        snapshot_id: str,
+        collaborative: bool = False,
+        num_tracks: int = None,
+    ):
+        self.id = playlist_id
+        self.name = name
+        self.owner_id = owner_id
+        self.snapshot_id = snapshot_id
+        self.collaborative = collaborative
+        self.num_tracks = num_tracks
+
+    # Create a record from a playlist dict as returned by the API
+    @classmethod
+    def from_api(cls, playlist: dict):
+        return cls(
+            playlist["id"],
+            playlist["name"],
+            playlist["owner"]["id"],
+            playlist["snapshot_id"],
+            bool(playlist.get("collaborative")),
+            (playlist.get("tracks") or {}).get("total"),
+        )
+
+    # Create a record from to_dict output. Older save files stored the raw API dicts instead.
+    @classmethod
+    def from_dict(cls, data: dict):
+        if "owner" in data:
+            return cls.from_api(data)
+        return cls(**data)
+
+    def to_dict(self) -> dict:
+        return {
+            "playlist_id": self.id,
+            "name": self.name,
+            "owner_id": self.owner_id,
+            "snapshot_id": self.snapshot_id,
+            "collaborative": self.collaborative,
+            "num_tracks": self.num_tracks,
+        }
+
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __eq__(self, other):
+        return isinstance(other, PlaylistRecord) and self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return "'{}' by {} - ID: {} - Snapshot: {}".format(
+            self.name, self.owner_id, self.id, self.snapshot_id
+        )
 
 
 class SubscribedPlaylist:
     """
-    Convert subscribed playlist dictionary into more managable object.
+    Convert subscribed playlist record into more managable object.
+
+    Attributes:
+    first_page_bytes (int): size of the first page of tracks, to estimate how much skipping unchanged playlists saves
+    num_tracks (int): number of tracks in the playlist when we last checked it, None if unknown
+    num_checks (int): number of updates that checked the playlist, see PollScheduler
+    num_changes (int): number of those checks in which the snapshot had changed
+    num_new_tracks (int): number of new tracks those checks found
+    last_checked (datetime): time of the update that last checked the playlist, None if unknown
+    check_interval (timedelta): time after the last check at which the playlist should be checked again
     """
 
-    def __init__(self, playlist: dict, tracks: list):
-        self.name = playlist["name"]
-        self.id = playlist["id"]
-        self.owner_id = playlist["owner"]["id"]
-        self.snapshot_id = playlist["snapshot_id"]
+    __slots__ = (
+        "name",
+        "id",
+        "owner_id",
+        "snapshot_id",
+        "subscribe_stamp",
+        "first_page_bytes",
+        "num_tracks",
+        "num_checks",
+        "num_changes",
+        "num_new_tracks",
+        "last_checked",
+        "check_interval",
+        "_index",
+        "_track_refs",
+        "_new_refs",
+        "_legacy_track_ids",
+    )
+
+    # Values for attributes that objects from older save files may not have
+    _defaults = {
+        "first_page_bytes": 0,
+        "num_tracks": None,
+        "num_checks": 0,
+        "num_changes": 0,
+        "num_new_tracks": 0,
+        "last_checked": None,
+        "check_interval": None,
+        "_index": None,
+        "_track_refs": None,
+        "_new_refs": None,
+        "_legacy_track_ids": None,
+    }
+
+    def __init__(
+        self,
+        playlist: PlaylistRecord,
+        tracks: list,
+        index: SeenTrackIndex,
+        first_page_bytes: int = 0,
+    ):
+        self.name = playlist.name
+        self.id = playlist.id
+        self.owner_id = playlist.owner_id
+        self.snapshot_id = playlist.snapshot_id
         self.subscribe_stamp = datetime.utcnow()
+        self.first_page_bytes = first_page_bytes
+        self.num_tracks = playlist.num_tracks
+        # The playlist is checked on the next update, for tracks added since the previous update
+        self.num_checks = 0
+        self.num_changes = 0
+        self.num_new_tracks = 0
+        self.last_checked = None
+        self.check_interval = timedelta(0)
 
-        # Store track IDs in dict so we won't think songs are new if they are
+        # Store the tracks in the index so we won't think songs are new if they are
         # deleted and re-added to the list
-        self.track_ids = {}
+        self._index = index
+        self._track_refs = array("I")
+        self._new_refs = array("I")
+        self._legacy_track_ids = None
         for track in tracks:
-            self.track_ids[track.id] = self.subscribe_stamp
+            self.add_track(track.id, self.subscribe_stamp)
+
+    # Recreate a subscribed playlist from stored attributes, without the API response.
+    @classmethod
+    def from_storage(
+        cls,
+        playlist_id: str,
+        name: str,
+        owner_id: str,
+        snapshot_id: str,
+        subscribe_stamp: datetime,
+        num_tracks: int,
+        first_page_bytes: int,
+        index: SeenTrackIndex,
+        num_checks: int = 0,
+        num_changes: int = 0,
+        num_new_tracks: int = 0,
+        last_checked: datetime = None,
+        check_interval: timedelta = None,
+    ):
+        playlist = cls.__new__(cls)
+        playlist.name = name
+        playlist.id = playlist_id
+        playlist.owner_id = owner_id
+        playlist.snapshot_id = snapshot_id
+        playlist.subscribe_stamp = subscribe_stamp
+        playlist.first_page_bytes = first_page_bytes
+        playlist.num_tracks = num_tracks
+        playlist.num_checks = num_checks
+        playlist.num_changes = num_changes
+        playlist.num_new_tracks = num_new_tracks
+        playlist.last_checked = last_checked
+        playlist.check_interval = check_interval
+        playlist._index = index
+        playlist._track_refs = array("I")
+        playlist._new_refs = array("I")
+        playlist._legacy_track_ids = None
+        return playlist
+
+    def __getstate__(self):
+        self._merge_new_refs()
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    # Objects from older save files were pickled with a __dict__, which may lack some attributes
+    # and contain a dict of track IDs instead of a reference to the shared index, or a set of references.
+    def __setstate__(self, state):
+        if isinstance(state, tuple):
+            state = {**(state[0] or {}), **(state[1] or {})}
+
+        for name in self.__slots__:
+            setattr(self, name, state.get(name, self._defaults.get(name)))
+        self._track_refs = array("I", sorted(self._track_refs or ()))
+        self._new_refs = array("I", self._new_refs or ())
+
+        if "track_ids" in state:
+            self._legacy_track_ids = state["track_ids"]
+
+    # Whether the playlist is attached to the shared index of seen tracks
+    @property
+    def attached(self) -> bool:
+        return self._index is not None
+
+    # Attach the playlist to the shared index. Used to upgrade objects from older save files,
+    # which stored their own dict of track IDs.
+    def attach_index(self, index: SeenTrackIndex):
+        track_ids = self._legacy_track_ids or {}
+        self._index = index
+        self._track_refs = array("I")
+        self._new_refs = array("I")
+        self._legacy_track_ids = None
+        for track_id, seen_at in track_ids.items():
+            self.add_track(track_id, seen_at)
+
+    # IDs of all tracks we have seen in this playlist
+    @property
+    def track_ids(self) -> list:
+        return [self._index.track_id(ref) for ref in self.track_refs]
+
+    # References of all tracks we have seen in this playlist, in ascending order
+    @property
+    def track_refs(self) -> array:
+        self._merge_new_refs()
+        return self._track_refs
+
+    def has_track(self, track_id: str) -> bool:
+        ref = self._index.get_ref(track_id)
+        if ref is None:
+            return False
+        refs = self.track_refs
+        position = bisect_left(refs, ref)
+        return position < len(refs) and refs[position] == ref
+
+    # Remember that the track was in this playlist, so it won't be considered new in the future.
+    def add_track(self, track_id: str, seen_at: datetime = None):
+        ref = self._index.add(self.id, track_id, seen_at)
+        # New tracks get the highest reference so far, so they can usually be appended. Others are sorted in
+        # at the next lookup, so adding many of them does not move the array every time.
+        if not self._track_refs or ref > self._track_refs[-1]:
+            self._track_refs.append(ref)
+        else:
+            self._new_refs.append(ref)
+
+    # Sort the references that could not be appended into the array of references
+    def _merge_new_refs(self):
+        if self._new_refs:
+            new_refs = set(self._new_refs).difference(self._track_refs)
+            self._track_refs = array("I", sorted(self._track_refs.tolist() + list(new_refs)))
+            self._new_refs = array("I")
 
     def __repr__(self):
         time_stamp = self.subscribe_stamp.strftime("%Y-%m-%dT%H:%M:%SZ")
@@ -34,21 +330,67 @@ class SubscribedPlaylist:
 class Track:
     """
     Convert track info dictionary into more managable object.
+
+    Only the fields used when updating the feed are kept. The full track info (album, artists, etc.)
+    is only kept if keep_details is True, or can be requested later with load_details.
     """
 
-    def __init__(self, track: dict, playlist_id="-1"):
+    __slots__ = ("name", "id", "main_artist_name", "playlist_id", "added_by", "_details")
+
+    def __init__(self, track: dict, playlist_id="-1", keep_details=False):
         self.name = track["track"]["name"]
         self.id = track["track"]["id"]
-        self.album = track["track"]["album"]
-        self.artist_dicts = track["track"]["artists"]
-        self.main_artist_name = self.artist_dicts[0]["name"]
+        self.main_artist_name = track["track"]["artists"][0]["name"]
         self.playlist_id = playlist_id
         self.added_by = track["added_by"]["id"]
+        self._details = track["track"] if keep_details else None
+
+    # Request the full track info from the API, if we did not keep it.
+    def load_details(self, spotify: "Spotify") -> dict:
+        if self._details is None:
+            self._details = spotify.track(self.id)
+        return self._details
+
+    def _get_detail(self, key: str):
+        if self._details is None:
+            raise AttributeError(
+                "Track {} did not keep its {}, call load_details first.".format(
+                    self.id, key
+                )
+            )
+        return self._details[key]
+
+    @property
+    def album(self) -> dict:
+        return self._get_detail("album")
+
+    @property
+    def artist_dicts(self) -> list:
+        return self._get_detail("artists")
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    # Tracks pickled by older versions stored the album and artists as attributes.
+    def __setstate__(self, state):
+        if isinstance(state, tuple):
+            state = {**(state[0] or {}), **(state[1] or {})}
+
+        for name in ("name", "id", "main_artist_name", "playlist_id", "added_by"):
+            setattr(self, name, state.get(name))
+        self._details = state.get("_details")
+        if self._details is None and "album" in state:
+            self._details = {
+                "name": state.get("name"),
+                "id": state.get("id"),
+                "album": state["album"],
+                "artists": state.get("artist_dicts"),
+            }
 
     def __repr__(self):
         return (
-            f"Track(name={self.name}, id={self.id}, artist_dicts={self.artist_dicts}, "
-            + f"album={self.album}, playlist_id={self.playlist_id})"
+            f"Track(name={self.name}, id={self.id}, main_artist_name={self.main_artist_name}, "
+            + f"added_by={self.added_by}, playlist_id={self.playlist_id})"
         )
 
 
@@ -67,7 +409,7 @@ class SubscriptionFeed:
 
     def __init__(
         self,
-        spotify: Spotify,
+        spotify: "Spotify",
         user_id: str,
         name: str = default_name,
         description: str = default_description,
@@ -84,3 +426,12 @@ class SubscriptionFeed:
         self.id = feed["id"]
         self.name = feed["name"]
         self.last_update = datetime.utcnow()
+
+    # Recreate the feed from stored attributes, without creating a new playlist.
+    @classmethod
+    def from_storage(cls, feed_id: str, name: str, last_update: datetime):
+        feed = cls.__new__(cls)
+        feed.id = feed_id
+        feed.name = name
+        feed.last_update = last_update
+        return feed
@@ -0,0 +1,214 @@
+import argparse
+import heapq
+import itertools
+import json
+import random
+import signal
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from SpotifySubscriber import SpotifySubscriber
+from rate_limit import RateLimiter
+from metrics import Metrics, parse_address
+from poll_scheduler import PollScheduler
+from utils import safe_print
+
+
+class UserContext:
+    """
+    A user of which the daemon keeps the feed up to date.
+
+    Attributes:
+    subscriber (SpotifySubscriber): loaded once and kept between updates, together with its API client and token
+    interval (float): number of seconds between updates of the feed
+    add_own (bool): whether to add tracks the user added to playlists themselves, see SpotifySubscriber.update_feed
+    scheduler (PollScheduler): decides which subscriptions are checked in an update
+    """
+
+    def __init__(
+        self,
+        subscriber: SpotifySubscriber,
+        interval: float,
+        add_own: bool = False,
+        scheduler: PollScheduler = None,
+    ):
+        self.subscriber = subscriber
+        self.interval = interval
+        self.add_own = add_own
+        self.scheduler = scheduler if scheduler is not None else PollScheduler()
+
+    @property
+    def user_id(self) -> str:
+        return self.subscriber.user_id
+
+
+class Daemon:
+    """
+    Long-running scheduler that keeps the subscription feeds of several users up to date.
+
+    The feed of every user is updated every interval seconds, randomly shifted by up to the jitter fraction of the
+    interval, so that the updates of different users are spread out. At most max_concurrent_users feeds are updated
+    at the same time, and they share one pool of worker threads to fetch playlists. Access tokens are refreshed
+    token_margin seconds before they expire, so updates never have to wait for a refresh.
+    """
+
+    def __init__(
+        self,
+        contexts: list,
+        workers: int = 8,
+        max_concurrent_users: int = 2,
+        jitter: float = 0.1,
+        token_margin: float = 300,
+    ):
+        self.contexts = contexts
+        self.workers = max(1, workers)
+        self.max_concurrent_users = max(1, max_concurrent_users)
+        self.jitter = jitter
+        self.token_margin = token_margin
+
+        # Heap of (time, sequence number, kind, context) of the scheduled jobs
+        self._queue = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._fetch_pool = None
+
+    def _schedule(self, when: float, kind: str, context: UserContext):
+        with self._condition:
+            heapq.heappush(self._queue, (when, next(self._sequence), kind, context))
+            self._condition.notify()
+
+    def _jittered(self, interval: float) -> float:
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def _refresh_token(self, context: UserContext):
+        try:
+            expires_at = context.subscriber.refresh_token(self.token_margin)
+        except Exception:
+            safe_print("Could not refresh the token of {}, retrying in a minute:".format(context.user_id))
+            traceback.print_exc()
+            self._schedule(time.time() + 60, "token", context)
+            return
+
+        # Clients that were not created by the subscriber do not have a token to refresh
+        if expires_at is not None:
+            self._schedule(expires_at - self.token_margin, "token", context)
+
+    def _update_feed(self, context: UserContext):
+        start = time.time()
+        try:
+            num_tracks = context.subscriber.update_feed(
+                add_own=context.add_own,
+                max_workers=self.workers,
+                executor=self._fetch_pool,
+                scheduler=context.scheduler,
+            )
+            safe_print(
+                "Added {} new tracks to the feed of {} in {:.1f} s.".format(
+                    num_tracks, context.user_id, time.time() - start
+                )
+            )
+        except Exception:
+            safe_print("Updating the feed of {} failed:".format(context.user_id))
+            traceback.print_exc()
+
+        # Only schedule the next update once this one is done, so a user is never updated twice at the same time.
+        self._schedule(time.time() + self._jittered(context.interval), "update", context)
+
+    # Run until stop is called. Updates that are running at that time are finished first.
+    def run(self):
+        now = time.time()
+        for context in self.contexts:
+            self._schedule(now, "token", context)
+            self._schedule(now + random.uniform(0, self.jitter * context.interval), "update", context)
+
+        with ThreadPoolExecutor(self.workers) as fetch_pool, ThreadPoolExecutor(
+            self.max_concurrent_users
+        ) as user_pool:
+            self._fetch_pool = fetch_pool
+            while True:
+                with self._condition:
+                    while not self._stopped and (
+                        not self._queue or self._queue[0][0] > time.time()
+                    ):
+                        timeout = self._queue[0][0] - time.time() if self._queue else None
+                        self._condition.wait(timeout)
+                    if self._stopped:
+                        break
+                    _, _, kind, context = heapq.heappop(self._queue)
+
+                if kind == "token":
+                    self._refresh_token(context)
+                else:
+                    user_pool.submit(self._update_feed, context)
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+
+def main(args):
+    with open(args.config, "r") as config_file:
+        config = json.load(config_file)
+
+    workers = config.get("workers", 8)
+    rate_limiter = RateLimiter(config.get("rate", 10.0), config.get("burst", 20))
+
+    contexts = []
+    for user in config["users"]:
+        metrics = Metrics(
+            enabled=user.get("metrics", False)
+            or "prometheus_file" in user
+            or "statsd" in user,
+            prometheus_path=user.get("prometheus_file"),
+            statsd_address=parse_address(user["statsd"]) if "statsd" in user else None,
+        )
+        subscriber = SpotifySubscriber(
+            user["user_id"],
+            storage_dir=user["storage_dir"],
+            pool_size=workers,
+            rate_limiter=rate_limiter,
+            metrics=metrics,
+            load_playlists=False,
+        )
+        interval = user.get("interval", config.get("interval", 60))
+        scheduler = PollScheduler(
+            max_interval=timedelta(days=user.get("max_interval", 7)),
+            request_budget=user.get("request_budget"),
+        )
+        contexts.append(UserContext(subscriber, interval * 60, user.get("add_own", False), scheduler))
+        safe_print("Loaded {}, updating every {} minutes.".format(subscriber.user_id, interval))
+
+    daemon = Daemon(
+        contexts,
+        workers=workers,
+        max_concurrent_users=config.get("max_concurrent_users", 2),
+        jitter=config.get("jitter", 0.1),
+        token_margin=config.get("token_margin", 300),
+    )
+    for signal_number in [signal.SIGINT, signal.SIGTERM]:
+        signal.signal(signal_number, lambda *_: daemon.stop())
+    daemon.run()
+
+    stats = rate_limiter.stats()
+    safe_print(
+        "Sent {} requests: {:.1f} s throttled ({} requests), {:.1f} s on the wire, {} rate limited.".format(
+            stats["requests"],
+            stats["throttled_time"],
+            stats["throttled_requests"],
+            stats["wire_time"],
+            stats["rate_limited"],
+        )
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Keep updating the subscription feeds of several users.')
+    parser.add_argument('config', type = str, help = 'JSON file with the users to update, see the README for its format.')
+    args = parser.parse_args()
+
+    main(args)
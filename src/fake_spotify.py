@@ -0,0 +1,328 @@
+import hashlib
+import random
+import string
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from urllib.parse import parse_qs, urlparse
+
+BASE62 = string.ascii_letters + string.digits
+
+
+# Raise an API error like the client does. Spotipy is imported here, so that importing the fake does not import it.
+def raise_api_error(http_status: int, message: str, headers: dict = None):
+    from spotipy.client import SpotifyException
+
+    raise SpotifyException(http_status, -1, message, headers=headers)
+
+
+# Deterministic 22 character base62 ID for a number. Consecutive numbers get unrelated IDs, like real ones.
+def synthetic_id(number: int) -> str:
+    digest = hashlib.blake2b(number.to_bytes(16, "little"), digest_size=16).digest()
+    number = int.from_bytes(digest, "little")
+    digits = []
+    for _ in range(22):
+        number, digit = divmod(number, 62)
+        digits.append(BASE62[digit])
+    return "".join(digits)
+
+
+class FakePlaylist:
+    """
+    Playlist of the fake API. The initial tracks are generated from their position when they are requested,
+    so large playlists take no memory. Tracks added later are stored.
+
+    Attributes:
+    num_initial (int): number of generated tracks, which were added one minute apart starting at 2019-01-01
+    added (list): (track ID, added_at, added_by) of the tracks added after the initial ones
+    snapshot (int): increased on every change
+    """
+
+    start = datetime(2019, 1, 1)
+
+    def __init__(self, number: int, name: str, owner_id: str, num_initial: int, collaborative=False):
+        self.number = number
+        self.id = synthetic_id(number)
+        self.name = name
+        self.owner_id = owner_id
+        self.collaborative = collaborative
+        self.num_initial = num_initial
+        self.added = []
+        self.snapshot = 0
+
+    def __len__(self):
+        return self.num_initial + len(self.added)
+
+    def item(self, position: int) -> dict:
+        if position < self.num_initial:
+            track_id = synthetic_id((self.number << 32) + position)
+            added_at = self.start + timedelta(minutes=position)
+            added_by = self.owner_id
+        else:
+            track_id, added_at, added_by = self.added[position - self.num_initial]
+
+        return {
+            "added_at": added_at.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "added_by": {"id": added_by},
+            "is_local": False,
+            "track": {
+                "id": track_id,
+                "name": "Track " + track_id[:6],
+                "artists": [{"id": track_id[::-1], "name": "Artist " + track_id[-6:]}],
+                "album": {"id": track_id[1:], "name": "Album " + track_id[:3]},
+                "duration_ms": 200000,
+            },
+        }
+
+    def add(self, track_ids: list, added_by: str, added_at: datetime = None):
+        added_at = added_at or datetime.utcnow()
+        self.added += [(track_id, added_at, added_by) for track_id in track_ids]
+        self.snapshot += 1
+
+    # Only the tracks added after the initial ones can be removed
+    def remove(self, track_ids: list):
+        track_ids = set(track_ids)
+        self.added = [entry for entry in self.added if entry[0] not in track_ids]
+        self.snapshot += 1
+
+    def summary(self) -> dict:
+        return {
+            "id": self.id,
+            "name": self.name,
+            "owner": {"id": self.owner_id},
+            "collaborative": self.collaborative,
+            "snapshot_id": "snapshot{}".format(self.snapshot),
+            "tracks": {"total": len(self)},
+        }
+
+
+class FakeSpotify:
+    """
+    Local stand-in for the Spotify client, serving synthetic playlists that the user follows.
+    It implements the client methods SpotifySubscriber uses, with the same paging as the API.
+
+    Every request sleeps for latency seconds. If rate_limit is set, requests beyond rate_limit per second are rate
+    limited: writes raise a SpotifyException with status 429 and a Retry-After header, and reads are delayed by
+    retry_after seconds, which is what the API session does when it retries them.
+
+    Attributes:
+    playlists (dict): FakePlaylists by ID
+    saved (list): (track ID, saved_at) of the tracks in the library of the user, newest first
+    calls (dict): number of requests per client method
+    rate_limited (int): number of requests that were rate limited
+    first_request_time (float): time.perf_counter() of the first request, None if none was made yet
+    """
+
+    def __init__(
+        self,
+        user_id: str = "me",
+        num_playlists: int = 10,
+        tracks_per_playlist: int = 100,
+        latency: float = 0.0,
+        rate_limit: float = None,
+        retry_after: float = 1.0,
+        seed: int = 0,
+    ):
+        self.user_id = user_id
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.calls = {}
+        self.rate_limited = 0
+        self.first_request_time = None
+        self._request_times = deque()
+        self._lock = threading.Lock()
+        self._next_number = 0
+
+        self.saved = []
+        self.playlists = {}
+        for index in range(num_playlists):
+            self._create_playlist(
+                "Benchmark playlist {}".format(index), "owner{}".format(index), tracks_per_playlist
+            )
+
+    def _create_playlist(self, name: str, owner_id: str, num_tracks: int) -> FakePlaylist:
+        with self._lock:
+            self._next_number += 1
+            number = self._next_number
+        playlist = FakePlaylist(number, name, owner_id, num_tracks)
+        self.playlists[playlist.id] = playlist
+        return playlist
+
+    @property
+    def num_requests(self) -> int:
+        return sum(self.calls.values())
+
+    def reset_counters(self):
+        self.calls = {}
+        self.rate_limited = 0
+
+    def _request(self, method: str, write: bool = False):
+        limited = False
+        with self._lock:
+            if self.first_request_time is None:
+                self.first_request_time = time.perf_counter()
+            self.calls[method] = self.calls.get(method, 0) + 1
+            if self.rate_limit is not None:
+                now = time.monotonic()
+                while self._request_times and now - self._request_times[0] > 1.0:
+                    self._request_times.popleft()
+                limited = len(self._request_times) >= self.rate_limit
+                if limited:
+                    self.rate_limited += 1
+                else:
+                    self._request_times.append(now)
+
+        if self.latency:
+            time.sleep(self.latency)
+        if limited:
+            if write:
+                raise_api_error(
+                    429, "API rate limit exceeded", {"Retry-After": str(self.retry_after)}
+                )
+            time.sleep(self.retry_after)
+
+    # Add num_new_tracks new tracks to a random fraction of the followed playlists, and return their IDs.
+    def churn(self, fraction: float, num_new_tracks: int) -> list:
+        followed = [
+            playlist for playlist in self.playlists.values() if playlist.owner_id != self.user_id
+        ]
+        changed = self.rng.sample(followed, int(round(fraction * len(followed))))
+        new_ids = []
+        for playlist in changed:
+            track_ids = [
+                synthetic_id(self.rng.getrandbits(64) + (1 << 64)) for _ in range(num_new_tracks)
+            ]
+            # Make sure the tracks are newer than the last update, which has a resolution of seconds
+            playlist.add(track_ids, playlist.owner_id, datetime.utcnow() + timedelta(seconds=1))
+            new_ids += track_ids
+        return new_ids
+
+    def _page(self, playlist: FakePlaylist, offset: int, limit: int) -> dict:
+        end = min(offset + limit, len(playlist))
+        next_url = None
+        if end < len(playlist):
+            next_url = "https://api.spotify.com/v1/playlists/{}/tracks?offset={}&limit={}".format(
+                playlist.id, end, limit
+            )
+        return {
+            "href": "https://api.spotify.com/v1/playlists/{}/tracks".format(playlist.id),
+            "items": [playlist.item(position) for position in range(offset, end)],
+            "limit": limit,
+            "next": next_url,
+            "offset": offset,
+            "total": len(playlist),
+        }
+
+    # Save tracks to the library of the user
+    def save_tracks(self, track_ids: list, saved_at: datetime = None):
+        saved_at = saved_at or datetime.utcnow()
+        self.saved = [(track_id, saved_at) for track_id in reversed(track_ids)] + self.saved
+
+    def _saved_page(self, offset: int, limit: int) -> dict:
+        end = min(offset + limit, len(self.saved))
+        next_url = None
+        if end < len(self.saved):
+            next_url = "https://api.spotify.com/v1/me/tracks?offset={}&limit={}".format(end, limit)
+        return {
+            "items": [
+                {
+                    "added_at": saved_at.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                    "track": {"id": track_id, "name": "Track " + track_id[:6]},
+                }
+                for track_id, saved_at in self.saved[offset:end]
+            ],
+            "limit": limit,
+            "next": next_url,
+            "offset": offset,
+            "total": len(self.saved),
+        }
+
+    def _playlists_page(self, offset: int, limit: int) -> dict:
+        playlists = list(self.playlists.values())
+        end = min(offset + limit, len(playlists))
+        next_url = None
+        if end < len(playlists):
+            next_url = "https://api.spotify.com/v1/users/{}/playlists?offset={}&limit={}".format(
+                self.user_id, end, limit
+            )
+        return {
+            "items": [playlist.summary() for playlist in playlists[offset:end]],
+            "limit": limit,
+            "next": next_url,
+            "offset": offset,
+            "total": len(playlists),
+        }
+
+    def user_playlists(self, user, limit=50, offset=0):
+        self._request("user_playlists")
+        return self._playlists_page(offset, limit)
+
+    def next(self, result):
+        if not result["next"]:
+            return None
+        self._request("next")
+        url = urlparse(result["next"])
+        query = parse_qs(url.query)
+        offset, limit = int(query["offset"][0]), int(query["limit"][0])
+        parts = url.path.split("/")
+        if parts[-2:] == ["me", "tracks"]:
+            return self._saved_page(offset, limit)
+        if parts[-1] == "tracks":
+            return self._page(self.playlists[parts[-2]], offset, limit)
+        return self._playlists_page(offset, limit)
+
+    def user_playlist(self, user, playlist_id=None, fields=None, market=None):
+        self._request("user_playlist")
+        playlist = self.playlists[playlist_id]
+        data = playlist.summary()
+        if fields is None or "tracks.total" not in fields:
+            data["tracks"] = self._page(playlist, 0, 100)
+        return data
+
+    def user_playlist_tracks(
+        self, user=None, playlist_id=None, fields=None, limit=100, offset=0, market=None
+    ):
+        self._request("user_playlist_tracks")
+        return self._page(self.playlists[playlist_id], offset, limit)
+
+    def user_playlist_create(self, user, name, public=True, collaborative=False, description=""):
+        self._request("user_playlist_create", write=True)
+        playlist = self._create_playlist(name, user, 0)
+        return playlist.summary()
+
+    def user_playlist_add_tracks(self, user, playlist_id, tracks, position=None):
+        self._request("user_playlist_add_tracks", write=True)
+        if len(tracks) > 100:
+            raise_api_error(400, "Too many tracks, at most 100 are allowed")
+        playlist = self.playlists[playlist_id]
+        playlist.add([str(track_id) for track_id in tracks], user)
+        return {"snapshot_id": "snapshot{}".format(playlist.snapshot)}
+
+    def user_playlist_remove_all_occurrences_of_tracks(self, user, playlist_id, tracks, snapshot_id=None):
+        self._request("user_playlist_remove_all_occurrences_of_tracks", write=True)
+        if len(tracks) > 100:
+            raise_api_error(400, "Too many tracks, at most 100 are allowed")
+        playlist = self.playlists[playlist_id]
+        playlist.remove([str(track_id) for track_id in tracks])
+        return {"snapshot_id": "snapshot{}".format(playlist.snapshot)}
+
+    def user_follow_users(self, ids):
+        self._request("user_follow_users", write=True)
+
+    def tracks(self, tracks, market=None):
+        self._request("tracks")
+        if len(tracks) > 50:
+            raise_api_error(400, "Too many tracks, at most 50 are allowed")
+        return {
+            "tracks": [
+                {"id": track_id, "name": "Track " + track_id[:6], "artists": [{"name": "Artist " + track_id[-6:]}]}
+                for track_id in tracks
+            ]
+        }
+
+    def current_user_saved_tracks(self, limit=20, offset=0, market=None):
+        self._request("current_user_saved_tracks")
+        return self._saved_page(offset, limit)
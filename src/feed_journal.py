@@ -0,0 +1,74 @@
+import json
+import os
+from datetime import datetime
+
+
+class FeedJournal:
+    """
+    Write-ahead journal of the tracks that are being added to the subscription feed.
+
+    Before tracks are sent to the API, they are recorded as pending, and every batch that was added to the feed and
+    to the FeedLog is recorded as done. The journal is cleared once the state has been saved. If a run is
+    interrupted, the pending tracks that are not done are the ones of which we do not know whether they reached the
+    feed, so the next run can check the feed for exactly those tracks instead of adding them again.
+
+    Every record is a line of JSON that is flushed to disk before we continue. An incomplete last line, left by
+    an interruption while writing it, is ignored.
+    """
+
+    filename = "feed_journal.jsonl"
+
+    def __init__(self, storage_dir: str):
+        self.path = os.path.join(storage_dir, self.filename)
+
+    def _write(self, record: dict):
+        with open(self.path, "a") as journal_file:
+            journal_file.write(json.dumps(record) + "\n")
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+
+    # Record that the tracks are about to be added to the feed playlist with the given ID.
+    def begin(self, feed_id: str, track_ids: list, time: datetime = None):
+        time = time or datetime.utcnow()
+        self._write(
+            {"pending": [str(track_id) for track_id in track_ids], "feed": feed_id, "time": time.isoformat()}
+        )
+
+    # Record that the tracks were added to the feed and to the feed log.
+    def commit(self, track_ids: list):
+        self._write({"done": [str(track_id) for track_id in track_ids]})
+
+    # Return (feed ID, time of the record, track IDs) for every pending record of which some tracks are not done,
+    # and the IDs of all tracks that are done.
+    def read(self):
+        pending = []
+        done = set()
+        if not os.path.exists(self.path):
+            return pending, done
+
+        with open(self.path, "r") as journal_file:
+            for line in journal_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if "pending" in record:
+                    pending.append(
+                        (record["feed"], datetime.fromisoformat(record["time"]), record["pending"])
+                    )
+                else:
+                    done.update(record["done"])
+
+        unfinished = []
+        for feed_id, time, track_ids in pending:
+            track_ids = [track_id for track_id in track_ids if track_id not in done]
+            if track_ids:
+                unfinished.append((feed_id, time, track_ids))
+        return unfinished, done
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,198 @@
+import os
+import pickle
+import numpy as np
+from datetime import datetime
+
+from utils import atomic_write, to_timestamp
+
+
+class FeedLog:
+    """
+    Log of the tracks that were added to the feed playlists.
+
+    The log is stored column-wise in fixed-width binary files, so that adding entries only appends to them:
+        feed_log_ids.bin: track IDs as 22-byte base62 strings
+        feed_log_timestamps.bin: int64 UTC timestamps (in seconds) at which the tracks were added to the feed
+        feed_log_feeds.bin: IDs of the feed playlists the tracks were added to, empty for entries of older versions,
+            which only had the subscription feed
+    In addition, feed_log_index.bin holds the sorted set of all track IDs that were ever added. It is memory-mapped
+    and binary searched, so checking whether tracks have been added to the feed before does not read the full
+    history. Entries of tracks that were removed from the feed are dropped from the columns by compact, but the
+    tracks stay in the index, so they are never added again.
+    """
+
+    id_dtype = np.dtype("S22")
+    timestamp_dtype = np.dtype("<i8")
+
+    def __init__(self, storage_dir: str):
+        self.storage_dir = storage_dir
+        self._ids_path = os.path.join(storage_dir, "feed_log_ids.bin")
+        self._timestamps_path = os.path.join(storage_dir, "feed_log_timestamps.bin")
+        self._feeds_path = os.path.join(storage_dir, "feed_log_feeds.bin")
+        self._index_path = os.path.join(storage_dir, "feed_log_index.bin")
+        self._legacy_path = os.path.join(storage_dir, "feed_log.npy")
+        self._compaction_path = os.path.join(storage_dir, "feed_log_compaction")
+
+        self._recover_compaction()
+        if os.path.exists(self._legacy_path) and not os.path.exists(self._ids_path):
+            self._migrate_legacy_log()
+
+    def __len__(self):
+        # If a previous run was interrupted between writing the columns, ignore the incomplete entry.
+        # Logs of older versions have no feed column yet.
+        lengths = [
+            self._file_entries(self._ids_path, self.id_dtype),
+            self._file_entries(self._timestamps_path, self.timestamp_dtype),
+        ]
+        if os.path.exists(self._feeds_path):
+            lengths.append(self._file_entries(self._feeds_path, self.id_dtype))
+        return min(lengths)
+
+    @staticmethod
+    def _file_entries(path: str, dtype: np.dtype) -> int:
+        if not os.path.exists(path):
+            return 0
+        return os.path.getsize(path) // dtype.itemsize
+
+    @staticmethod
+    def _memmap(path: str, dtype: np.dtype, num_entries: int = None) -> np.ndarray:
+        if num_entries is None:
+            num_entries = FeedLog._file_entries(path, dtype)
+        # Numpy cannot memory-map empty files
+        if num_entries == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode="r", shape=(num_entries,))
+
+    # Convert track IDs to fixed-width byte strings
+    def _encode(self, track_ids) -> np.ndarray:
+        track_ids = np.asarray(track_ids)
+        if track_ids.dtype.kind == "U":
+            if track_ids.size > 0 and np.any(np.char.str_len(track_ids) != 22):
+                raise ValueError("Track IDs must be 22-character base62 strings.")
+            track_ids = np.char.encode(track_ids, "ascii")
+        return track_ids.astype(self.id_dtype)
+
+    # Return a boolean array that denotes which of the track IDs have been added to the feed before.
+    def contains(self, track_ids) -> np.ndarray:
+        keys = self._encode(track_ids)
+        index = self._memmap(self._index_path, self.id_dtype)
+        if index.size == 0 or keys.size == 0:
+            return np.zeros(keys.shape, dtype=bool)
+
+        positions = np.minimum(np.searchsorted(index, keys), index.size - 1)
+        return index[positions] == keys
+
+    # Return only the track IDs that have never been added to the feed.
+    def filter_new(self, track_ids) -> np.ndarray:
+        track_ids = np.asarray(track_ids)
+        return track_ids[~self.contains(track_ids)]
+
+    # Store that the track IDs were added to the feed playlist with the given ID at the given time.
+    def append(self, track_ids, time: datetime = None, feed_id: str = None):
+        keys = self._encode(track_ids)
+        if keys.size == 0:
+            return
+        if time is None:
+            time = datetime.utcnow()
+        timestamps = np.full(keys.size, to_timestamp(time), dtype=self.timestamp_dtype)
+        feed_ids = np.full(keys.size, (feed_id or "").encode("ascii"), dtype=self.id_dtype)
+
+        # Cut off any incomplete entry before appending, so the columns stay aligned. Truncating the feed column
+        # of older logs extends it with empty IDs.
+        num_entries = len(self)
+        for path, dtype, values in [
+            (self._ids_path, self.id_dtype, keys),
+            (self._timestamps_path, self.timestamp_dtype, timestamps),
+            (self._feeds_path, self.id_dtype, feed_ids),
+        ]:
+            with open(path, "ab") as log_file:
+                log_file.truncate(num_entries * dtype.itemsize)
+                log_file.write(values.tobytes())
+
+        self._add_to_index(keys)
+
+    # Merge the new IDs into the sorted index, and atomically replace the old index file.
+    def _add_to_index(self, keys: np.ndarray):
+        index = self._memmap(self._index_path, self.id_dtype)
+        new_keys = np.unique(keys)
+        if index.size > 0:
+            new_keys = new_keys[~self.contains(new_keys)]
+        if new_keys.size == 0:
+            return
+
+        merged = np.insert(index, np.searchsorted(index, new_keys), new_keys)
+        del index
+
+        with atomic_write(self._index_path) as index_file:
+            merged.tofile(index_file)
+
+    # Return the track IDs (as strings) and timestamps (as datetime64) of all entries in the log.
+    def read(self):
+        num_entries = len(self)
+        track_ids = self._memmap(self._ids_path, self.id_dtype, num_entries)
+        timestamps = self._memmap(self._timestamps_path, self.timestamp_dtype, num_entries)
+        return track_ids.astype(str), timestamps.astype("datetime64[s]")
+
+    # Return the IDs of the feed playlists of all entries in the log, as strings. They are empty for entries of
+    # older versions.
+    def read_feeds(self) -> np.ndarray:
+        return self._feed_column(len(self)).astype(str)
+
+    def _feed_column(self, num_entries: int) -> np.ndarray:
+        feed_ids = np.zeros(num_entries, dtype=self.id_dtype)
+        stored = self._memmap(self._feeds_path, self.id_dtype)[:num_entries]
+        feed_ids[: stored.size] = stored
+        return feed_ids
+
+    # Drop the entries of which keep is False from the columns. The tracks stay in the index.
+    def compact(self, keep: np.ndarray):
+        """
+        The columns are written next to the old ones first. Once they are all complete, a marker file is written
+        and the new columns replace the old ones, so an interruption never leaves columns of different entries:
+        without the marker the new columns are discarded, with it the replacement is finished when the log is opened.
+        """
+        num_entries = len(self)
+        columns = [
+            (self._ids_path, self._memmap(self._ids_path, self.id_dtype, num_entries)),
+            (self._timestamps_path, self._memmap(self._timestamps_path, self.timestamp_dtype, num_entries)),
+            (self._feeds_path, self._feed_column(num_entries)),
+        ]
+        for path, values in columns:
+            with open(path + ".compact", "wb") as column_file:
+                values[keep].tofile(column_file)
+                column_file.flush()
+                os.fsync(column_file.fileno())
+        # Memory-mapped files cannot be replaced on Windows
+        del columns, values
+
+        with atomic_write(self._compaction_path) as marker_file:
+            marker_file.write(b"")
+        self._recover_compaction()
+
+    # Finish or discard a compaction, see compact
+    def _recover_compaction(self):
+        finish = os.path.exists(self._compaction_path)
+        for path in [self._ids_path, self._timestamps_path, self._feeds_path]:
+            if os.path.exists(path + ".compact"):
+                if finish:
+                    os.replace(path + ".compact", path)
+                else:
+                    os.remove(path + ".compact")
+        if finish:
+            os.remove(self._compaction_path)
+
+    # Convert the pickled feed_log.npy of older versions, which contained object arrays of IDs and datetimes.
+    def _migrate_legacy_log(self):
+        with open(self._legacy_path, "rb") as log_file:
+            legacy_log = pickle.load(log_file)
+
+        keys = self._encode(np.asarray(legacy_log["track_ids"], dtype=str))
+        timestamps = np.array(
+            [to_timestamp(time) for time in legacy_log["timestamps"]],
+            dtype=self.timestamp_dtype,
+        )
+
+        keys.tofile(self._ids_path)
+        timestamps.tofile(self._timestamps_path)
+        self._add_to_index(keys)
+        os.replace(self._legacy_path, self._legacy_path + ".bak")
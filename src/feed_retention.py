@@ -0,0 +1,70 @@
+import numpy as np
+from datetime import datetime, timedelta
+
+
+class RetentionPolicy:
+    """
+    Decides which tracks are removed from the feeds, so the feed playlists and the FeedLog stop growing.
+
+    A track is removed if any of the rules applies:
+        max_age: it was added to its feed longer than max_age ago
+        max_count: its feed (all playlists of the feed together) holds at least max_count tracks that were added later
+        remove_saved: the user saved it in their library
+    Rules that are None or False do not apply. The rules are evaluated on the columns of the FeedLog at once,
+    so even long logs are checked quickly.
+
+    Attributes:
+    max_age (timedelta): age after which tracks are removed
+    max_count (int): number of newest tracks that are kept in every feed
+    remove_saved (bool): whether tracks the user saved are removed
+    """
+
+    def __init__(self, max_age: timedelta = None, max_count: int = None, remove_saved: bool = False):
+        if max_count is not None and max_count < 0:
+            raise ValueError("The number of tracks to keep cannot be negative.")
+        self.max_age = max_age
+        self.max_count = max_count
+        self.remove_saved = remove_saved
+
+    # Whether any of the rules applies
+    def __bool__(self):
+        return self.max_age is not None or self.max_count is not None or self.remove_saved
+
+    def select(
+        self, timestamps: np.ndarray, feed_names: np.ndarray, saved: np.ndarray = None, now: datetime = None
+    ) -> np.ndarray:
+        """
+        Return a boolean array that denotes which entries of the log should be removed.
+        Timestamps and feed_names hold the time and feed of every entry, in the order of the log. Saved denotes which
+        tracks the user saved, and is only needed if remove_saved is True.
+        """
+        remove = np.zeros(len(timestamps), dtype=bool)
+        if self.max_age is not None:
+            now = now or datetime.utcnow()
+            remove |= timestamps < np.datetime64(now - self.max_age, "s")
+        if self.max_count is not None:
+            remove |= self._newer_in_feed(feed_names) >= self.max_count
+        if self.remove_saved:
+            remove |= saved
+        return remove
+
+    # For every entry, the number of later entries of the same feed. The log is in the order in which the tracks
+    # were added, so these are the tracks that are newer.
+    @staticmethod
+    def _newer_in_feed(feed_names: np.ndarray) -> np.ndarray:
+        num_entries = len(feed_names)
+        if num_entries == 0:
+            return np.zeros(0, dtype=np.int64)
+        _, feeds = np.unique(feed_names, return_inverse=True)
+        feeds = feeds.reshape(-1)
+
+        # Sort by feed, and newest first within a feed, so the rank within the feed is the number of newer entries
+        positions = np.arange(num_entries)
+        order = np.lexsort((-positions, feeds))
+        sorted_feeds = feeds[order]
+        starts = np.flatnonzero(np.r_[True, sorted_feeds[1:] != sorted_feeds[:-1]])
+        counts = np.diff(np.r_[starts, num_entries])
+
+        newer = np.empty(num_entries, dtype=np.int64)
+        newer[order] = positions - np.repeat(starts, counts)
+        return newer
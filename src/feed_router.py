@@ -0,0 +1,135 @@
+from datetime import datetime
+
+
+class FeedPlaylist:
+    """
+    One of the playlists of a feed.
+
+    Attributes:
+    id (str): the playlist ID
+    name (str): the playlist name
+    num_tracks (int): number of tracks we added to the playlist, None if it has to be requested
+    """
+
+    __slots__ = ("id", "name", "num_tracks")
+
+    def __init__(self, playlist_id: str, name: str, num_tracks: int = None):
+        self.id = playlist_id
+        self.name = name
+        self.num_tracks = num_tracks
+
+    def __repr__(self):
+        return "FeedPlaylist({!r}, {!r}, {!r})".format(self.id, self.name, self.num_tracks)
+
+
+class FeedRouter:
+    """
+    Decides to which playlists new tracks are added.
+
+    Tracks are first routed to a named feed, depending on the mode:
+        "single": all tracks go to the default feed
+        "monthly": tracks go to a feed per month, e.g. "SpotifySubscriber 2020-01"
+        "source": tracks of the subscribed playlists in the routing table go to the feed named there,
+            the others go to the default feed
+    Every feed is a chain of playlists. Tracks are added to the last playlist of the chain until it holds
+    max_tracks tracks, after which a new playlist is created, since Spotify playlists hold at most 10,000 tracks
+    and large playlists are slow to load. If max_tracks is None, feeds never roll over.
+
+    Attributes:
+    mode (str): one of the modes above
+    max_tracks (int): number of tracks after which a feed rolls over into a new playlist
+    default_name (str): name of the default feed
+    routes (dict): feed names by subscribed playlist ID, used in the "source" mode
+    feeds (dict): lists of FeedPlaylists by feed name, in the order in which they were created
+    """
+
+    modes = ("single", "monthly", "source")
+    default_max_tracks = 9500
+
+    def __init__(
+        self,
+        default_id: str,
+        default_name: str,
+        mode: str = "single",
+        max_tracks: int = default_max_tracks,
+    ):
+        self.set_mode(mode, max_tracks)
+        self.default_name = default_name
+        self.routes = {}
+        self.feeds = {default_name: [FeedPlaylist(default_id, default_name)]}
+
+    def set_mode(self, mode: str, max_tracks: int = default_max_tracks):
+        if mode not in self.modes:
+            raise ValueError(
+                "Unknown feed mode {}, choose one of {}.".format(mode, ", ".join(self.modes))
+            )
+        self.mode = mode
+        self.max_tracks = max_tracks
+
+    # Name of the feed that tracks of the source playlist, found at the given time, should be added to
+    def feed_name(self, source_id: str, time: datetime) -> str:
+        if self.mode == "monthly":
+            return "{} {:%Y-%m}".format(self.default_name, time)
+        if self.mode == "source":
+            return self.routes.get(source_id, self.default_name)
+        return self.default_name
+
+    # IDs of all playlists of all feeds
+    def playlist_ids(self) -> set:
+        return {playlist.id for chain in self.feeds.values() for playlist in chain}
+
+    # Forget the number of tracks of a playlist, e.g. after an interrupted update, so it is requested again
+    def invalidate(self, playlist_id: str):
+        for chain in self.feeds.values():
+            for playlist in chain:
+                if playlist.id == playlist_id:
+                    playlist.num_tracks = None
+
+    def route(self, source_ids: list, feed_name: str):
+        for source_id in source_ids:
+            self.routes[source_id] = feed_name
+
+    def unroute(self, source_ids: list):
+        for source_id in source_ids:
+            self.routes.pop(source_id, None)
+
+    def assign(self, track_ids: list, sources: dict, time: datetime, create_playlist, count_tracks) -> list:
+        """
+        Return (FeedPlaylist, track IDs) pairs that spread the tracks over the feeds, in the order of track_ids.
+        Sources holds the ID of the subscribed playlist every track was found in.
+        Create_playlist is called with a name to create a new FeedPlaylist, and count_tracks with a playlist ID to
+        request its number of tracks if we do not know it, or if the playlist seems to be full.
+        """
+        by_feed = {}
+        for track_id in track_ids:
+            by_feed.setdefault(self.feed_name(sources.get(track_id), time), []).append(track_id)
+
+        assignments = []
+        counted = set()
+        for name, remaining in by_feed.items():
+            chain = self.feeds.setdefault(name, [])
+            while remaining:
+                if not chain:
+                    chain.append(create_playlist(name))
+                playlist = chain[-1]
+
+                # The count is also kept if feeds never roll over, so it is known when max_tracks is set again
+                if playlist.num_tracks is None:
+                    playlist.num_tracks = count_tracks(playlist.id)
+                    counted.add(playlist.id)
+
+                space = len(remaining)
+                if self.max_tracks is not None:
+                    # Our count may be off if tracks were removed from the playlist, so check it before rolling over
+                    if playlist.num_tracks + len(remaining) > self.max_tracks and playlist.id not in counted:
+                        playlist.num_tracks = count_tracks(playlist.id)
+                        counted.add(playlist.id)
+                    space = max(self.max_tracks - playlist.num_tracks, 0)
+
+                if space > 0:
+                    assignments.append((playlist, remaining[:space]))
+                    remaining = remaining[space:]
+                # The rest does not fit in the playlist
+                if remaining:
+                    chain.append(create_playlist("{} ({})".format(name, len(chain) + 1)))
+        return assignments
@@ -0,0 +1,129 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from requests.exceptions import RequestException
+from spotipy.client import SpotifyException
+
+
+class FeedWriter:
+    """
+    Adds tracks to a playlist, or removes them, in batches of at most 100 tracks, which is the API limit for a
+    single request.
+
+    Several batches are sent concurrently. Requests that fail because of rate limiting (429), server errors (5xx)
+    or connection problems are retried, waiting for the Retry-After time if the API provides one and backing off
+    exponentially otherwise. For every batch, the number of tracks, number of attempts and latency are recorded.
+
+    Attributes:
+    batch_stats (list): dicts with the size, attempts, latency (s) and throughput (tracks/s) of every written batch
+    """
+
+    batch_size = 100
+
+    def __init__(
+        self,
+        spotify,
+        user_id: str,
+        playlist_id: str,
+        max_in_flight: int = 4,
+        max_retries: int = 5,
+        backoff: float = 1.0,
+    ):
+        self.sp = spotify
+        self.user_id = user_id
+        self.playlist_id = playlist_id
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.batch_stats = []
+
+    # Return how long to wait before retrying after the given error, or None if it should not be retried.
+    def _retry_delay(self, error: Exception, attempt: int):
+        if isinstance(error, SpotifyException):
+            if error.http_status == 429:
+                headers = getattr(error, "headers", None) or {}
+                try:
+                    return float(headers["Retry-After"])
+                except (KeyError, TypeError, ValueError):
+                    pass
+            elif error.http_status is None or error.http_status < 500:
+                return None
+
+        return self.backoff * 2 ** attempt
+
+    def _write_batch(self, track_ids: list, remove: bool = False):
+        start = time.perf_counter()
+        attempt = 0
+        while True:
+            try:
+                if remove:
+                    self.sp.user_playlist_remove_all_occurrences_of_tracks(
+                        self.user_id, self.playlist_id, track_ids
+                    )
+                else:
+                    self.sp.user_playlist_add_tracks(self.user_id, self.playlist_id, track_ids)
+                break
+            except (SpotifyException, RequestException) as error:
+                delay = self._retry_delay(error, attempt)
+                if delay is None or attempt >= self.max_retries:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+
+        latency = time.perf_counter() - start
+        return {
+            "size": len(track_ids),
+            "attempts": attempt + 1,
+            "latency": latency,
+            "throughput": len(track_ids) / latency if latency > 0 else float("inf"),
+        }
+
+    # Add the tracks to the playlist. Calls on_written with the IDs of every batch as soon as it was written
+    # (from the calling thread), and returns the IDs of all tracks that were written successfully.
+    def write(self, track_ids, on_written=None) -> list:
+        return self._send(track_ids, on_written, remove=False)
+
+    # Remove all occurrences of the tracks from the playlist. Like write, calls on_removed for every batch and
+    # returns the IDs of all tracks that were removed successfully.
+    def remove(self, track_ids, on_removed=None) -> list:
+        return self._send(track_ids, on_removed, remove=True)
+
+    def _send(self, track_ids, on_sent, remove: bool) -> list:
+        track_ids = [str(track_id) for track_id in track_ids]
+        batches = [
+            track_ids[start : start + self.batch_size]
+            for start in range(0, len(track_ids), self.batch_size)
+        ]
+
+        written = []
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            futures = {executor.submit(self._write_batch, batch, remove): batch for batch in batches}
+            for future in as_completed(futures):
+                batch = futures[future]
+                try:
+                    self.batch_stats.append(future.result())
+                except (SpotifyException, RequestException) as error:
+                    print(
+                        "WARNING: failed to {} {} tracks {} the feed: {}".format(
+                            "remove" if remove else "add", len(batch), "from" if remove else "to", error
+                        )
+                    )
+                    continue
+
+                written += batch
+                if on_sent is not None:
+                    on_sent(batch)
+
+        return written
+
+    # Summary of the batches written so far
+    def summary(self) -> dict:
+        num_tracks = sum(stats["size"] for stats in self.batch_stats)
+        total_latency = sum(stats["latency"] for stats in self.batch_stats)
+        return {
+            "batches": len(self.batch_stats),
+            "tracks": num_tracks,
+            "retries": sum(stats["attempts"] - 1 for stats in self.batch_stats),
+            "mean_latency": total_latency / len(self.batch_stats) if self.batch_stats else 0.0,
+            "max_latency": max((stats["latency"] for stats in self.batch_stats), default=0.0),
+        }
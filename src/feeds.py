@@ -0,0 +1,48 @@
+import argparse
+
+from SpotifySubscriber import SpotifySubscriber
+from feed_router import FeedRouter
+
+
+def main(args):
+    spotify = SpotifySubscriber(load_playlists = False, lock_timeout = args.lock_timeout)
+
+    if args.mode is not None:
+        max_tracks = args.max_tracks if args.max_tracks > 0 else None
+        spotify.set_feed_mode(args.mode, max_tracks = max_tracks)
+
+    if args.playlists:
+        if args.unroute:
+            if args.id:
+                spotify.unroute_playlists(playlist_ids = args.playlists)
+            else:
+                spotify.unroute_playlists(contains = args.playlists)
+        elif args.to is not None:
+            if args.id:
+                spotify.route_playlists(args.to, playlist_ids = args.playlists)
+            else:
+                spotify.route_playlists(args.to, contains = args.playlists)
+        else:
+            raise Exception("Specify the feed to route the playlists to with --to, or use --unroute.")
+
+    spotify.print_feeds()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Choose how new songs are spread over feed playlists, and print the feeds.')
+    parser.add_argument('playlists', type = str, nargs = '*', help = 'Names of subscribed playlists to route to the feed given \
+        by --to. Partial names also work, and names can be prefixed with "re:" or "glob:" as in subscribe.py.')
+    parser.add_argument('--to', type = str, default = None, help = 'Name of the feed to add the new songs of the playlists to. \
+        Only used in the "source" mode.')
+    parser.add_argument('--unroute', action = 'store_true', help = 'Add the new songs of the playlists to the default feed again.')
+    parser.add_argument('--id', action = 'store_true', help = 'The provided names are playlist IDs rather than name patterns.')
+    parser.add_argument('--mode', type = str, default = None, choices = FeedRouter.modes, help = 'Add all new songs to a \
+        single feed, to a feed per month, or to the feed their source playlist is routed to.')
+    parser.add_argument('--max_tracks', type = int, default = FeedRouter.default_max_tracks, help = 'Start a new playlist \
+        for a feed once it holds this many tracks (Spotify allows at most 10,000). Use 0 to never roll over. Only used with --mode.')
+    parser.add_argument('--lock_timeout', type = float, default = None, help = 'Give up after this many seconds if \
+        another run (e.g. the daemon) keeps using the storage dir. Waits until it is done by default.')
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,132 @@
+import os
+import numpy as np
+
+from utils import atomic_write
+
+
+class LibraryIndex:
+    """
+    Index of the tracks the user already has: the tracks saved in their library and the tracks in the playlists
+    they own. Update_feed uses it to skip new tracks that the user has anyway.
+
+    The index is stored in library_index.npz and kept up to date incrementally by SpotifySubscriber:
+    the saved tracks are listed newest first, so usually only the tracks saved after the newest one in the index
+    (the watermark) are requested. Own playlists are only read again when their snapshot changed.
+    Track IDs are kept as sorted fixed-width byte strings, so large libraries are checked with a binary search.
+
+    Attributes:
+    saved_watermark (int): UTC timestamp (in seconds) at which the newest track in the index was saved, 0 if none
+    """
+
+    filename = "library_index.npz"
+    id_dtype = np.dtype("S22")
+
+    def __init__(self, storage_dir: str):
+        self.path = os.path.join(storage_dir, self.filename)
+        self.saved_watermark = 0
+        self._saved_ids = np.empty(0, dtype=self.id_dtype)
+        # Snapshot ID and sorted track IDs by own playlist ID
+        self._playlists = {}
+        self._all_ids = None
+
+        if os.path.exists(self.path):
+            self._load()
+
+    def _load(self):
+        with np.load(self.path) as data:
+            self._saved_ids = data["saved_ids"]
+            self.saved_watermark = int(data["saved_watermark"])
+            offsets = data["playlist_offsets"]
+            track_ids = data["playlist_track_ids"]
+            for position, (playlist_id, snapshot) in enumerate(
+                zip(data["playlist_ids"].tolist(), data["playlist_snapshots"].tolist())
+            ):
+                self._playlists[playlist_id] = (
+                    snapshot,
+                    track_ids[offsets[position] : offsets[position + 1]],
+                )
+
+    def save(self):
+        playlists = list(self._playlists.items())
+        lengths = [len(track_ids) for _, (_, track_ids) in playlists]
+        with atomic_write(self.path) as index_file:
+            np.savez(
+                index_file,
+                saved_ids=self._saved_ids,
+                saved_watermark=np.int64(self.saved_watermark),
+                playlist_ids=np.array([playlist_id for playlist_id, _ in playlists], dtype=str),
+                playlist_snapshots=np.array([snapshot for _, (snapshot, _) in playlists], dtype=str),
+                playlist_track_ids=np.concatenate(
+                    [track_ids for _, (_, track_ids) in playlists] + [np.empty(0, dtype=self.id_dtype)]
+                ),
+                playlist_offsets=np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)]),
+            )
+
+    # Convert track IDs to sorted, unique fixed-width byte strings
+    def _encode(self, track_ids) -> np.ndarray:
+        track_ids = np.asarray(track_ids)
+        if track_ids.size == 0:
+            return np.empty(0, dtype=self.id_dtype)
+        if track_ids.dtype.kind == "U":
+            track_ids = np.char.encode(track_ids, "ascii")
+        return np.unique(track_ids.astype(self.id_dtype))
+
+    @property
+    def num_saved(self) -> int:
+        return len(self._saved_ids)
+
+    # Merge newly saved tracks into the index, which were saved up to the watermark.
+    def add_saved(self, track_ids, watermark: int):
+        self._saved_ids = np.union1d(self._saved_ids, self._encode(track_ids))
+        self.saved_watermark = max(self.saved_watermark, watermark)
+        self._all_ids = None
+
+    # Replace all saved tracks, after listing the entire library.
+    def replace_saved(self, track_ids, watermark: int):
+        self._saved_ids = self._encode(track_ids)
+        self.saved_watermark = watermark
+        self._all_ids = None
+
+    # Number of saved tracks the index would hold after adding these
+    def num_saved_with(self, track_ids) -> int:
+        return len(np.union1d(self._saved_ids, self._encode(track_ids)))
+
+    @property
+    def playlist_ids(self) -> list:
+        return list(self._playlists)
+
+    # Snapshot ID at which the own playlist was indexed, None if it is not in the index
+    def snapshot(self, playlist_id: str) -> str:
+        entry = self._playlists.get(playlist_id)
+        return entry[0] if entry is not None else None
+
+    def set_playlist(self, playlist_id: str, snapshot: str, track_ids):
+        self._playlists[playlist_id] = (snapshot, self._encode(track_ids))
+        self._all_ids = None
+
+    def remove_playlist(self, playlist_id: str):
+        if self._playlists.pop(playlist_id, None) is not None:
+            self._all_ids = None
+
+    # Return a boolean array that denotes which of the track IDs the user has saved or in an own playlist.
+    def contains(self, track_ids) -> np.ndarray:
+        if self._all_ids is None:
+            self._all_ids = np.unique(
+                np.concatenate([self._saved_ids] + [track_ids for _, track_ids in self._playlists.values()])
+            )
+        return self._search(self._all_ids, track_ids)
+
+    # Return a boolean array that denotes which of the track IDs the user has saved in their library.
+    def contains_saved(self, track_ids) -> np.ndarray:
+        return self._search(self._saved_ids, track_ids)
+
+    def _search(self, sorted_ids: np.ndarray, track_ids) -> np.ndarray:
+        keys = np.asarray(track_ids)
+        if keys.dtype.kind == "U":
+            keys = np.char.encode(keys, "ascii")
+        keys = keys.astype(self.id_dtype)
+        if sorted_ids.size == 0 or keys.size == 0:
+            return np.zeros(keys.shape, dtype=bool)
+
+        positions = np.minimum(np.searchsorted(sorted_ids, keys), sorted_ids.size - 1)
+        return sorted_ids[positions] == keys
@@ -0,0 +1,189 @@
+import re
+import socket
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+from utils import atomic_write
+
+# Path segments that follow these segments are IDs, which are replaced to group requests by endpoint
+_id_parents = {"users", "playlists", "tracks", "albums", "artists"}
+_statsd_invalid = re.compile(r"[^A-Za-z0-9_]+")
+
+
+# Group a request by its method and path without IDs, e.g. "GET /v1/playlists/{id}/tracks"
+def endpoint_name(method: str, path: str) -> str:
+    segments = path.split("/")
+    for index in range(1, len(segments)):
+        if segments[index - 1] in _id_parents and segments[index]:
+            segments[index] = "{id}"
+    return "{} {}".format(method.upper(), "/".join(segments))
+
+
+# Parse a "host:port" address, e.g. of a StatsD server
+def parse_address(address: str) -> tuple:
+    host, _, port = address.rpartition(":")
+    if not host or not port.isdigit():
+        raise ValueError("Address {} should be of the form host:port.".format(address))
+    return host, int(port)
+
+
+class Metrics:
+    """
+    Instrumentation of a run: the time spent in every phase, the number of requests and bytes received per API
+    endpoint, and the number of pages of tracks requested per playlist.
+    When disabled, all methods return immediately, so the instrumentation can stay in place at no noticeable cost.
+
+    Attributes:
+    enabled (bool): whether anything is recorded
+    prometheus_path (str): if set, emit writes the metrics to this file in the Prometheus textfile format
+    statsd_address (tuple): if set, emit sends the metrics to this (host, port) in the StatsD format
+    prefix (str): prefix of all metric names
+    """
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        prometheus_path: str = None,
+        statsd_address: tuple = None,
+        prefix: str = "spotify_subscriber",
+    ):
+        self.enabled = enabled
+        self.prometheus_path = prometheus_path
+        self.statsd_address = statsd_address
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self._phases = {}
+        self._requests = {}
+        self._received_bytes = {}
+        self._pages = {}
+        self._started = time.time()
+
+    # Time the code in the with block, and add it to the total time of the phase.
+    def phase(self, name: str):
+        if not self.enabled:
+            return nullcontext()
+        return self._timed_phase(name)
+
+    @contextmanager
+    def _timed_phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self._lock:
+                total, count = self._phases.get(name, (0.0, 0))
+                self._phases[name] = (total + seconds, count + 1)
+
+    def count_request(self, endpoint: str, num_bytes: int = 0):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._requests[endpoint] = self._requests.get(endpoint, 0) + 1
+            self._received_bytes[endpoint] = self._received_bytes.get(endpoint, 0) + num_bytes
+
+    def count_page(self, playlist_id: str):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._pages[playlist_id] = self._pages.get(playlist_id, 0) + 1
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {
+                "started": self._started,
+                "duration": time.time() - self._started,
+                "phases": {
+                    name: {"seconds": total, "count": count}
+                    for name, (total, count) in self._phases.items()
+                },
+                "requests": dict(self._requests),
+                "received_bytes": dict(self._received_bytes),
+                "total_requests": sum(self._requests.values()),
+                "total_received_bytes": sum(self._received_bytes.values()),
+                "pages": dict(self._pages),
+            }
+
+    # Write the summary to the configured outputs, and start recording a new run.
+    def emit(self, summary: dict = None):
+        if not self.enabled:
+            return
+        summary = summary or self.summary()
+        if self.prometheus_path:
+            self.write_prometheus(summary)
+        if self.statsd_address:
+            self.send_statsd(summary)
+        self.reset()
+
+    # Write the summary in the Prometheus textfile format, e.g. for the textfile collector of the node exporter.
+    def write_prometheus(self, summary: dict):
+        prefix = self.prefix
+
+        def escape(value):
+            return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+        lines = [
+            "# TYPE {}_phase_seconds gauge".format(prefix),
+            *[
+                '{}_phase_seconds{{phase="{}"}} {}'.format(prefix, escape(name), phase["seconds"])
+                for name, phase in summary["phases"].items()
+            ],
+            "# TYPE {}_api_requests gauge".format(prefix),
+            *[
+                '{}_api_requests{{endpoint="{}"}} {}'.format(prefix, escape(endpoint), count)
+                for endpoint, count in summary["requests"].items()
+            ],
+            "# TYPE {}_api_received_bytes gauge".format(prefix),
+            *[
+                '{}_api_received_bytes{{endpoint="{}"}} {}'.format(prefix, escape(endpoint), size)
+                for endpoint, size in summary["received_bytes"].items()
+            ],
+            "# TYPE {}_playlist_pages gauge".format(prefix),
+            *[
+                '{}_playlist_pages{{playlist="{}"}} {}'.format(prefix, escape(playlist_id), count)
+                for playlist_id, count in summary["pages"].items()
+            ],
+            "# TYPE {}_last_run_timestamp_seconds gauge".format(prefix),
+            "{}_last_run_timestamp_seconds {}".format(prefix, summary["started"]),
+            "# TYPE {}_run_duration_seconds gauge".format(prefix),
+            "{}_run_duration_seconds {}".format(prefix, summary["duration"]),
+        ]
+
+        # The collector may read the file at any time, so replace it at once.
+        with atomic_write(self.prometheus_path, "w") as metrics_file:
+            metrics_file.write("\n".join(lines) + "\n")
+
+    # Send the summary to a StatsD server over UDP, as timers (phases) and counters.
+    def send_statsd(self, summary: dict):
+        def name(*parts):
+            return ".".join([self.prefix] + [_statsd_invalid.sub("_", part).strip("_") for part in parts])
+
+        lines = [
+            "{}:{:.3f}|ms".format(name("phase", phase), values["seconds"] * 1000)
+            for phase, values in summary["phases"].items()
+        ]
+        lines += [
+            "{}:{}|c".format(name("requests", endpoint), count)
+            for endpoint, count in summary["requests"].items()
+        ]
+        lines += [
+            "{}:{}|c".format(name("received_bytes", endpoint), size)
+            for endpoint, size in summary["received_bytes"].items()
+        ]
+        lines.append("{}:{}|c".format(name("pages"), sum(summary["pages"].values())))
+
+        # Keep packets small enough to not be fragmented
+        packets = [[]]
+        for line in lines:
+            if sum(len(packet_line) + 1 for packet_line in packets[-1]) + len(line) > 1400:
+                packets.append([])
+            packets[-1].append(line)
+
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as statsd_socket:
+            for packet in packets:
+                if packet:
+                    statsd_socket.sendto("\n".join(packet).encode("utf-8"), self.statsd_address)
@@ -0,0 +1,65 @@
+import re
+from collections import defaultdict
+from fnmatch import fnmatchcase
+
+
+class PlaylistNameIndex:
+    """
+    Index of the lowercase names of playlists, to match many name patterns at once.
+
+    Patterns are matched case-insensitively, and can take three forms:
+        "re:<regex>": the regular expression matches part of the name, e.g. "re:^release (radar|wave)"
+        "glob:<pattern>": the whole name matches the shell-style wildcard pattern, e.g. "glob:*radar"
+        anything else: the pattern is part of the name
+    Plain patterns of at least three characters are looked up in a trigram index, so only the names that
+    contain all trigrams of the pattern are compared with it.
+
+    Attributes:
+    playlists (dict): the indexed playlists by ID, which should have a name attribute
+    """
+
+    def __init__(self, playlists: dict):
+        self.playlists = playlists
+        self._ids = list(playlists.keys())
+        self._names = [playlist.name.lower() for playlist in playlists.values()]
+
+        # Positions of the names that contain each trigram
+        self._trigrams = defaultdict(set)
+        for position, name in enumerate(self._names):
+            for trigram in self._split(name):
+                self._trigrams[trigram].add(position)
+
+    @staticmethod
+    def _split(text: str) -> set:
+        return {text[start : start + 3] for start in range(len(text) - 2)}
+
+    # Positions of the names that match a single pattern
+    def _match_pattern(self, pattern: str) -> set:
+        if pattern.startswith("re:"):
+            regex = re.compile(pattern[3:], re.IGNORECASE)
+            return {
+                position for position, name in enumerate(self._names) if regex.search(name)
+            }
+
+        if pattern.startswith("glob:"):
+            glob = pattern[5:].lower()
+            return {
+                position
+                for position, name in enumerate(self._names)
+                if fnmatchcase(name, glob)
+            }
+
+        pattern = pattern.lower()
+        if len(pattern) < 3:
+            candidates = range(len(self._names))
+        else:
+            trigram_positions = [self._trigrams.get(trigram, set()) for trigram in self._split(pattern)]
+            candidates = set.intersection(*trigram_positions)
+        return {position for position in candidates if pattern in self._names[position]}
+
+    # Return the IDs of the playlists that match any of the patterns, in the order of the playlists dict.
+    def match(self, patterns: list) -> list:
+        positions = set()
+        for pattern in patterns:
+            positions |= self._match_pattern(pattern)
+        return [self._ids[position] for position in sorted(positions)]
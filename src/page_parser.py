@@ -0,0 +1,37 @@
+import numpy as np
+from datetime import datetime
+
+from classes import Track
+
+
+# Parse the added_at times of the items of a page at once. Items without a date (which very old playlists have)
+# get NaT.
+def added_at_array(items: list) -> np.ndarray:
+    # The times are in UTC, numpy parses them without the Z
+    return np.array(
+        [item["added_at"][:-1] if item["added_at"] else "NaT" for item in items],
+        dtype="datetime64[s]",
+    )
+
+
+# Return a boolean array that denotes which items were added after min_timestamp and have a track.
+# Items without a date may be new, so they are included.
+def new_item_mask(items: list, added_at: np.ndarray, min_timestamp: datetime) -> np.ndarray:
+    mask = (added_at > np.datetime64(min_timestamp, "s")) | np.isnat(added_at)
+    has_track = np.array(
+        [item["track"] is not None and item["track"]["id"] is not None for item in items], dtype=bool
+    )
+    num_empty = int(np.count_nonzero(mask & ~has_track))
+    for _ in range(num_empty):
+        # Somehow, it's possible that we receive an empty track. IDK if this is a spotipy bug or what
+        print("WARNING: encountered None track! Ignoring.")
+    return mask & has_track
+
+
+# Return the Tracks of the items of a page that were added after min_timestamp, in the order of the page.
+# Only the items that pass the filter are converted into Tracks.
+def parse_new_tracks(items: list, playlist_id: str, min_timestamp: datetime) -> list:
+    if not items:
+        return []
+    mask = new_item_mask(items, added_at_array(items), min_timestamp)
+    return [Track(items[position], playlist_id) for position in np.flatnonzero(mask)]
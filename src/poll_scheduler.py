@@ -0,0 +1,88 @@
+from datetime import datetime, timedelta
+
+
+class PollScheduler:
+    """
+    Decides which subscribed playlists are checked in an update of the feed, based on how often they had new tracks.
+
+    Every subscription has a check interval, and is due once that much time passed since it was last checked.
+    If a check finds new tracks, the interval is reset to 0, so the playlist is checked on every update while it
+    keeps changing. Otherwise the interval is multiplied by backoff, staying between min_interval and max_interval.
+    This includes playlists that change their snapshot without adding tracks, like 'Brain Food'. So the cost of an
+    update scales with the number of playlists that actually get new tracks, rather than with the number of
+    subscriptions. A max_interval of 0 checks every subscription on every update.
+
+    If request_budget is set, the due playlists are checked from the most overdue one, until the requests they are
+    expected to take would exceed the budget. The others stay due, so they go first in the next update.
+
+    Attributes:
+    min_interval (timedelta): interval after the first check that found nothing
+    max_interval (timedelta): longest interval between checks
+    backoff (float): factor by which the interval grows after every check that found nothing
+    request_budget (int): number of requests an update may take, None for no limit
+    """
+
+    def __init__(
+        self,
+        min_interval: timedelta = timedelta(hours=1),
+        max_interval: timedelta = timedelta(days=7),
+        backoff: float = 2.0,
+        request_budget: int = None,
+    ):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.request_budget = request_budget
+
+    # The time that passed since the playlist was last checked, divided by its interval. Playlists are due at 1.
+    def _overdue(self, playlist, now: datetime) -> float:
+        if playlist.last_checked is None:
+            return float("inf")
+        interval = min(playlist.check_interval or timedelta(0), self.max_interval)
+        elapsed = now - playlist.last_checked
+        if interval <= timedelta(0):
+            return float("inf")
+        return elapsed / interval
+
+    # Number of requests that checking the playlist is expected to take: one for the snapshot, and the pages of
+    # tracks if the snapshot changed, in the same fraction of checks as before.
+    @staticmethod
+    def expected_requests(playlist) -> float:
+        if playlist.num_checks == 0:
+            return 2.0
+        change_rate = playlist.num_changes / playlist.num_checks
+        new_per_change = playlist.num_new_tracks / max(playlist.num_changes, 1)
+        return 1.0 + change_rate * (1.0 + new_per_change / 100)
+
+    # Return the due playlists that fit in the request budget, most overdue first, and the number of due playlists
+    # that were postponed because of the budget.
+    def due(self, playlists: list, now: datetime):
+        overdue = [(self._overdue(playlist, now), playlist) for playlist in playlists]
+        due = [playlist for ratio, playlist in sorted(overdue, key=lambda item: -item[0]) if ratio >= 1]
+        if self.request_budget is None:
+            return due, 0
+
+        selected = []
+        spent = 0.0
+        for playlist in due:
+            cost = self.expected_requests(playlist)
+            # Always check at least one playlist, so a small budget cannot stop the updates altogether
+            if selected and spent + cost > self.request_budget:
+                break
+            selected.append(playlist)
+            spent += cost
+        return selected, len(due) - len(selected)
+
+    # Update the history and interval of the playlist after a check. Changed denotes whether its snapshot changed.
+    def record(self, playlist, changed: bool, num_new_tracks: int, now: datetime):
+        playlist.num_checks += 1
+        if changed:
+            playlist.num_changes += 1
+        playlist.num_new_tracks += num_new_tracks
+        playlist.last_checked = now
+
+        if num_new_tracks > 0:
+            playlist.check_interval = timedelta(0)
+        else:
+            interval = (playlist.check_interval or timedelta(0)) * self.backoff
+            playlist.check_interval = min(max(interval, self.min_interval), self.max_interval)
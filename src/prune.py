@@ -0,0 +1,39 @@
+import argparse
+from datetime import timedelta
+
+from SpotifySubscriber import SpotifySubscriber
+from feed_retention import RetentionPolicy
+
+
+def main(args):
+    policy = RetentionPolicy(
+        max_age = timedelta(days = args.max_age) if args.max_age is not None else None,
+        max_count = args.max_count,
+        remove_saved = args.remove_saved)
+    if not policy:
+        raise Exception("Nothing to remove, specify --max_age, --max_count or --remove_saved.")
+
+    spotify = SpotifySubscriber(load_playlists = False, lock_timeout = args.lock_timeout)
+    num_removed = spotify.prune_feed(policy, dry_run = args.dry_run, max_workers = args.workers)
+    if args.dry_run:
+        print("Would remove {} tracks.".format(num_removed))
+    else:
+        print("Removed {} tracks.".format(num_removed))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Remove old tracks from the subscription feeds.')
+    parser.add_argument("--max_age", type = float, default = None, help = "Remove tracks that were added to " + \
+        "the feed more than this many days ago.")
+    parser.add_argument("--max_count", type = int, default = None, help = "Keep only this many of the newest " + \
+        "tracks in every feed.")
+    parser.add_argument("--remove_saved", action = "store_true", help = "Remove tracks that you saved in " + \
+        "your library.")
+    parser.add_argument("--dry_run", action = "store_true", help = "Only print which tracks would be removed.")
+    parser.add_argument("--workers", type = int, default = 4, help = "Number of batches of tracks " + \
+        "to remove concurrently.")
+    parser.add_argument("--lock_timeout", type = float, default = None, help = "Give up after this many " + \
+        "seconds if another run (e.g. the daemon) keeps using the storage dir. Waits until it is done by default.")
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,119 @@
+import threading
+import time
+
+
+class RateLimiter:
+    """
+    Token bucket that limits the rate of requests to the API. It is thread-safe, so one limiter can be shared by
+    all sessions of all users, which then share the same request budget.
+
+    The rate adapts to the responses of the API: when a request is rate limited (429), the rate is halved and no
+    requests are sent until the Retry-After time has passed. Every successful request increases the rate again,
+    by about increase requests per second for every second of traffic, up to max_rate.
+    Writes are prioritised: while a write is waiting for a token, reads are not sent.
+
+    Attributes:
+    rate (float): number of requests per second that are currently allowed on average
+    max_rate (float): the rate never increases beyond this
+    min_rate (float): the rate never decreases below this
+    burst (int): number of requests that may be sent at once after a quiet period
+    """
+
+    def __init__(
+        self,
+        rate: float = 10.0,
+        burst: int = 20,
+        max_rate: float = None,
+        min_rate: float = 0.5,
+        increase: float = 0.5,
+    ):
+        self.rate = rate
+        self.max_rate = rate if max_rate is None else max_rate
+        self.min_rate = min_rate
+        self.increase = increase
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._last_decrease = 0.0
+        self._waiting_writes = 0
+        self._condition = threading.Condition()
+
+        # Counters, see stats()
+        self._requests = 0
+        self._throttled_requests = 0
+        self._rate_limited = 0
+        self._throttled_time = 0.0
+        self._wire_time = 0.0
+
+    # Add the tokens that accumulated since the last update. Must be called while holding the lock.
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    # Wait until a request may be sent, and return how long we waited in seconds.
+    def acquire(self, write: bool = False) -> float:
+        start = time.monotonic()
+        with self._condition:
+            if write:
+                self._waiting_writes += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if now < self._blocked_until:
+                        wait = self._blocked_until - now
+                    elif self._tokens < 1:
+                        wait = (1 - self._tokens) / self.rate
+                    elif not write and self._waiting_writes > 0:
+                        # Woken up when the write got its token
+                        wait = None
+                    else:
+                        self._tokens -= 1
+                        break
+                    self._condition.wait(wait)
+            finally:
+                if write:
+                    self._waiting_writes -= 1
+                    self._condition.notify_all()
+
+            waited = time.monotonic() - start
+            self._requests += 1
+            self._throttled_time += waited
+            if waited > 0.001:
+                self._throttled_requests += 1
+        return waited
+
+    # Adapt the rate to the response to a request. Status is None if the request failed without a response.
+    def record_response(self, status: int, retry_after: str = None, elapsed: float = 0.0):
+        with self._condition:
+            self._wire_time += elapsed
+            now = time.monotonic()
+            if status == 429:
+                self._rate_limited += 1
+                try:
+                    delay = float(retry_after)
+                except (TypeError, ValueError):
+                    delay = 1 / self.rate
+                self._blocked_until = max(self._blocked_until, now + delay)
+                self._tokens = 0.0
+
+                # Concurrent requests are often limited together, so only decrease once per blocked period
+                if now - self._last_decrease > delay:
+                    self.rate = max(self.min_rate, self.rate / 2)
+                    self._last_decrease = now
+            elif status is not None and status < 500:
+                self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+    # Number of requests, how many of them had to wait and were rate limited, and the total time (in seconds)
+    # requests spent waiting for the limiter (throttled) and waiting for the API (wire).
+    def stats(self) -> dict:
+        with self._condition:
+            return {
+                "requests": self._requests,
+                "throttled_requests": self._throttled_requests,
+                "rate_limited": self._rate_limited,
+                "throttled_time": self._throttled_time,
+                "wire_time": self._wire_time,
+                "rate": self.rate,
+            }
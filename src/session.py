@@ -0,0 +1,236 @@
+import os
+import json
+import hashlib
+import threading
+import time
+from urllib.parse import urlencode, urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+from requests.structures import CaseInsensitiveDict
+from urllib3.util.retry import Retry
+
+from rate_limit import RateLimiter
+from metrics import Metrics, endpoint_name
+
+
+class ResponseCache:
+    """
+    On-disk cache of API responses and their ETags, bounded to max_bytes.
+
+    Every response is stored in its own file. When the cache grows beyond max_bytes, the least recently used
+    responses are removed. The modification time of a file is updated whenever it is used.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        # Size and last use of every cached file
+        self._entries = {}
+        for filename in os.listdir(cache_dir):
+            path = os.path.join(cache_dir, filename)
+            self._entries[filename] = (os.path.getsize(path), os.path.getmtime(path))
+        self._size = sum(size for size, _ in self._entries.values())
+
+    @staticmethod
+    def key(url: str, params: dict = None) -> str:
+        if params:
+            url += "?" + urlencode(sorted(params.items()))
+        return hashlib.sha1(url.encode("utf-8")).hexdigest() + ".json"
+
+    def get(self, key: str):
+        path = os.path.join(self.cache_dir, key)
+        with self._lock:
+            if key not in self._entries:
+                return None
+            try:
+                with open(path, "r") as cache_file:
+                    entry = json.load(cache_file)
+                os.utime(path)
+            except (OSError, ValueError):
+                self._remove(key)
+                return None
+            self._entries[key] = (self._entries[key][0], os.path.getmtime(path))
+        return entry
+
+    def put(self, key: str, etag: str, response: requests.Response):
+        data = json.dumps(
+            {
+                "etag": etag,
+                "content_type": response.headers.get("Content-Type"),
+                "body": response.text,
+            }
+        ).encode("utf-8")
+        # Don't bother caching responses that would evict everything else
+        if len(data) > self.max_bytes / 4:
+            return
+
+        path = os.path.join(self.cache_dir, key)
+        with self._lock:
+            if key in self._entries:
+                self._size -= self._entries[key][0]
+            with open(path, "wb") as cache_file:
+                cache_file.write(data)
+            self._entries[key] = (len(data), os.path.getmtime(path))
+            self._size += len(data)
+            self._evict()
+
+    def _remove(self, key: str):
+        size, _ = self._entries.pop(key)
+        self._size -= size
+        try:
+            os.remove(os.path.join(self.cache_dir, key))
+        except OSError:
+            pass
+
+    # Remove the least recently used entries until the cache fits in max_bytes again
+    def _evict(self):
+        if self._size <= self.max_bytes:
+            return
+        for key, _ in sorted(self._entries.items(), key=lambda item: item[1][1]):
+            self._remove(key)
+            if self._size <= self.max_bytes:
+                break
+
+
+class SpotifySession(requests.Session):
+    """
+    Requests session that keeps up to pool_size connections to the API alive, so that concurrent requests
+    do not have to set up a new connection each time.
+
+    If a rate limiter is provided, every request waits for it before being sent, and the limiter adapts its rate to
+    the responses. Requests that are rate limited (429) are sent again up to rate_limit_retries times.
+    If metrics are provided, every request that is sent is counted by endpoint, together with the size of the response.
+    If a cache is provided, GET requests for playlists and tracks are sent with the ETag of the cached response.
+    If the API replies that nothing changed (304), the cached response is returned instead of downloading it again.
+    """
+
+    cached_paths = ("/playlists", "/tracks")
+    write_methods = ("POST", "PUT", "DELETE")
+    rate_limit_retries = 3
+
+    def __init__(
+        self,
+        pool_size: int = 8,
+        cache: ResponseCache = None,
+        rate_limiter: RateLimiter = None,
+        metrics: Metrics = None,
+    ):
+        super().__init__()
+        self.cache = cache
+        self.rate_limiter = rate_limiter
+        self.metrics = metrics
+
+        # Only retry failed connections here. Rate limiting is handled in request and server errors by the callers.
+        retry = Retry(
+            total=3,
+            connect=3,
+            read=False,
+            status=0,
+            backoff_factor=0.3,
+            respect_retry_after_header=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+        )
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def _is_cacheable(self, method: str, url: str) -> bool:
+        if self.cache is None or method.upper() != "GET":
+            return False
+        path = urlparse(url).path
+        return any(part in path for part in self.cached_paths)
+
+    def request(self, method, url, params=None, headers=None, **kwargs):
+        if self.rate_limiter is None:
+            return self._send(method, url, params, headers, **kwargs)
+
+        # Writes go before reads, so adding tracks to the feed is not held up by fetching playlists.
+        write = method.upper() in self.write_methods
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire(write)
+            start = time.perf_counter()
+            try:
+                response = self._send(method, url, params, headers, **kwargs)
+            except RequestException:
+                self.rate_limiter.record_response(None, elapsed=time.perf_counter() - start)
+                raise
+
+            self.rate_limiter.record_response(
+                response.status_code,
+                response.headers.get("Retry-After"),
+                time.perf_counter() - start,
+            )
+            # The limiter holds back all requests until the Retry-After time has passed, then we try again.
+            if response.status_code != 429 or attempt >= self.rate_limit_retries:
+                return response
+            attempt += 1
+
+    # Called for every request that actually goes to the API
+    def send(self, request, **kwargs):
+        response = super().send(request, **kwargs)
+        if self.metrics is not None:
+            self.metrics.count_request(
+                endpoint_name(request.method, urlparse(request.url).path), len(response.content)
+            )
+        return response
+
+    def _send(self, method, url, params=None, headers=None, **kwargs):
+        if not self._is_cacheable(method, url):
+            return super().request(method, url, params=params, headers=headers, **kwargs)
+
+        key = self.cache.key(url, params)
+        entry = self.cache.get(key)
+        headers = dict(headers or {})
+        if entry is not None:
+            headers["If-None-Match"] = entry["etag"]
+
+        response = super().request(method, url, params=params, headers=headers, **kwargs)
+
+        if response.status_code == 304 and entry is not None:
+            return self._cached_response(entry, response)
+
+        etag = response.headers.get("ETag")
+        if response.status_code == 200 and etag:
+            self.cache.put(key, etag, response)
+
+        return response
+
+    # Turn a cached entry into a response, as if the server had sent it again
+    @staticmethod
+    def _cached_response(entry: dict, not_modified: requests.Response) -> requests.Response:
+        response = requests.Response()
+        response.status_code = 200
+        response.reason = "OK"
+        response.url = not_modified.url
+        response.request = not_modified.request
+        response.headers = CaseInsensitiveDict(not_modified.headers)
+        response.headers["Content-Type"] = entry["content_type"] or "application/json"
+        response.headers["ETag"] = entry["etag"]
+        response.encoding = "utf-8"
+        response._content = entry["body"].encode("utf-8")
+        return response
+
+
+# Create a session for the API client. Pass cache_dir=None or cache_size=0 to disable the response cache.
+def create_session(
+    pool_size: int = 8,
+    cache_dir: str = None,
+    cache_size: int = 64 * 2 ** 20,
+    rate_limiter: RateLimiter = None,
+    metrics: Metrics = None,
+) -> SpotifySession:
+    cache = None
+    if cache_dir is not None and cache_size > 0:
+        cache = ResponseCache(cache_dir, cache_size)
+    return SpotifySession(
+        pool_size=pool_size, cache=cache, rate_limiter=rate_limiter, metrics=metrics
+    )
@@ -0,0 +1,420 @@
+import os
+import json
+import pickle
+import sqlite3
+from contextlib import closing
+from datetime import datetime, timedelta
+
+from classes import PlaylistRecord, SeenTrackIndex, SubscribedPlaylist, SubscriptionFeed
+from feed_router import FeedPlaylist, FeedRouter
+from utils import atomic_write
+
+
+class Storage:
+    """
+    Base class for the backends in which the state of a SpotifySubscriber is stored.
+
+    Attributes:
+    storage_dir (str): directory containing the storage file
+    path (str): path of the storage file
+    """
+
+    filename = None
+
+    def __init__(self, storage_dir: str):
+        self.storage_dir = storage_dir
+        self.path = os.path.join(storage_dir, self.filename)
+
+    def exists(self) -> bool:
+        return os.path.isfile(self.path)
+
+    # Changes whenever the storage file is written, so we can tell whether another run saved since we last did
+    def version(self):
+        if not self.exists():
+            return None
+        stat = os.stat(self.path)
+        return stat.st_mtime_ns, stat.st_size
+
+    # Whether the last load included the playlists the user owns and follows
+    @property
+    def includes_playlists(self) -> bool:
+        return True
+
+    # IDs of the playlists the user owns, also if the last load did not include the playlists
+    def own_playlist_ids(self, subscriber) -> list:
+        return list(subscriber.user_playlists)
+
+    # Overwrite the attributes of the subscriber with the stored ones. If include_playlists is False, backends may
+    # skip loading the playlists the user owns and follows, which are not needed to update the feed.
+    def load(self, subscriber, include_playlists: bool = True):
+        raise NotImplementedError
+
+    # Store the state of the subscriber
+    def save(self, subscriber):
+        raise NotImplementedError
+
+
+class PickleStorage(Storage):
+    """
+    Pickles the entire SpotifySubscriber object on every save. The file is replaced at once, so an interrupted
+    save leaves the previous state intact.
+    """
+
+    filename = "storage.p"
+
+    def load(self, subscriber, include_playlists: bool = True):
+        with open(self.path, "rb") as save_file:
+            load_obj = pickle.load(save_file)
+
+        # Overwrite own attributes with the ones we just loaded. Older save files may contain attributes of the run
+        # that saved them, such as its storage dir, which must not replace the ones of this run.
+        for attr, val in load_obj.__dict__.items():
+            if attr not in subscriber._run_attributes:
+                subscriber.__dict__[attr] = val
+
+    def save(self, subscriber):
+        with atomic_write(self.path, "wb") as save_file:
+            pickle.dump(subscriber, save_file)
+        subscriber.seen_tracks.mark_saved()
+
+
+class SQLiteStorage(Storage):
+    """
+    Stores the subscriber state in an SQLite database, and only writes the rows that changed since the last save.
+    Seen tracks are only ever added to a subscription, so for those we insert the ones the index has not saved yet.
+    Every save is a single transaction, so an interrupted save leaves the previous state intact.
+    """
+
+    filename = "storage.db"
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS playlists (
+            id TEXT PRIMARY KEY,
+            followed INTEGER,
+            data TEXT
+        );
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            id TEXT PRIMARY KEY,
+            name TEXT,
+            owner_id TEXT,
+            snapshot_id TEXT,
+            subscribe_stamp TEXT,
+            num_tracks INTEGER,
+            first_page_bytes INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS seen_tracks (
+            playlist_id TEXT,
+            track_id TEXT,
+            seen_at TEXT,
+            PRIMARY KEY (playlist_id, track_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS feeds (
+            feed_name TEXT,
+            position INTEGER,
+            id TEXT,
+            name TEXT,
+            num_tracks INTEGER,
+            PRIMARY KEY (feed_name, position)
+        );
+        CREATE TABLE IF NOT EXISTS feed_routes (
+            playlist_id TEXT PRIMARY KEY,
+            feed_name TEXT
+        );
+    """
+
+    def __init__(self, storage_dir: str):
+        super().__init__(storage_dir)
+
+        # What we last read from or wrote to the database, so we know which rows changed.
+        self._stored_settings = {}
+        self._stored_playlists = {}
+        self._stored_subscriptions = {}
+        self._stored_feeds = []
+        self._stored_routes = []
+        self._playlists_loaded = True
+
+    @property
+    def includes_playlists(self) -> bool:
+        return self._playlists_loaded
+
+    def own_playlist_ids(self, subscriber) -> list:
+        # Unless the playlists were refreshed since, only their IDs are read
+        if self._playlists_loaded or subscriber.user_playlists or not self.exists():
+            return super().own_playlist_ids(subscriber)
+        with closing(self._connect()) as conn:
+            return [playlist_id for playlist_id, in conn.execute("SELECT id FROM playlists WHERE followed = 0")]
+
+    # Columns that were added to the tables of older versions
+    added_columns = {
+        "subscriptions": [
+            ("num_checks", "INTEGER DEFAULT 0"),
+            ("num_changes", "INTEGER DEFAULT 0"),
+            ("num_new_tracks", "INTEGER DEFAULT 0"),
+            ("last_checked", "TEXT"),
+            ("check_interval", "REAL"),
+        ],
+    }
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path)
+        conn.executescript(self.schema)
+        for table, columns in self.added_columns.items():
+            existing = {row[1] for row in conn.execute("PRAGMA table_info({})".format(table))}
+            for name, definition in columns:
+                if name not in existing:
+                    conn.execute("ALTER TABLE {} ADD COLUMN {} {}".format(table, name, definition))
+        return conn
+
+    def load(self, subscriber, include_playlists: bool = True):
+        self._stored_playlists = {}
+        self._stored_subscriptions = {}
+        with closing(self._connect()) as conn:
+            settings = {
+                key: json.loads(value)
+                for key, value in conn.execute("SELECT key, value FROM settings")
+            }
+
+            user_playlists = {}
+            followed_playlists = {}
+            self._playlists_loaded = include_playlists
+            playlist_rows = conn.execute("SELECT id, followed, data FROM playlists") if include_playlists else []
+            for playlist_id, followed, data in playlist_rows:
+                # Older versions stored the raw API dicts, which from_dict converts as well
+                record = PlaylistRecord.from_dict(json.loads(data))
+                if followed:
+                    followed_playlists[playlist_id] = record
+                else:
+                    user_playlists[playlist_id] = record
+                self._stored_playlists[playlist_id] = (followed, data)
+
+            seen_tracks = SeenTrackIndex()
+            subscribed_playlists = {}
+            for row in conn.execute(
+                "SELECT id, name, owner_id, snapshot_id, subscribe_stamp, num_tracks, first_page_bytes, "
+                "num_checks, num_changes, num_new_tracks, last_checked, check_interval FROM subscriptions"
+            ):
+                playlist_id, name, owner_id, snapshot_id, stamp, num_tracks, page_bytes = row[:7]
+                num_checks, num_changes, num_new_tracks, last_checked, check_interval = row[7:]
+                subscribed_playlists[playlist_id] = SubscribedPlaylist.from_storage(
+                    playlist_id,
+                    name,
+                    owner_id,
+                    snapshot_id,
+                    datetime.fromisoformat(stamp),
+                    num_tracks,
+                    page_bytes,
+                    seen_tracks,
+                    num_checks,
+                    num_changes,
+                    num_new_tracks,
+                    datetime.fromisoformat(last_checked) if last_checked else None,
+                    timedelta(seconds=check_interval) if check_interval is not None else None,
+                )
+                self._stored_subscriptions[playlist_id] = row
+
+            for playlist_id, track_id, seen_at in conn.execute(
+                "SELECT playlist_id, track_id, seen_at FROM seen_tracks"
+            ):
+                subscribed_playlists[playlist_id].add_track(
+                    track_id, datetime.fromisoformat(seen_at)
+                )
+
+            self._stored_feeds = conn.execute(
+                "SELECT feed_name, position, id, name, num_tracks FROM feeds ORDER BY feed_name, position"
+            ).fetchall()
+            self._stored_routes = conn.execute(
+                "SELECT playlist_id, feed_name FROM feed_routes ORDER BY playlist_id"
+            ).fetchall()
+
+        seen_tracks.mark_saved()
+        self._stored_settings = settings
+
+        subscriber.user_id = settings["user_id"]
+        subscriber._client_id = settings["client_id"]
+        subscriber._client_secret = settings["client_secret"]
+        subscriber.user_playlists = user_playlists
+        subscriber.followed_playlists = followed_playlists
+        refreshed_at = settings.get("playlists_refreshed_at")
+        subscriber.playlists_refreshed_at = (
+            datetime.fromisoformat(refreshed_at) if refreshed_at else None
+        )
+        subscriber.subscribed_playlists = subscribed_playlists
+        subscriber.seen_tracks = seen_tracks
+
+        feed = settings["subscription_feed"]
+        subscriber.subscription_feed = SubscriptionFeed.from_storage(
+            feed["id"], feed["name"], datetime.fromisoformat(feed["last_update"])
+        )
+
+        # Older versions only had the subscription feed
+        router = FeedRouter(
+            feed["id"],
+            feed["name"],
+            settings.get("feed_mode", "single"),
+            settings.get("feed_max_tracks", FeedRouter.default_max_tracks),
+        )
+        if self._stored_feeds:
+            router.feeds = {}
+            for feed_name, _, playlist_id, name, num_tracks in self._stored_feeds:
+                router.feeds.setdefault(feed_name, []).append(FeedPlaylist(playlist_id, name, num_tracks))
+        router.routes = dict(self._stored_routes)
+        subscriber.feed_router = router
+
+    def save(self, subscriber):
+        feed = subscriber.subscription_feed
+        settings = {
+            "user_id": subscriber.user_id,
+            "client_id": getattr(subscriber, "_client_id", None),
+            "client_secret": getattr(subscriber, "_client_secret", None),
+            "subscription_feed": {
+                "id": feed.id,
+                "name": feed.name,
+                "last_update": feed.last_update.isoformat(),
+            },
+            "feed_mode": subscriber.feed_router.mode,
+            "feed_max_tracks": subscriber.feed_router.max_tracks,
+            "playlists_refreshed_at": (
+                subscriber.playlists_refreshed_at.isoformat()
+                if subscriber.playlists_refreshed_at
+                else None
+            ),
+        }
+
+        playlists = {}
+        for playlist_id, playlist in subscriber.user_playlists.items():
+            playlists[playlist_id] = (0, json.dumps(playlist.to_dict()))
+        for playlist_id, playlist in subscriber.followed_playlists.items():
+            playlists[playlist_id] = (1, json.dumps(playlist.to_dict()))
+
+        router = subscriber.feed_router
+        feeds = sorted(
+            (feed_name, position, playlist.id, playlist.name, playlist.num_tracks)
+            for feed_name, chain in router.feeds.items()
+            for position, playlist in enumerate(chain)
+        )
+        routes = sorted(router.routes.items())
+
+        subscriptions = {}
+        for playlist_id, playlist in subscriber.subscribed_playlists.items():
+            subscriptions[playlist_id] = (
+                playlist_id,
+                playlist.name,
+                playlist.owner_id,
+                playlist.snapshot_id,
+                playlist.subscribe_stamp.isoformat(),
+                playlist.num_tracks,
+                playlist.first_page_bytes,
+                playlist.num_checks,
+                playlist.num_changes,
+                playlist.num_new_tracks,
+                playlist.last_checked.isoformat() if playlist.last_checked else None,
+                playlist.check_interval.total_seconds() if playlist.check_interval is not None else None,
+            )
+
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+                [
+                    (key, json.dumps(value))
+                    for key, value in settings.items()
+                    if key not in self._stored_settings
+                    or self._stored_settings[key] != value
+                ],
+            )
+
+            # If the playlists were not loaded, we do not know which rows changed. Leave them alone, unless
+            # the playlists were refreshed since, in which case they are replaced entirely.
+            if not self._playlists_loaded and playlists:
+                conn.execute("DELETE FROM playlists")
+                self._stored_playlists = {}
+                self._playlists_loaded = True
+
+            if self._playlists_loaded:
+                conn.executemany(
+                    "DELETE FROM playlists WHERE id = ?",
+                    [(key,) for key in self._stored_playlists.keys() - playlists.keys()],
+                )
+                conn.executemany(
+                    "INSERT OR REPLACE INTO playlists (id, followed, data) VALUES (?, ?, ?)",
+                    [
+                        (key, *value)
+                        for key, value in playlists.items()
+                        if self._stored_playlists.get(key) != value
+                    ],
+                )
+
+            # The routing table is small, so it is replaced entirely when it changed
+            if feeds != self._stored_feeds:
+                conn.execute("DELETE FROM feeds")
+                conn.executemany("INSERT INTO feeds VALUES (?, ?, ?, ?, ?)", feeds)
+            if routes != self._stored_routes:
+                conn.execute("DELETE FROM feed_routes")
+                conn.executemany("INSERT INTO feed_routes VALUES (?, ?)", routes)
+
+            removed = [
+                (key,) for key in self._stored_subscriptions.keys() - subscriptions.keys()
+            ]
+            conn.executemany("DELETE FROM subscriptions WHERE id = ?", removed)
+            conn.executemany("DELETE FROM seen_tracks WHERE playlist_id = ?", removed)
+            conn.executemany(
+                "INSERT OR REPLACE INTO subscriptions (id, name, owner_id, snapshot_id, subscribe_stamp, num_tracks, "
+                "first_page_bytes, num_checks, num_changes, num_new_tracks, last_checked, check_interval) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    value
+                    for key, value in subscriptions.items()
+                    if self._stored_subscriptions.get(key) != value
+                ],
+            )
+
+            # For subscriptions we stored before, only the tracks the index has not saved yet are new.
+            seen_tracks = subscriber.seen_tracks
+            unsaved = seen_tracks.unsaved()
+            new_refs = [
+                (playlist_id, ref)
+                for playlist_id, ref in unsaved
+                if playlist_id in self._stored_subscriptions
+                and playlist_id in subscriptions
+            ]
+            for playlist_id, playlist in subscriber.subscribed_playlists.items():
+                if playlist_id not in self._stored_subscriptions:
+                    new_refs.extend((playlist_id, ref) for ref in playlist.track_refs)
+
+            conn.executemany(
+                "INSERT OR REPLACE INTO seen_tracks (playlist_id, track_id, seen_at) VALUES (?, ?, ?)",
+                [
+                    (
+                        playlist_id,
+                        seen_tracks.track_id(ref),
+                        seen_tracks.first_seen(ref).isoformat(),
+                    )
+                    for playlist_id, ref in new_refs
+                ],
+            )
+
+        seen_tracks.mark_saved(len(unsaved))
+        self._stored_settings = settings
+        if self._playlists_loaded:
+            self._stored_playlists = playlists
+        self._stored_subscriptions = subscriptions
+        self._stored_feeds = feeds
+        self._stored_routes = routes
+
+
+backends = {"pickle": PickleStorage, "sqlite": SQLiteStorage}
+
+
+# Create the storage backend with the given name
+def get_storage(backend: str, storage_dir: str) -> Storage:
+    if backend not in backends:
+        raise ValueError(
+            "Unknown storage backend {}, choose one of {}.".format(
+                backend, ", ".join(backends)
+            )
+        )
+
+    return backends[backend](storage_dir)
@@ -0,0 +1,89 @@
+import os
+import threading
+import time
+
+from utils import safe_print
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+
+class StorageLock:
+    """
+    Exclusive lock on a storage directory, so that overlapping runs for the same user (e.g. the update scheduled
+    at startup and the daily one) take turns instead of overwriting each other's state.
+
+    The lock is held on the file storage.lock through the operating system, so it is released when the process
+    exits, even if it crashes. Within a process the lock is shared: every acquire increases a count, and the file
+    is unlocked once every acquire was released. This allows creating several subscribers for the same directory.
+
+    Attributes:
+    path (str): path of the lock file
+    """
+
+    filename = "storage.lock"
+
+    # Open lock files and their counts by path, shared by all locks of the process
+    _held = {}
+    _held_lock = threading.Lock()
+
+    def __init__(self, storage_dir: str):
+        self.path = os.path.abspath(os.path.join(storage_dir, self.filename))
+
+    @staticmethod
+    def _try_lock(lock_file) -> bool:
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                # Msvcrt locks bytes from the current position
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            return False
+        return True
+
+    # Wait until the lock is ours. Raises an exception if that takes longer than timeout seconds.
+    def acquire(self, timeout: float = None):
+        start = time.monotonic()
+        lock_file = None
+        waiting = False
+        while True:
+            with self._held_lock:
+                if self.path in self._held:
+                    self._held[self.path][1] += 1
+                    if lock_file is not None:
+                        lock_file.close()
+                    return
+
+                if lock_file is None:
+                    lock_file = open(self.path, "a+")
+                if self._try_lock(lock_file):
+                    self._held[self.path] = [lock_file, 1]
+                    return
+
+            if timeout is not None and time.monotonic() - start > timeout:
+                lock_file.close()
+                raise Exception(
+                    "Another run is still using {}, gave up after {:g} seconds.".format(
+                        os.path.dirname(self.path), timeout
+                    )
+                )
+            if not waiting:
+                safe_print("Waiting for another run that uses {}...".format(os.path.dirname(self.path)))
+                waiting = True
+            time.sleep(0.1)
+
+    def release(self):
+        with self._held_lock:
+            if self.path not in self._held:
+                return
+            entry = self._held[self.path]
+            entry[1] -= 1
+            if entry[1] == 0:
+                # Closing the file releases the lock
+                entry[0].close()
+                del self._held[self.path]
@@ -5,29 +5,36 @@ from SpotifySubscriber import SpotifySubscriber
 
 
 def main(args):
-    spotify = SpotifySubscriber()
-    spotify.refresh_user_playlists()
+    spotify = SpotifySubscriber(lock_timeout = args.lock_timeout)
+    changes = spotify.refresh_user_playlists(max_age = args.max_age * 60)
+    spotify.print_playlist_changes(changes)
 
     if args.unsubscribe:
         if args.id:
-            spotify.unsubscribe_from_playlists(playlist_ids = [args.playlist])
+            spotify.unsubscribe_from_playlists(playlist_ids = args.playlists)
         else:
-            spotify.unsubscribe_from_playlists(contains = [args.playlist])
+            spotify.unsubscribe_from_playlists(contains = args.playlists)
     else:
         if args.id:
-            spotify.subscribe_to_playlists(playlist_ids = [args.playlist])
+            spotify.subscribe_to_playlists(playlist_ids = args.playlists, max_workers = args.workers)
         else:
-            spotify.subscribe_to_playlists(contains = [args.playlist])
+            spotify.subscribe_to_playlists(contains = args.playlists, max_workers = args.workers)
 
     spotify.print_playlists()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description = 'Subscribe or unsubscribe to one of your followed playlists.')
-    parser.add_argument('playlist', type = str, help = 'Playlist name to subscribe to or unsubscribe from. \
-        Partial name also works, for example "discover" will subscribe to discover weekly. Not case sensitive.')
+    parser.add_argument('playlists', type = str, nargs = '+', help = 'Playlist names to subscribe to or unsubscribe from. \
+        Partial names also work, for example "discover" will subscribe to discover weekly. Not case sensitive. \
+        Prefix a name with "re:" to use a regular expression, or with "glob:" to use wildcards, e.g. "glob:*radar".')
     parser.add_argument('--unsubscribe', action = 'store_true', help = 'Unsubscribe from this playlist.')
-    parser.add_argument('--id', action = 'store_true', help = 'The provided name is a playlist ID rather than a name pattern.')
+    parser.add_argument('--id', action = 'store_true', help = 'The provided names are playlist IDs rather than name patterns.')
+    parser.add_argument('--workers', type = int, default = 8, help = 'Number of playlists to fetch concurrently when subscribing.')
+    parser.add_argument('--max_age', type = float, default = 10, help = 'Do not refresh the list of followed playlists if it is \
+        less than this many minutes old. Use 0 to always refresh it.')
+    parser.add_argument('--lock_timeout', type = float, default = None, help = 'Give up after this many seconds if \
+        another run (e.g. the daemon) keeps using the storage dir. Waits until it is done by default.')
 
     args = parser.parse_args()
 
@@ -0,0 +1,40 @@
+import contextlib
+import io
+from datetime import datetime
+
+from fake_spotify import FakeSpotify
+from feed_router import FeedPlaylist, FeedRouter
+from SpotifySubscriber import SpotifySubscriber
+
+
+def test_assign_requests_unknown_size_if_feeds_never_roll_over():
+    router = FeedRouter("feed", "SpotifySubscriber", max_tracks=None)
+    counted = []
+
+    def count_tracks(playlist_id):
+        counted.append(playlist_id)
+        return 7
+
+    assignments = router.assign(["a", "b"], {"a": "x", "b": "x"}, datetime.utcnow(), FeedPlaylist, count_tracks)
+    assert counted == ["feed"]
+    assert [(playlist.id, track_ids) for playlist, track_ids in assignments] == [("feed", ["a", "b"])]
+    assert router.feeds["SpotifySubscriber"][0].num_tracks == 7
+
+
+def test_update_feed_that_never_rolls_over(tmp_path):
+    sp = FakeSpotify(num_playlists=4, tracks_per_playlist=20)
+    with contextlib.redirect_stdout(io.StringIO()):
+        subscriber = SpotifySubscriber(sp.user_id, storage_dir=str(tmp_path), spotify=sp)
+        subscriber.subscribe_to_playlists(contains=["benchmark"])
+        subscriber.set_feed_mode("single", max_tracks=None)
+
+        for update in range(1, 4):
+            feed = subscriber.feed_router.feeds["SpotifySubscriber"][0]
+            # The size is unknown after journal recovery and pruning
+            if update == 2:
+                subscriber.feed_router.invalidate(feed.id)
+            sp.churn(1.0, 5)
+            subscriber.update_feed()
+            assert feed.num_tracks == len(sp.playlists[feed.id]) == 20 * update
+
+    assert len(subscriber.feed_router.feeds["SpotifySubscriber"]) == 1
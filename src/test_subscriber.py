@@ -0,0 +1,159 @@
+import os
+import pickle
+from collections import Counter
+from datetime import datetime
+from unittest import mock
+
+import numpy as np
+
+from classes import SubscribedPlaylist
+from fake_spotify import FakeSpotify
+from SpotifySubscriber import SpotifySubscriber
+
+
+def subscribe(storage_dir, num_playlists=8, tracks_per_playlist=250, **kwargs):
+    sp = FakeSpotify(num_playlists=num_playlists, tracks_per_playlist=tracks_per_playlist)
+    subscriber = SpotifySubscriber(sp.user_id, storage_dir=str(storage_dir), spotify=sp, **kwargs)
+    subscriber.subscribe_to_playlists(contains=["benchmark"])
+    return sp, subscriber
+
+
+# IDs of the tracks in the playlist, in the order of the playlist
+def playlist_track_ids(sp, playlist_id):
+    playlist = sp.playlists[playlist_id]
+    return [playlist.item(position)["track"]["id"] for position in range(len(playlist))]
+
+
+def test_feed_does_not_depend_on_number_of_workers(tmp_path):
+    feeds = []
+    for max_workers in [1, 8]:
+        sp, subscriber = subscribe(tmp_path / str(max_workers))
+        new_ids = sp.churn(0.5, 120)
+        assert subscriber.update_feed(max_workers=max_workers) == len(new_ids)
+        feeds.append(playlist_track_ids(sp, subscriber.subscription_feed.id))
+
+    assert feeds[0] == feeds[1]
+    assert sorted(feeds[0]) == sorted(new_ids)
+
+
+def test_migrate_legacy_storage(tmp_path):
+    sp, subscriber = subscribe(tmp_path, storage_backend="pickle")
+    expected = {
+        playlist_id: sorted(playlist.track_ids)
+        for playlist_id, playlist in subscriber.subscribed_playlists.items()
+    }
+
+    # Older versions pickled a dict of track IDs in every subscription, and had no shared index or feed router
+    def legacy_playlist_state(playlist):
+        return {
+            "name": playlist.name,
+            "id": playlist.id,
+            "owner_id": playlist.owner_id,
+            "snapshot_id": playlist.snapshot_id,
+            "subscribe_stamp": playlist.subscribe_stamp,
+            "track_ids": {track_id: playlist.subscribe_stamp for track_id in playlist.track_ids},
+        }
+
+    state = subscriber.__getstate__()
+    del state["seen_tracks"]
+    del state["feed_router"]
+    with mock.patch.object(SubscribedPlaylist, "__getstate__", legacy_playlist_state):
+        with mock.patch.object(SpotifySubscriber, "__getstate__", lambda self: state):
+            with open(tmp_path / "storage.p", "wb") as save_file:
+                pickle.dump(subscriber, save_file)
+
+    # Older versions pickled the log as object arrays
+    new_ids = sp.churn(1.0, 10)
+    logged_ids = new_ids[:15]
+    with open(tmp_path / "feed_log.npy", "wb") as log_file:
+        pickle.dump(
+            {
+                "track_ids": np.array(logged_ids, dtype=object),
+                "timestamps": np.array([datetime(2020, 1, 1)] * len(logged_ids), dtype=object),
+            },
+            log_file,
+        )
+
+    migrated = SpotifySubscriber(storage_dir=str(tmp_path), spotify=sp)
+    assert os.path.isfile(tmp_path / "storage.db")
+    assert os.path.isfile(tmp_path / "storage.p.bak")
+    assert {
+        playlist_id: sorted(playlist.track_ids)
+        for playlist_id, playlist in migrated.subscribed_playlists.items()
+    } == expected
+
+    # Tracks in the old log are not added again
+    assert migrated.update_feed() == len(new_ids) - len(logged_ids)
+    assert os.path.isfile(tmp_path / "feed_log.npy.bak")
+    assert sorted(playlist_track_ids(sp, migrated.subscription_feed.id)) == sorted(new_ids[15:])
+    track_ids, _ = migrated.feed_log.read()
+    assert track_ids.tolist() == logged_ids + playlist_track_ids(sp, migrated.subscription_feed.id)
+
+
+def test_resume_interrupted_fetch(tmp_path):
+    sp, subscriber = subscribe(tmp_path, num_playlists=4, tracks_per_playlist=1000)
+    new_ids = sp.churn(1.0, 10)
+
+    next_page = sp.next
+    calls = []
+
+    def dropped_connection(result):
+        calls.append(result)
+        if len(calls) == 12:
+            raise ConnectionError("Connection dropped")
+        return next_page(result)
+
+    with mock.patch.object(sp, "next", dropped_connection):
+        try:
+            subscriber.update_feed(max_workers=2, incremental=False)
+        except ConnectionError:
+            pass
+        else:
+            raise AssertionError("The update was not interrupted")
+    assert os.path.isfile(tmp_path / "update_checkpoint.json")
+
+    # Every playlist has 11 pages, the ones that were fetched before are not requested again
+    sp.reset_counters()
+    assert subscriber.update_feed(max_workers=2, incremental=False) == len(new_ids)
+    assert sp.calls.get("user_playlist_tracks", 0) + sp.calls["next"] <= 4 * 11 - 11
+    assert sorted(playlist_track_ids(sp, subscriber.subscription_feed.id)) == sorted(new_ids)
+    assert not os.path.exists(tmp_path / "update_checkpoint.json")
+
+
+class Interrupted(BaseException):
+    pass
+
+
+def test_resume_interrupted_write(tmp_path):
+    sp, subscriber = subscribe(tmp_path, num_playlists=10)
+    new_ids = sp.churn(1.0, 30)
+
+    add_tracks = sp.user_playlist_add_tracks
+    calls = []
+
+    # The run is killed while it sends the second of three batches of tracks
+    def interrupted(user, playlist_id, tracks, position=None):
+        calls.append(tracks)
+        result = add_tracks(user, playlist_id, tracks, position)
+        if len(calls) == 2:
+            raise Interrupted()
+        return result
+
+    with mock.patch.object(sp, "user_playlist_add_tracks", interrupted):
+        try:
+            subscriber.update_feed(max_workers=1)
+        except Interrupted:
+            pass
+        else:
+            raise AssertionError("The update was not interrupted")
+    # Some tracks reached the feed, but the run was killed before it logged them
+    assert os.path.isfile(tmp_path / "feed_journal.jsonl")
+    assert len(subscriber.feed_log) < len(sp.playlists[subscriber.subscription_feed.id])
+
+    # A new run recovers the tracks that reached the feed, and does not add them again
+    resumed = SpotifySubscriber(storage_dir=str(tmp_path), spotify=sp)
+    resumed.update_feed(max_workers=2)
+    feed_ids = playlist_track_ids(sp, resumed.subscription_feed.id)
+    assert sorted(feed_ids) == sorted(new_ids)
+    assert max(Counter(feed_ids).values()) == 1
+    assert not os.path.exists(tmp_path / "feed_journal.jsonl")
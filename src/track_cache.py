@@ -0,0 +1,100 @@
+import os
+import sqlite3
+import time
+
+
+class TrackCache:
+    """
+    Persistent cache of track metadata by track ID, stored in an SQLite database in the storage directory.
+
+    Entries expire ttl seconds after they were fetched. If the cache holds more than max_entries tracks,
+    the least recently used ones are removed. Only the metadata needed to describe a track is kept.
+    The cache should only be used from the thread that created it.
+
+    Attributes:
+    path (str): path of the database file
+    ttl (float): number of seconds after which an entry is fetched again
+    max_entries (int): maximum number of tracks in the cache
+    """
+
+    filename = "track_cache.db"
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS tracks (
+            id TEXT PRIMARY KEY,
+            name TEXT,
+            artist_name TEXT,
+            fetched_at REAL,
+            used_at REAL
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS tracks_used_at ON tracks (used_at);
+    """
+
+    def __init__(
+        self, storage_dir: str, ttl: float = 30 * 24 * 3600, max_entries: int = 100000
+    ):
+        self.path = os.path.join(storage_dir, self.filename)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._conn = sqlite3.connect(self.path)
+        self._conn.executescript(self.schema)
+
+    def close(self):
+        self._conn.close()
+
+    # Return a dict of track ID to (name, artist name) for the IDs that are in the cache and have not expired.
+    def get_many(self, track_ids) -> dict:
+        now = time.time()
+        track_ids = list(set(track_ids))
+        found = {}
+        # Stay below the maximum number of SQLite parameters
+        for start in range(0, len(track_ids), 500):
+            chunk = track_ids[start : start + 500]
+            query = "SELECT id, name, artist_name FROM tracks WHERE fetched_at > ? AND id IN ({})".format(
+                ", ".join("?" * len(chunk))
+            )
+            for track_id, name, artist_name in self._conn.execute(
+                query, [now - self.ttl, *chunk]
+            ):
+                found[track_id] = (name, artist_name)
+
+        with self._conn:
+            self._conn.executemany(
+                "UPDATE tracks SET used_at = ? WHERE id = ?",
+                [(now, track_id) for track_id in found],
+            )
+        return found
+
+    # Store the metadata of track dicts as returned by the API. None entries (unknown tracks) are ignored.
+    def put_many(self, tracks: list):
+        now = time.time()
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO tracks (id, name, artist_name, fetched_at, used_at) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (
+                        track["id"],
+                        track["name"],
+                        track["artists"][0]["name"] if track["artists"] else "",
+                        now,
+                        now,
+                    )
+                    for track in tracks
+                    if track is not None
+                ],
+            )
+        self._evict()
+
+    # Remove the least recently used tracks until at most max_entries remain
+    def _evict(self):
+        (num_entries,) = self._conn.execute("SELECT COUNT(*) FROM tracks").fetchone()
+        if num_entries <= self.max_entries:
+            return
+        with self._conn:
+            self._conn.execute(
+                "DELETE FROM tracks WHERE id IN (SELECT id FROM tracks ORDER BY used_at LIMIT ?)",
+                (num_entries - self.max_entries,),
+            )
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM tracks").fetchone()[0]
@@ -1,23 +1,57 @@
 import argparse
+from datetime import timedelta
 
 from SpotifySubscriber import SpotifySubscriber
+from metrics import Metrics, parse_address
+from poll_scheduler import PollScheduler
 
 
 def main(args):
-    spotify = SpotifySubscriber()
-
-    # Print all playlists
-    spotify.print_playlists()
-
-    # Obtain any new songs since the last update
-    new_tracks = spotify.update_feed(add_own = args.add_own)
+    metrics = Metrics(
+        enabled = args.metrics or args.prometheus_file is not None or args.statsd is not None,
+        prometheus_path = args.prometheus_file,
+        statsd_address = parse_address(args.statsd) if args.statsd else None)
+    # Updating the feed does not need the playlists the user owns and follows, so only load them to print them
+    spotify = SpotifySubscriber(pool_size = args.workers, metrics = metrics, load_playlists = args.print_playlists,
+        lock_timeout = args.lock_timeout)
+
+    if args.print_playlists:
+        spotify.print_playlists()
+
+    # Obtain any new songs since the last update, from the subscriptions that are due
+    scheduler = PollScheduler(max_interval = timedelta(days = args.max_interval), request_budget = args.request_budget)
+    new_tracks = spotify.update_feed(add_own = args.add_own, max_workers = args.workers,
+        skip_library = not args.include_library, scheduler = scheduler)
     print("Added {} new tracks.".format(new_tracks))
 
+    stats = spotify.rate_limiter.stats()
+    print("Sent {} requests: {:.1f} s throttled ({} requests), {:.1f} s on the wire, {} rate limited.".format(
+        stats["requests"], stats["throttled_time"], stats["throttled_requests"], stats["wire_time"], stats["rate_limited"]))
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description = 'Check for new tracks & update the subscription feed.')
     parser.add_argument("--add_own", action="store_true", help="Without this argument, " + \
         "tracks added by the user themselves are ignored.")
+    parser.add_argument("--include_library", action = "store_true", help = "Also add tracks that are " + \
+        "already saved in your library or in one of your own playlists.")
+    parser.add_argument("--print_playlists", action = "store_true", help = "Print the playlists the user " + \
+        "owns and follows before updating.")
+    parser.add_argument("--workers", type = int, default = 8, help = "Number of subscribed playlists " + \
+        "to check concurrently.")
+    parser.add_argument("--max_interval", type = float, default = 7, help = "Playlists that have not had " + \
+        "new tracks for a while are checked less often, but at least once every this many days. " + \
+        "Use 0 to check every subscription on every update.")
+    parser.add_argument("--request_budget", type = int, default = None, help = "Check at most as many " + \
+        "playlists as fit in this many requests. The others are checked first in the next update.")
+    parser.add_argument("--metrics", action = "store_true", help = "Print a JSON summary of the time spent " + \
+        "in every phase and the requests per endpoint after the update.")
+    parser.add_argument("--prometheus_file", type = str, default = None, help = "Also write the metrics " + \
+        "to this file in the Prometheus textfile format.")
+    parser.add_argument("--statsd", type = str, default = None, help = "Also send the metrics to this " + \
+        "StatsD server, given as host:port.")
+    parser.add_argument("--lock_timeout", type = float, default = None, help = "Give up after this many " + \
+        "seconds if another run (e.g. the daemon) keeps using the storage dir. Waits until it is done by default.")
     args = parser.parse_args()
 
     main(args)
\ No newline at end of file
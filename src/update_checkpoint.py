@@ -0,0 +1,92 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+from utils import atomic_write
+
+
+class UpdateCheckpoint:
+    """
+    Progress of an update of the feed, so that an update that was interrupted (e.g. by an expired token or a
+    dropped connection) can resume where it stopped instead of fetching every changed playlist again.
+
+    For every playlist that was fetched, the checkpoint holds the snapshot it was fetched at, the offset from
+    which a scan of the playlist should continue, the IDs of the new tracks found so far and whether the playlist
+    was fetched completely. Progress is only reused if the snapshot of the playlist is still the same, and the
+    checkpoint is only valid for an update that starts from the same last update time with the same options.
+    It is written at most every save_interval seconds, and whenever save is called.
+
+    Attributes:
+    path (str): path of the checkpoint file
+    key (dict): last update time and options of the update the checkpoint belongs to
+    playlists (dict): progress by playlist ID
+    """
+
+    filename = "update_checkpoint.json"
+
+    def __init__(
+        self,
+        storage_dir: str,
+        last_update: datetime,
+        add_own: bool,
+        incremental: bool,
+        save_interval: float = 2.0,
+    ):
+        self.path = os.path.join(storage_dir, self.filename)
+        self.key = {"last_update": last_update.isoformat(), "add_own": add_own, "incremental": incremental}
+        self.save_interval = save_interval
+        self.playlists = {}
+        self._lock = threading.Lock()
+        self._saved_at = time.monotonic()
+
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r") as checkpoint_file:
+                    data = json.load(checkpoint_file)
+            except ValueError:
+                data = {}
+            # A checkpoint of an older update, or one with other options, cannot be reused
+            if data.get("key") == self.key:
+                self.playlists = data["playlists"]
+
+    def __len__(self):
+        return len(self.playlists)
+
+    # Return the progress of the playlist if it was fetched at this snapshot, otherwise None
+    def progress(self, playlist_id: str, snapshot: str) -> dict:
+        with self._lock:
+            progress = self.playlists.get(playlist_id)
+        if progress is None or progress["snapshot"] != snapshot:
+            return None
+        return progress
+
+    # Record that the playlist was read up to offset, and which new tracks were found.
+    # If done is True, the playlist was read completely.
+    def update(self, playlist_id: str, snapshot: str, offset: int, track_ids: list, done: bool = False):
+        with self._lock:
+            self.playlists[playlist_id] = {
+                "snapshot": snapshot,
+                "offset": offset,
+                "track_ids": list(track_ids),
+                "done": done,
+            }
+            if time.monotonic() - self._saved_at > self.save_interval:
+                self._save()
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        with atomic_write(self.path, "w") as checkpoint_file:
+            json.dump({"key": self.key, "playlists": self.playlists}, checkpoint_file)
+        self._saved_at = time.monotonic()
+
+    # Remove the checkpoint once the update has been saved
+    def clear(self):
+        with self._lock:
+            self.playlists = {}
+            if os.path.exists(self.path):
+                os.remove(self.path)
@@ -1,3 +1,10 @@
+import os
+import json
+import calendar
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+
 def safe_print(*args):
     try:
         print(*args)
@@ -7,3 +14,35 @@ def safe_print(*args):
             string += str(arg) + " "
         string += str(args[-1])
         print(string.encode("utf-8"))
+
+
+# Write a file through a temporary file that replaces it once it is complete, so an interrupted write never leaves
+# a truncated file behind. Readers see either the old or the new contents.
+@contextmanager
+def atomic_write(path: str, mode: str = "wb"):
+    temp_path = path + ".tmp"
+    try:
+        with open(temp_path, mode) as temp_file:
+            yield temp_file
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+# Approximate size in bytes of an API response, measured as compact JSON
+def json_size(data) -> int:
+    return len(json.dumps(data, separators=(",", ":")).encode("utf-8"))
+
+
+# Convert a naive UTC datetime to an integer UTC timestamp in seconds
+def to_timestamp(time: datetime) -> int:
+    return calendar.timegm(time.utctimetuple())
+
+
+# Convert an integer UTC timestamp in seconds back to a naive UTC datetime
+def from_timestamp(timestamp: int) -> datetime:
+    return datetime(1970, 1, 1) + timedelta(seconds=int(timestamp))